@@ -11,6 +11,7 @@ from urllib.parse import quote
 import sympy as sp
 import re
 import traceback
+import itertools
 import google.generativeai as genai
 import requests
 
@@ -20,6 +21,7 @@ load_dotenv() #changed
 
 ############################################################################################
 import os
+import json
 import requests
 from dotenv import load_dotenv
 
@@ -34,189 +36,2723 @@ if not GEMINI_API_KEY:
         "Gemini API key is missing. Set GEMINI_API_KEY in your .env to enable AI responses."
     )
 
-def gemini_chat(prompt, max_retries: int = 3, timeout: int = 15):
-    """Send a prompt to Gemini API with retries and return the response text or a friendly fallback."""
-    if not GEMINI_API_KEY or GEMINI_API_KEY.strip() == "":
-        return "Gemini API key is not configured. Please set GEMINI_API_KEY in your .env."
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
-    payload = {
-        "contents": [{
-            "parts": [{"text": prompt}]
-        }],
-        "generationConfig": {"temperature": 0.4, "maxOutputTokens": 1000}
-    }
-    backoff = 1.0
-    last_error = None
-    for attempt in range(max_retries):
-        try:
-            resp = requests.post(url, json=payload, timeout=timeout)
-            if resp.status_code >= 500:
-                raise requests.exceptions.HTTPError(f"{resp.status_code} {resp.reason}")
-            resp.raise_for_status()
-            data = resp.json()
-            return data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-            last_error = e
-            time.sleep(backoff)
-            backoff *= 2
+# ==== POOLED HTTP TRANSPORT ====
+# One keep-alive session shared by every outbound call (Gemini, NewsAPI) so
+# repeated requests reuse TCP/TLS connections instead of reconnecting each time.
+import threading
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_CONNECTIONS = int(os.getenv("ALIAS_HTTP_POOL_CONNECTIONS", "4"))  # distinct hosts kept pooled
+HTTP_POOL_MAXSIZE = int(os.getenv("ALIAS_HTTP_POOL_MAXSIZE", "10"))  # keep-alive connections per host
+HTTP_POOL_BLOCK = os.getenv("ALIAS_HTTP_POOL_BLOCK", "false").strip().lower() in ("1", "true", "yes")
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """Return the shared pooled requests.Session, creating it on first use."""
+    global _http_session
+    if _http_session is not None:
+        return _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            # pool_block=True turns pool_maxsize into a hard per-host connection limit
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                pool_block=HTTP_POOL_BLOCK,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+    return _http_session
+
+
+def http_post(url, **kwargs):
+    """POST through the shared pooled session."""
+    return get_http_session().post(url, **kwargs)
+
+
+def http_get(url, **kwargs):
+    """GET through the shared pooled session."""
+    return get_http_session().get(url, **kwargs)
+
+
+def get_http_pool_stats():
+    """Return connection reuse counters for every host pool opened so far.
+
+    urllib3 counts requests and newly opened connections per host pool, so
+    reused = requests - connections.
+    """
+    stats = {"hosts": {}, "requests": 0, "connections_opened": 0, "connections_reused": 0}
+    if _http_session is None:
+        return stats
+    seen = set()
+    for adapter in _http_session.adapters.values():
+        if id(adapter) in seen:
             continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests = getattr(pool, "num_requests", 0)
+            num_connections = getattr(pool, "num_connections", 0)
+            reused = max(0, num_requests - num_connections)
+            stats["hosts"][f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "requests": num_requests,
+                "connections_opened": num_connections,
+                "connections_reused": reused,
+                "idle_connections": pool.pool.qsize() if pool.pool is not None else 0,
+            }
+            stats["requests"] += num_requests
+            stats["connections_opened"] += num_connections
+            stats["connections_reused"] += reused
+    return stats
+
+
+def close_http_session():
+    """Close all pooled connections (e.g. on shutdown)."""
+    global _http_session
+    if _http_session is not None:
+        try:
+            _http_session.close()
         except Exception as e:
-            last_error = e
-            break
-    return f"Service is temporarily unavailable. Please try again in a moment. ({last_error})"
+            print("[HTTP Close Error]", e)
+        _http_session = None
 
-###############################################################################################################
+import atexit
+atexit.register(close_http_session)
 
-# ==== CONFIGURATION ====
-# Set your Gemini API key here, or use an environment variable for better security
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')  # Use only the environment variable; no hardcoded default
+# ==== SQLITE CONNECTION MANAGER ====
+# All SQLite access (chat history, caches, document index) goes through one
+# manager: WAL journaling so readers never block the writer, one long-lived
+# read connection per thread, and a single serialized writer connection.
+# Connections live for the whole session, so each keeps its prepared
+# statements (sqlite3's cached_statements) between calls.
+import queue
+import sqlite3
+from contextlib import contextmanager
 
-# No genai.configure for older SDKs
-# ==== TEXT TO SPEECH ====
-engine = pyttsx3.init()
-engine.setProperty('rate', 150)
-voices = engine.getProperty('voices')
-# Use the first available voice instead of hardcoding index 2
-if voices:
-    engine.setProperty('voice', voices[0].id)
+DB_PATH = os.getenv("ALIAS_DB_PATH", "alias_chat_history.db")
+DB_SYNCHRONOUS = os.getenv("ALIAS_DB_SYNCHRONOUS", "NORMAL").strip().upper()  # OFF, NORMAL or FULL
+DB_CACHE_KB = int(os.getenv("ALIAS_DB_CACHE_KB", "16384"))  # page cache per connection
+DB_BUSY_TIMEOUT = float(os.getenv("ALIAS_DB_BUSY_TIMEOUT", "10"))
+DB_STATEMENT_CACHE = int(os.getenv("ALIAS_DB_STATEMENT_CACHE", "256"))
+DB_IDLE_READERS = 4  # read connections kept open after their thread ends
 
-# Define speak before any function uses it
-import threading
-_speaking_thread = None
 
-def speak(text):
-    print(f"ALIAS: {text}")
-    try:
-        global _speaking_thread
-        # Stop any existing speech first
-        if _speaking_thread and _speaking_thread.is_alive():
-            engine.stop()
-        
-        def _speak_worker():
-            try:
-                engine.say(text)
-                engine.runAndWait()
-            except Exception as e:
-                print("[TTS ERROR]", e)
-        
-        _speaking_thread = threading.Thread(target=_speak_worker, daemon=True)
-        _speaking_thread.start()
-    except Exception as e:
-        print("[TTS ERROR]", e)
+class _ReaderSlot:
+    """Holds a thread's read connection; hands it back to the manager when the thread ends."""
 
-def stop_speaking():
-    """Immediately stop any ongoing TTS playback."""
-    try:
-        engine.stop()
-        # Clear any queued speech
-        engine.stop()
-    except Exception as e:
-        print("[TTS STOP ERROR]", e)
+    def __init__(self, manager, conn, generation):
+        self.manager = manager
+        self.conn = conn
+        self.generation = generation
 
-# ==== NEW IMPORTS FOR PDF/FILES/CAMERA/EMAIL ====
-import tempfile
-import docx2txt
-from pypdf import PdfReader
-import cv2
-import base64
-import imaplib
-import smtplib
-import ssl
-from email.message import EmailMessage
+    def __del__(self):
+        try:
+            self.manager._release_reader(self.conn, self.generation)
+        except Exception:
+            pass
 
-# Email configuration from environment
-EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS", "")
-EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD", "")
-IMAP_SERVER = os.getenv("IMAP_SERVER", "imap.gmail.com")
-SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 
-# ==== UTILITIES: PDF EXPORT AND DOCUMENT ANALYSIS ====
-def export_text_to_pdf(text, output_path=None):
-    """Export given text to a simple PDF file and return file path."""
-    try:
-        # Lazy import to avoid linter/module issues until installed
-        from reportlab.lib.pagesizes import letter
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.units import inch
-        if not output_path:
-            fd, tmp_path = tempfile.mkstemp(prefix="friday_", suffix=".pdf")
-            os.close(fd)
-            output_path = tmp_path
-        c = canvas.Canvas(output_path, pagesize=letter)
-        width, height = letter
-        margin = 0.75 * inch
-        y = height - margin
-        max_width = width - 2 * margin
-        # Simple word-wrap
-        words = text.split()
-        line = ""
-        for word in words:
-            test = (line + " " + word).strip()
-            if c.stringWidth(test, "Helvetica", 11) > max_width:
-                c.setFont("Helvetica", 11)
-                c.drawString(margin, y, line)
-                y -= 14
-                if y < margin:
-                    c.showPage()
-                    y = height - margin
-                line = word
-            else:
-                line = test
-        if line:
-            c.setFont("Helvetica", 11)
-            c.drawString(margin, y, line)
-        c.save()
-        speak(f"Saved PDF to {output_path}")
-        return output_path
-    except Exception as e:
-        speak("Failed to export PDF.")
-        print("[PDF Export Error]", e)
-        return None
+class SQLiteManager:
+    """Shared SQLite connections for one database file.
+
+    reader() returns the calling thread's read-only connection. write() is a
+    context manager that serializes writers on one connection and commits (or
+    rolls back) when the outermost block exits, so nested writes join the
+    outer transaction.
+    """
 
+    def __init__(self, path: str = None):
+        self._path = path
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._writer = None
+        self._state_lock = threading.RLock()  # re-entrant: a slot may be released during GC
+        self._readers = set()  # every open read connection, for close()
+        self._idle = []
+        self._generation = 0
+        self.stats = {"reader_opens": 0, "reader_reuses": 0, "writes": 0, "rollbacks": 0}
 
-def read_text_from_file(file_path):
-    """Read text from TXT, PDF, DOCX. Return extracted text or None."""
-    try:
-        lower = file_path.lower()
-        if lower.endswith(".txt"):
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                return f.read()
-        if lower.endswith(".pdf"):
-            from pypdf import PdfReader
-            reader = PdfReader(file_path)
-            texts = []
-            for page in reader.pages:
+    @property
+    def path(self) -> str:
+        return self._path or DB_PATH
+
+    def _open(self, readonly: bool):
+        conn = sqlite3.connect(
+            self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        if not readonly:
+            # Only takes effect on a new file; compact_chat_database() converts existing ones
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+        if DB_SYNCHRONOUS in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size=-{max(0, DB_CACHE_KB)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def reader(self):
+        """This thread's read connection; statements on it autocommit and see the latest committed data."""
+        slot = getattr(self._local, "slot", None)
+        if slot is not None and slot.generation == self._generation:
+            return slot.conn
+        with self._state_lock:
+            generation = self._generation
+            conn = self._idle.pop() if self._idle else None
+            if conn is not None:
+                self.stats["reader_reuses"] += 1
+        if conn is None:
+            # Make sure the schema-changing writer has set WAL before the first reader
+            self._writer_conn()
+            conn = self._open(readonly=True)
+            with self._state_lock:
+                self._readers.add(conn)
+                self.stats["reader_opens"] += 1
+        self._local.slot = _ReaderSlot(self, conn, generation)
+        return conn
+
+    def _release_reader(self, conn, generation):
+        with self._state_lock:
+            if generation == self._generation and len(self._idle) < DB_IDLE_READERS:
+                self._idle.append(conn)
+                return
+            self._readers.discard(conn)
+        conn.close()
+
+    def _writer_conn(self):
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._open(readonly=False)
+            return self._writer
+
+    @contextmanager
+    def write(self):
+        """Run a write transaction on the shared writer connection."""
+        with self._write_lock:
+            conn = self._writer_conn()
+            self._write_depth += 1
+            try:
+                yield conn
+            except BaseException:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    conn.rollback()
+                    self.stats["rollbacks"] += 1
+                raise
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                conn.commit()
+                self.stats["writes"] += 1
+
+    def query(self, sql: str, params=()):
+        return self.reader().execute(sql, params).fetchall()
+
+    def query_one(self, sql: str, params=()):
+        return self.reader().execute(sql, params).fetchone()
+
+    def execute(self, sql: str, params=()):
+        """Run one write statement in its own transaction; returns the cursor."""
+        with self.write() as conn:
+            return conn.execute(sql, params)
+
+    def close(self):
+        """Close every connection; later calls reopen lazily (also used to switch path)."""
+        with self._write_lock:
+            with self._state_lock:
+                self._generation += 1
+                readers, self._readers, self._idle = self._readers, set(), []
+            for conn in readers:
                 try:
-                    texts.append(page.extract_text() or "")
+                    conn.close()
                 except Exception:
                     pass
-            return "\n".join(texts).strip()
-        if lower.endswith(".docx"):
-            import docx2txt
-            return docx2txt.process(file_path) or ""
-        return None
-    except Exception as e:
-        speak("Failed to read the document.")
-        print("[Read File Error]", e)
+            if self._writer is not None:
+                try:
+                    self._writer.close()
+                except Exception:
+                    pass
+                self._writer = None
+
+    def configure(self, path: str):
+        """Point the manager at another database file."""
+        self.close()
+        self._path = path
+
+    def get_stats(self):
+        with self._state_lock:
+            stats = dict(self.stats)
+            stats["open_readers"] = len(self._readers)
+            stats["idle_readers"] = len(self._idle)
+        stats["path"] = self.path
+        return stats
+
+
+chat_db = SQLiteManager()
+atexit.register(chat_db.close)
+
+
+def get_db_stats():
+    """Connection statistics for the shared SQLite manager."""
+    return chat_db.get_stats()
+
+
+# Write-behind queue: chat turns and query-memory updates are applied by a
+# background thread in grouped transactions, off the response path.
+DB_WRITE_BEHIND = os.getenv("ALIAS_DB_WRITE_BEHIND", "on").strip().lower() not in ("0", "off", "false", "no")
+DB_WRITE_BATCH = int(os.getenv("ALIAS_DB_WRITE_BATCH", "64"))  # flush when this many writes are queued
+DB_WRITE_INTERVAL = float(os.getenv("ALIAS_DB_WRITE_INTERVAL", "0.5"))  # ...or this many seconds after the first
+DB_WRITE_DURABLE = os.getenv("ALIAS_DB_WRITE_DURABLE", "off").strip().lower() in ("1", "on", "true", "yes")
+
+
+class WriteBehindQueue:
+    """Applies write operations (callables taking a connection) in batched transactions.
+
+    Each operation runs under its own savepoint, so one failing write does
+    not discard the rest of its batch. submit(op, durable=True) blocks until
+    the batch holding op has committed and returns whether op succeeded.
+    """
+
+    def __init__(self, db, batch_size: int = DB_WRITE_BATCH, interval: float = DB_WRITE_INTERVAL):
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self.interval = max(0.0, interval)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        self.stats = {"submitted": 0, "written": 0, "failed": 0, "batches": 0, "largest_batch": 0}
+
+    def _ensure_thread(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+                self._thread.start()
+
+    def submit(self, op, durable: bool = None):
+        """Queue op(conn). Returns True once queued, or op's outcome when durable."""
+        durable = DB_WRITE_DURABLE if durable is None else durable
+        if self._closed:
+            # After shutdown started, write straight through
+            return self._apply([(op, None)])[0]
+        done = _WriteResult() if durable else None
+        with self._pending_lock:
+            self._pending += 1
+            self.stats["submitted"] += 1
+        self._ensure_thread()
+        self._queue.put((op, done))
+        return done.wait() if done else True
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until everything queued so far is committed."""
+        with self._pending_lock:
+            if self._pending == 0:
+                return True
+        marker = _WriteResult()
+        self._ensure_thread()
+        self._queue.put((None, marker))
+        return marker.wait(timeout)
+
+    def close(self, timeout: float = 10.0):
+        """Flush and stop the writer thread (registered with atexit)."""
+        self.flush(timeout)
+        self._closed = True
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            urgent = item[1] is not None
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    if urgent:
+                        # A caller is waiting: take only what is already queued
+                        item = self._queue.get_nowait()
+                    else:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                urgent = urgent or item[1] is not None
+            outcomes = self._apply(batch)
+            for (op, done), ok in zip(batch, outcomes):
+                if done is not None:
+                    done.set(ok)
+            writes = sum(1 for op, _ in batch if op is not None)
+            with self._pending_lock:
+                self._pending -= writes
+
+    def _apply(self, batch):
+        outcomes = []
+        try:
+            with self.db.write() as conn:
+                if not conn.in_transaction:
+                    conn.execute("BEGIN")
+                for op, _ in batch:
+                    if op is None:
+                        outcomes.append(True)
+                        continue
+                    conn.execute("SAVEPOINT write_behind")
+                    try:
+                        op(conn)
+                        conn.execute("RELEASE write_behind")
+                        outcomes.append(True)
+                    except Exception as e:
+                        print("[DB Write Error]", e)
+                        conn.execute("ROLLBACK TO write_behind")
+                        conn.execute("RELEASE write_behind")
+                        outcomes.append(False)
+        except Exception as e:
+            print("[DB Write Error]", e)
+            outcomes = [op is None for op, _ in batch]
+        writes = [ok for (op, _), ok in zip(batch, outcomes) if op is not None]
+        with self._pending_lock:
+            self.stats["written"] += sum(writes)
+            self.stats["failed"] += len(writes) - sum(writes)
+            if writes:
+                self.stats["batches"] += 1
+                self.stats["largest_batch"] = max(self.stats["largest_batch"], len(writes))
+        return outcomes
+
+    def get_stats(self):
+        with self._pending_lock:
+            stats = dict(self.stats)
+            stats["pending"] = self._pending
+        stats["avg_batch"] = stats["written"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+
+class _WriteResult:
+    def __init__(self):
+        self._event = threading.Event()
+        self.ok = False
+
+    def set(self, ok: bool):
+        self.ok = ok
+        self._event.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._event.wait(timeout) and self.ok
+
+
+chat_writes = WriteBehindQueue(chat_db)
+atexit.register(chat_writes.close)
+
+
+def get_write_queue_stats():
+    """Batching statistics for the chat write-behind queue."""
+    return chat_writes.get_stats()
+
+
+# ==== LLM RESPONSE CACHE ====
+# Two tiers in front of gemini_chat: an in-process LRU for microsecond hits and
+# a SQLite table (in the chat history DB) that survives restarts. Keys cover the
+# normalized prompt, model and generationConfig; TTLs are chosen per feature.
+import hashlib
+from collections import OrderedDict, deque
+
+GEMINI_MODEL = "gemini-1.5-flash"
+GEMINI_GENERATION_CONFIG = {"temperature": 0.4, "maxOutputTokens": 1000}
+
+LLM_CACHE_ENABLED = os.getenv("ALIAS_LLM_CACHE", "on").strip().lower() not in ("0", "off", "false", "no")
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("ALIAS_LLM_CACHE_MEMORY_ENTRIES", "256"))
+LLM_CACHE_DISK_ENTRIES = int(os.getenv("ALIAS_LLM_CACHE_DISK_ENTRIES", "5000"))
+LLM_CACHE_DISK_BYTES = int(os.getenv("ALIAS_LLM_CACHE_DISK_BYTES", str(50 * 1024 * 1024)))
+
+# Seconds a cached reply stays valid, by feature. 0 disables caching for that feature.
+LLM_CACHE_TTLS = {
+    "general": 6 * 3600,
+    "document": 30 * 86400,
+    "news": 30 * 60,
+    "code": 7 * 86400,
+    "math": 30 * 86400,
+    "sql": 86400,
+    "summary": 7 * 86400,
+}
+
+
+def _normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace so trivially different prompts share a cache entry."""
+    return re.sub(r"\s+", " ", (prompt or "").strip())
+
+
+class LLMResponseCache:
+    """Memory LRU + SQLite cache of Gemini replies with per-feature TTLs."""
+
+    def __init__(self, db=None, memory_entries=LLM_CACHE_MEMORY_ENTRIES,
+                 disk_entries=LLM_CACHE_DISK_ENTRIES, disk_bytes=LLM_CACHE_DISK_BYTES):
+        self.db = db or chat_db
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # key -> (response, expires_at)
+        self._lock = threading.Lock()
+        self._table_ready = False
+        self._puts_since_evict = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(prompt: str, generation_config=None, model: str = GEMINI_MODEL) -> str:
+        config = json.dumps(generation_config or GEMINI_GENERATION_CONFIG, sort_keys=True)
+        raw = f"{model}\n{config}\n{_normalize_prompt(prompt)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _ensure_table(self):
+        if not self._table_ready:
+            migrate_chat_database(self.db)
+            self._table_ready = True
+
+    def _remember(self, key, response, expires_at):
+        with self._lock:
+            self._memory[key] = (response, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get(self, key: str):
+        """Return the cached response for key, or None on miss/expiry."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry[0]
+                del self._memory[key]
+        try:
+            self._ensure_table()
+            row = self.db.query_one('SELECT response, expires_at FROM llm_cache WHERE key = ?', (key,))
+            if row and row[1] > now:
+                self.db.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (now, key))
+            elif row:
+                self.db.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                row = None
+        except Exception as e:
+            print("[LLM Cache Read Error]", e)
+            row = None
+        if row:
+            self._remember(key, row[0], row[1])
+            with self._lock:
+                self.stats["disk_hits"] += 1
+            return row[0]
+        with self._lock:
+            self.stats["misses"] += 1
         return None
 
+    def put(self, key: str, response: str, feature: str = "general"):
+        """Store a successful response under key using the feature's TTL."""
+        ttl = LLM_CACHE_TTLS.get(feature, LLM_CACHE_TTLS["general"])
+        if not response or ttl <= 0:
+            return
+        now = time.time()
+        expires_at = now + ttl
+        self._remember(key, response, expires_at)
+        try:
+            self._ensure_table()
+            self.db.execute('''
+                INSERT OR REPLACE INTO llm_cache (key, feature, response, created_at, expires_at, last_access, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (key, feature, response, now, expires_at, now, len(response.encode("utf-8"))))
+            with self._lock:
+                self.stats["stores"] += 1
+                self._puts_since_evict += 1
+                run_evict = self._puts_since_evict >= 50
+                if run_evict:
+                    self._puts_since_evict = 0
+            if run_evict:
+                with self.db.write() as conn:
+                    self._evict(conn, now)
+        except Exception as e:
+            print("[LLM Cache Write Error]", e)
+
+    def _evict(self, conn, now):
+        """Drop expired rows, then least-recently-used rows beyond the size bounds."""
+        removed = conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,)).rowcount
+        count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+        while count > self.disk_entries or total > self.disk_bytes:
+            batch = max(1, count - self.disk_entries, count // 10 if total > self.disk_bytes else 0)
+            removed += conn.execute(
+                'DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access LIMIT ?)',
+                (batch,),
+            ).rowcount
+            count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+        with self._lock:
+            self.stats["evictions"] += removed
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        try:
+            self._ensure_table()
+            self.db.execute('DELETE FROM llm_cache')
+        except Exception as e:
+            print("[LLM Cache Clear Error]", e)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+llm_cache = LLMResponseCache()
+
+
+def get_llm_cache_stats():
+    """Hit/miss statistics for the Gemini response cache."""
+    return llm_cache.get_stats()
+
+# ==== ASYNC GEMINI CLIENT ====
+# A single asyncio loop (on a daemon thread) owns all non-streaming Gemini calls.
+# A semaphore caps requests in flight, identical concurrent prompts share one
+# upstream call (single-flight), and retry backoff awaits instead of sleeping a
+# thread. The blocking HTTP attempt itself runs on a small executor sized to the
+# in-flight limit so it keeps using the pooled keep-alive session.
+import asyncio
+import concurrent.futures
+
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("ALIAS_GEMINI_MAX_IN_FLIGHT", "4"))
+GEMINI_RATE_LIMIT_RPM = float(os.getenv("ALIAS_GEMINI_RPM", "0"))  # upstream requests per minute; 0 = unlimited
+
 
-def analyze_document(file_path):
-    """Extract text and run Gemini summary/analysis. Return summary string."""
+# ---- Resilience: circuit breaker, jittered backoff, Retry-After, deadlines ----
+import random
+from email.utils import parsedate_to_datetime
+
+GEMINI_DEADLINE = float(os.getenv("ALIAS_GEMINI_DEADLINE", "30"))  # seconds per call, retries included
+GEMINI_BACKOFF_BASE = float(os.getenv("ALIAS_GEMINI_BACKOFF_BASE", "0.5"))
+GEMINI_BACKOFF_CAP = float(os.getenv("ALIAS_GEMINI_BACKOFF_CAP", "8"))
+GEMINI_BREAKER_FAILURES = int(os.getenv("ALIAS_GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_RESET = float(os.getenv("ALIAS_GEMINI_BREAKER_RESET", "30"))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while the circuit breaker is open."""
+
+
+class GeminiRateLimitError(requests.exceptions.HTTPError):
+    """HTTP 429 from Gemini; retry_after is the server-requested delay in seconds (or None)."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed -> open after failure_threshold consecutive failures; after
+    reset_timeout one half-open probe is let through, and its outcome closes
+    or re-opens the circuit."""
+
+    def __init__(self, failure_threshold: int = GEMINI_BREAKER_FAILURES, reset_timeout: float = GEMINI_BREAKER_RESET):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return self._state
+
+    def allow(self) -> bool:
+        """Return True if a request may go upstream now."""
+        with self._lock:
+            if self._state == "closed":
+                return True
+            if self._state == "open":
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = "half_open"
+                self._probe_in_flight = False
+            # half-open: a single probe at a time
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def retry_in(self) -> float:
+        """Seconds until the next half-open probe is allowed (0 if not open)."""
+        with self._lock:
+            if self._state != "open":
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    print(f"[Gemini Circuit] open after {self._failures} failures; failing fast for {self.reset_timeout:.0f}s")
+                self._state = "open"
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+gemini_breaker = CircuitBreaker()
+
+
+def _parse_retry_after(value):
+    """Parse a Retry-After header (delta-seconds or HTTP date) into seconds."""
+    if not value:
+        return None
+    value = value.strip()
     try:
-        text = read_text_from_file(file_path)
-        if not text:
-            return "Could not extract text from document."
-        prompt = (
-            "Summarize and analyze the following document. Extract key points, action items, and any entities.\n\n" 
-            + text[:12000]
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, when.timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def _decorrelated_jitter(previous: float, base: float = GEMINI_BACKOFF_BASE, cap: float = GEMINI_BACKOFF_CAP) -> float:
+    """Next backoff delay: uniform(base, previous * 3), capped."""
+    return min(cap, random.uniform(base, max(base, previous) * 3))
+
+
+def _is_transient_error(error) -> bool:
+    """Timeouts, connection errors, 5xx and 429 are worth retrying; other 4xx are not."""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, GeminiRateLimitError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError):
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+        return status is None or status >= 500
+    return False
+
+
+def _gemini_generate_once(payload, timeout):
+    """Perform one generateContent request and return the reply text (raises on failure)."""
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
+    resp = http_post(url, json=payload, timeout=timeout)
+    if resp.status_code == 429:
+        raise GeminiRateLimitError(
+            f"429 {resp.reason}", retry_after=_parse_retry_after(resp.headers.get("Retry-After"))
         )
-        summary = gemini_chat(prompt)
-        return summary or "No analysis produced."
-    except Exception as e:
-        print("[Analyze Document Error]", e)
-        return "Failed to analyze document."
+    if resp.status_code >= 500:
+        raise requests.exceptions.HTTPError(f"{resp.status_code} {resp.reason}")
+    resp.raise_for_status()
+    data = resp.json()
+    return data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+
+
+def _gemini_fallback_message(error):
+    return f"Service is temporarily unavailable. Please try again in a moment. ({error})"
+
+
+class _AsyncRateLimiter:
+    """Token bucket shared by every upstream request on the client loop."""
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+
+    async def acquire(self, deadline_at: float = None):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            wait = (1 - self._tokens) / self.rate
+            if deadline_at is not None and now + wait > deadline_at:
+                raise TimeoutError("Gemini rate limit wait exceeds call deadline")
+            await asyncio.sleep(wait)
+
+
+class _UpstreamSlot:
+    """An acquired in-flight slot of AsyncGeminiClient; release() is idempotent."""
+
+    def __init__(self, client):
+        self._client = client
+        self._held = True
+
+    def release(self):
+        if self._held:
+            self._held = False
+            self._client.loop.call_soon_threadsafe(self._client._semaphore.release)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AsyncGeminiClient:
+    """asyncio Gemini client with bounded concurrency and request coalescing."""
+
+    def __init__(self, max_in_flight: int = GEMINI_MAX_IN_FLIGHT, rate_limit_rpm: float = GEMINI_RATE_LIMIT_RPM):
+        self.max_in_flight = max(1, max_in_flight)
+        self._rate_limiter = _AsyncRateLimiter(rate_limit_rpm, burst=self.max_in_flight)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_in_flight, thread_name_prefix="gemini"
+        )
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._inflight = {}  # cache key -> asyncio.Task shared by identical prompts
+        self._waiters = {}  # cache key -> callers currently awaiting that task
+        self._start_lock = threading.Lock()
+        self.stats = {"requests": 0, "coalesced": 0, "upstream_calls": 0}
+
+    @property
+    def loop(self):
+        """The client's event loop, started on a daemon thread on first use."""
+        if self._loop is None:
+            with self._start_lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    ready = threading.Event()
+
+                    def run():
+                        asyncio.set_event_loop(loop)
+                        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+                        ready.set()
+                        loop.run_forever()
+
+                    self._thread = threading.Thread(target=run, name="gemini-loop", daemon=True)
+                    self._thread.start()
+                    ready.wait()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the client loop; returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def generate(self, prompt, max_retries: int = 3, timeout: int = 15,
+                       feature: str = "general", use_cache: bool = True, raise_errors: bool = False,
+                       deadline: float = None):
+        """Return Gemini's reply for prompt. Must run on the client loop.
+
+        deadline bounds the whole call in seconds, retries included (default
+        GEMINI_DEADLINE). Identical concurrent prompts share one upstream call,
+        but each caller's deadline only limits its own wait; the shared call is
+        cancelled once nobody is waiting for it. On failure returns the
+        friendly fallback message, or raises if raise_errors is set.
+        """
+        self.stats["requests"] += 1
+        deadline = deadline if deadline is not None else GEMINI_DEADLINE
+        deadline_at = time.monotonic() + deadline
+        key = llm_cache.make_key(prompt, GEMINI_GENERATION_CONFIG)
+        shared = self._inflight.get(key)
+        if shared is not None:
+            self.stats["coalesced"] += 1
+        else:
+            # The upstream call is its own task: cancelling the caller that started it
+            # (deadline, cancel token) must not strand the callers that joined it
+            shared = self.loop.create_task(self._generate_uncoalesced(
+                key, prompt, max_retries, timeout, feature, use_cache, max(deadline, GEMINI_DEADLINE)
+            ))
+            self._inflight[key] = shared
+            shared.add_done_callback(lambda task, key=key: self._finish_inflight(key, task))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(shared), max(0.0, deadline_at - time.monotonic()))
+        except Exception as e:
+            if raise_errors:
+                raise
+            return _gemini_fallback_message(e)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not shared.done():
+                    shared.cancel()
+
+    def _finish_inflight(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark retrieved so asyncio doesn't warn when every waiter has gone
+            task.exception()
+
+    async def _generate_uncoalesced(self, key, prompt, max_retries, timeout, feature, use_cache, deadline):
+        loop = asyncio.get_running_loop()
+        if use_cache and LLM_CACHE_ENABLED:
+            cached = await loop.run_in_executor(None, llm_cache.get, key)
+            if cached is not None:
+                return cached
+        payload = {
+            "contents": [{
+                "parts": [{"text": prompt}]
+            }],
+            "generationConfig": GEMINI_GENERATION_CONFIG
+        }
+        deadline_at = time.monotonic() + (deadline if deadline is not None else GEMINI_DEADLINE)
+        backoff = GEMINI_BACKOFF_BASE
+        last_error = None
+        for attempt in range(max_retries):
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0.05:
+                last_error = last_error or TimeoutError("Gemini call deadline exceeded")
+                break
+            await self._rate_limiter.acquire(deadline_at)
+            if not gemini_breaker.allow():
+                raise CircuitOpenError(
+                    f"Gemini circuit open; retrying in {gemini_breaker.retry_in():.0f}s"
+                )
+            try:
+                async with self._semaphore:
+                    self.stats["upstream_calls"] += 1
+                    attempt_timeout = min(timeout, max(0.5, deadline_at - time.monotonic()))
+                    text = await loop.run_in_executor(self._executor, _gemini_generate_once, payload, attempt_timeout)
+                gemini_breaker.record_success()
+                if use_cache and LLM_CACHE_ENABLED and text:
+                    loop.run_in_executor(None, llm_cache.put, key, text, feature)
+                return text
+            except Exception as e:
+                last_error = e
+                if not _is_transient_error(e):
+                    # The request itself is bad (4xx, bad JSON); upstream is healthy
+                    gemini_breaker.record_success()
+                    raise
+                if isinstance(e, GeminiRateLimitError):
+                    # Throttling is not an outage: don't trip the breaker, wait as asked
+                    gemini_breaker.record_success()
+                    delay = e.retry_after if e.retry_after is not None else _decorrelated_jitter(backoff)
+                else:
+                    gemini_breaker.record_failure()
+                    delay = _decorrelated_jitter(backoff)
+                backoff = delay
+                if attempt + 1 >= max_retries:
+                    break
+                if delay >= deadline_at - time.monotonic():
+                    # Waiting would blow the deadline; fail now instead
+                    break
+                await asyncio.sleep(delay)
+        raise last_error or RuntimeError("no Gemini attempts were made")
+
+    async def _acquire_upstream(self, deadline_at: float):
+        await self._rate_limiter.acquire(deadline_at)
+        await self._semaphore.acquire()
+        self.stats["upstream_calls"] += 1
+
+    def upstream_slot(self, deadline: float = None):
+        """Wait for a rate-limit token and an in-flight slot for a request made outside the loop.
+
+        Used by gemini_chat_stream so streamed replies count against the same
+        ALIAS_GEMINI_RPM limit and GEMINI_MAX_IN_FLIGHT cap as everything else.
+        Returns a _UpstreamSlot; release it (or leave its with block) when the
+        request is finished. Raises TimeoutError if the wait would pass deadline.
+        """
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("upstream_slot() called from the Gemini loop")
+        deadline_at = time.monotonic() + (deadline if deadline is not None else GEMINI_DEADLINE)
+        self.submit(self._acquire_upstream(deadline_at)).result()
+        return _UpstreamSlot(self)
+
+    def generate_sync(self, prompt, **kwargs):
+        """Blocking wrapper around generate() for callers outside the loop."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("generate_sync() called from the Gemini loop; await generate() instead")
+        return self.submit(self.generate(prompt, **kwargs)).result()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["in_flight_keys"] = len(self._inflight)
+        stats["circuit_state"] = gemini_breaker.state
+        return stats
+
+
+gemini_client = AsyncGeminiClient()
+
+
+async def gemini_chat_async(prompt, max_retries: int = 3, timeout: int = 15,
+                            feature: str = "general", use_cache: bool = True, deadline: float = None):
+    """Awaitable gemini_chat; usable from the client loop or any other event loop."""
+    if not GEMINI_API_KEY or GEMINI_API_KEY.strip() == "":
+        return "Gemini API key is not configured. Please set GEMINI_API_KEY in your .env."
+    coro = gemini_client.generate(prompt, max_retries=max_retries, timeout=timeout,
+                                  feature=feature, use_cache=use_cache, deadline=deadline)
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is gemini_client.loop:
+        return await coro
+    return await asyncio.wrap_future(gemini_client.submit(coro))
+
+
+def gemini_chat(prompt, max_retries: int = 3, timeout: int = 15, feature: str = "general",
+                use_cache: bool = True, deadline: float = None):
+    """Send a prompt to Gemini API with retries and return the response text or a friendly fallback.
+
+    Thin blocking wrapper over gemini_client. Successful replies are cached per
+    feature (see LLM_CACHE_TTLS); pass use_cache=False for prompts whose answer
+    must always be fresh. deadline caps the total wait in seconds.
+    """
+    if not GEMINI_API_KEY or GEMINI_API_KEY.strip() == "":
+        return "Gemini API key is not configured. Please set GEMINI_API_KEY in your .env."
+    try:
+        return gemini_client.generate_sync(prompt, max_retries=max_retries, timeout=timeout,
+                                           feature=feature, use_cache=use_cache, deadline=deadline)
+    except Exception as e:
+        return _gemini_fallback_message(e)
+
+
+async def gemini_batch_async(prompts, max_concurrency: int = None, feature: str = "general",
+                             use_cache: bool = True, deadline: float = None, on_item=None, cancel=None):
+    """Run prompts concurrently on the client loop; see gemini_batch()."""
+    limit = asyncio.Semaphore(max(1, max_concurrency or gemini_client.max_in_flight))
+
+    async def run_one(index, prompt):
+        async with limit:
+            try:
+                if cancel is not None and cancel.cancelled:
+                    raise AnalysisCancelled("cancelled")
+                text = await gemini_client.generate(prompt, feature=feature, use_cache=use_cache,
+                                                    deadline=deadline, raise_errors=True)
+                item = {"index": index, "ok": True, "text": text, "error": None}
+            except Exception as e:
+                item = {"index": index, "ok": False, "text": None, "error": str(e) or type(e).__name__}
+        if on_item:
+            try:
+                on_item(item)
+            except Exception as e:
+                print("[Gemini Batch Callback Error]", e)
+        return item
+
+    # gather preserves input order regardless of completion order
+    return await asyncio.gather(*(run_one(i, p) for i, p in enumerate(prompts)))
+
+
+def gemini_batch(prompts, max_concurrency: int = None, feature: str = "general",
+                 use_cache: bool = True, deadline: float = None, on_item=None, cancel=None):
+    """Send independent prompts in parallel and return one result per prompt, in input order.
+
+    Each result is a dict: {"index", "ok", "text", "error"}; a failed prompt does
+    not fail the batch. max_concurrency limits this batch (default: the client's
+    in-flight limit); all batches still share the global in-flight cap, rate
+    limit and circuit breaker. on_item(result) is called as each prompt finishes
+    (from the client loop thread, so keep it cheap). Once cancel (a CancelToken)
+    is cancelled, prompts that have not been sent yet fail with "cancelled".
+    """
+    prompts = list(prompts)
+    if not prompts:
+        return []
+    if not GEMINI_API_KEY or GEMINI_API_KEY.strip() == "":
+        error = "Gemini API key is not configured. Please set GEMINI_API_KEY in your .env."
+        return [{"index": i, "ok": False, "text": None, "error": error} for i in range(len(prompts))]
+    return gemini_client.submit(
+        gemini_batch_async(prompts, max_concurrency=max_concurrency, feature=feature,
+                           use_cache=use_cache, deadline=deadline, on_item=on_item, cancel=cancel)
+    ).result()
+
+
+def gemini_chat_stream(prompt, on_chunk=None, timeout: int = 30, feature: str = "general", use_cache: bool = True):
+    """Stream a Gemini reply via streamGenerateContent (SSE).
+
+    on_chunk(text_so_far) is called as each partial chunk arrives. Returns the
+    full response text, or a friendly fallback message on failure. Cache hits
+    are delivered as a single chunk.
+    """
+    if not GEMINI_API_KEY or GEMINI_API_KEY.strip() == "":
+        return "Gemini API key is not configured. Please set GEMINI_API_KEY in your .env."
+    cache_key = None
+    if use_cache and LLM_CACHE_ENABLED:
+        cache_key = llm_cache.make_key(prompt, GEMINI_GENERATION_CONFIG)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            if on_chunk:
+                on_chunk(cached)
+            return cached
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+    payload = {
+        "contents": [{
+            "parts": [{"text": prompt}]
+        }],
+        "generationConfig": GEMINI_GENERATION_CONFIG
+    }
+    try:
+        slot = gemini_client.upstream_slot()
+    except Exception as e:
+        # The rate-limit wait would exceed the call deadline
+        return _gemini_fallback_message(e)
+    if not gemini_breaker.allow():
+        slot.release()
+        return _gemini_fallback_message(
+            CircuitOpenError(f"Gemini circuit open; retrying in {gemini_breaker.retry_in():.0f}s")
+        )
+    parts = []
+    try:
+        with slot, http_post(url, json=payload, timeout=timeout, stream=True) as resp:
+            resp.raise_for_status()
+            gemini_breaker.record_success()
+            for raw in resp.iter_lines(decode_unicode=True):
+                # SSE frames look like "data: {...json...}"; blank lines separate events
+                if not raw or not raw.startswith("data:"):
+                    continue
+                data_str = raw[5:].strip()
+                if not data_str or data_str == "[DONE]":
+                    continue
+                try:
+                    data = json.loads(data_str)
+                except ValueError:
+                    continue
+                chunk = "".join(
+                    p.get("text", "")
+                    for p in data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+                )
+                if not chunk:
+                    continue
+                parts.append(chunk)
+                if on_chunk:
+                    try:
+                        on_chunk("".join(parts))
+                    except Exception as e:
+                        print("[Stream Callback Error]", e)
+        text = "".join(parts)
+        if cache_key and text:
+            llm_cache.put(cache_key, text, feature)
+        return text
+    except Exception as e:
+        print("[Gemini Stream Error]", e)
+        if _is_transient_error(e):
+            gemini_breaker.record_failure()
+        else:
+            # Upstream answered (e.g. a 4xx); it is healthy, so release any half-open probe
+            gemini_breaker.record_success()
+        if parts:
+            # Keep whatever already reached the user rather than discarding it
+            return "".join(parts)
+        # Fall back to the non-streaming path (with its retries)
+        return gemini_chat(prompt, feature=feature, use_cache=use_cache)
+
+# ==== PROMPT BUDGETING ====
+# Prompts are assembled from parts (system text, retrieved memory, history, the
+# user query) under a token budget instead of blind character slicing. Each part
+# gets a share of the budget; unused share flows to parts that need more, and
+# anything still too large is trimmed at a natural boundary.
+import math
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("ALIAS_PROMPT_TOKEN_BUDGET", "6000"))
+DOCUMENT_TOKEN_BUDGET = int(os.getenv("ALIAS_DOCUMENT_TOKEN_BUDGET", "8000"))
+CHARS_PER_TOKEN = 4  # rough average for English text with Gemini's tokenizer
+
+# Share of the budget each part may claim before leftovers are redistributed
+PROMPT_BUDGET_SHARES = {"system": 0.15, "memory": 0.2, "history": 0.25, "query": 0.4}
+# Order in which leftover budget is handed out
+_PROMPT_PRIORITY = ("query", "system", "memory", "history")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token)."""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """Trim text to roughly max_tokens.
+
+    keep="head" keeps the beginning, "tail" the end, and "middle" keeps the
+    beginning and end and elides the middle (useful for documents and logs).
+    """
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text or ""
+    if max_tokens <= 0:
+        return ""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if keep == "tail":
+        cut = text[-max_chars:]
+        space = cut.find(" ")
+        return cut[space + 1:] if 0 <= space < 40 else cut
+    if keep == "middle":
+        marker = "\n[...]\n"
+        head_chars = max(0, (max_chars - len(marker)) * 2 // 3)
+        tail_chars = max(0, max_chars - len(marker) - head_chars)
+        return text[:head_chars].rstrip() + marker + (text[-tail_chars:].lstrip() if tail_chars else "")
+    cut = text[:max_chars]
+    space = cut.rfind(" ")
+    return cut[:space] if space > max_chars - 40 else cut
+
+
+def _allocate_prompt_budget(needs: dict, budget: int) -> dict:
+    """Split budget across parts: each gets min(need, share), then leftovers by priority."""
+    alloc = {name: min(need, int(budget * PROMPT_BUDGET_SHARES[name])) for name, need in needs.items()}
+    leftover = budget - sum(alloc.values())
+    for name in _PROMPT_PRIORITY:
+        if leftover <= 0:
+            break
+        extra = min(leftover, needs.get(name, 0) - alloc.get(name, 0))
+        if extra > 0:
+            alloc[name] += extra
+            leftover -= extra
+    return alloc
+
+
+def build_prompt(query: str, system: str = "", history=None, memory=None,
+                 budget: int = None, query_keep: str = "head", summary: str = "") -> str:
+    """Assemble a prompt that fits within budget tokens.
+
+    history: list of (user_message, assistant_response) pairs, oldest first;
+    the oldest turns are dropped first. summary: a running summary of earlier
+    turns, placed before them and given at most half the history share.
+    memory: list of retrieved snippets, best first; the lowest-ranked are
+    dropped first. query_keep controls how an oversized query is trimmed (see
+    truncate_to_tokens).
+    """
+    budget = budget or PROMPT_TOKEN_BUDGET
+    history = [(u or "", a or "") for u, a in (history or [])]
+    memory = [m for m in (memory or []) if m]
+
+    turn_texts = [f"User: {u}\nAssistant: {a}\n" for u, a in history]
+    summary_text = f"Summary of earlier conversation: {summary.strip()}\n" if summary and summary.strip() else ""
+    needs = {
+        "system": estimate_tokens(system),
+        "memory": sum(estimate_tokens(m) + 1 for m in memory),
+        "history": estimate_tokens(summary_text) + sum(estimate_tokens(t) for t in turn_texts),
+        "query": estimate_tokens(query),
+    }
+    alloc = _allocate_prompt_budget(needs, budget)
+
+    system_text = truncate_to_tokens(system, alloc["system"])
+    query_text = truncate_to_tokens(query or "", alloc["query"], keep=query_keep)
+    if summary_text:
+        summary_text = truncate_to_tokens(summary_text, alloc["history"] // 2).rstrip("\n")
+        summary_text = summary_text + "\n" if summary_text else ""
+
+    # Keep the newest turns; compress a long turn rather than dropping it outright
+    kept_turns = []
+    remaining = alloc["history"] - estimate_tokens(summary_text)
+    for turn in reversed(turn_texts):
+        cost = estimate_tokens(turn)
+        if cost <= remaining:
+            kept_turns.append(turn)
+            remaining -= cost
+        elif remaining >= 32 and not kept_turns:
+            kept_turns.append(truncate_to_tokens(turn, remaining, keep="middle") + "\n")
+            remaining = 0
+        else:
+            break
+    kept_turns.reverse()
+
+    kept_memory = []
+    remaining = alloc["memory"]
+    for snippet in memory:
+        cost = estimate_tokens(snippet) + 1
+        if cost <= remaining:
+            kept_memory.append(snippet)
+            remaining -= cost
+        elif remaining >= 32:
+            kept_memory.append(truncate_to_tokens(snippet, remaining - 1))
+            break
+        else:
+            break
+
+    total_need = sum(needs.values())
+    if total_need > budget:
+        print(f"[Prompt Budget] trimmed prompt from ~{total_need} to ~{budget} tokens "
+              f"(history {len(kept_turns)}/{len(turn_texts)} turns, memory {len(kept_memory)}/{len(memory)} items)")
+
+    sections = []
+    if system_text:
+        sections.append(system_text)
+    if kept_memory:
+        sections.append("Relevant information:\n" + "\n".join(kept_memory))
+    if kept_turns or summary_text:
+        sections.append("Recent conversation context:\n" + summary_text + "".join(kept_turns) + "\nCurrent query: " + query_text)
+    else:
+        sections.append(query_text)
+    return "\n\n".join(sections)
+
+###############################################################################################################
+
+# ==== CONFIGURATION ====
+# Set your Gemini API key here, or use an environment variable for better security
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')  # Use only the environment variable; no hardcoded default
+
+# No genai.configure for older SDKs
+# ==== TEXT TO SPEECH ====
+engine = pyttsx3.init()
+engine.setProperty('rate', 150)
+voices = engine.getProperty('voices')
+# Use the first available voice instead of hardcoding index 2
+if voices:
+    engine.setProperty('voice', voices[0].id)
+
+# Define speak before any function uses it
+_speaking_thread = None
+
+def speak(text):
+    print(f"ALIAS: {text}")
+    try:
+        global _speaking_thread
+        # Stop any existing speech first
+        if _speaking_thread and _speaking_thread.is_alive():
+            engine.stop()
+        
+        def _speak_worker():
+            try:
+                engine.say(text)
+                engine.runAndWait()
+            except Exception as e:
+                print("[TTS ERROR]", e)
+        
+        _speaking_thread = threading.Thread(target=_speak_worker, daemon=True)
+        _speaking_thread.start()
+    except Exception as e:
+        print("[TTS ERROR]", e)
+
+def stop_speaking():
+    """Immediately stop any ongoing TTS playback."""
+    try:
+        engine.stop()
+        # Clear any queued speech
+        engine.stop()
+    except Exception as e:
+        print("[TTS STOP ERROR]", e)
+
+# ==== NEW IMPORTS FOR PDF/FILES/CAMERA/EMAIL ====
+import tempfile
+import docx2txt
+from pypdf import PdfReader
+import cv2
+import base64
+import imaplib
+import smtplib
+import ssl
+from email.message import EmailMessage
+
+# Email configuration from environment
+EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS", "")
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD", "")
+IMAP_SERVER = os.getenv("IMAP_SERVER", "imap.gmail.com")
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+
+# ==== UTILITIES: PDF EXPORT AND DOCUMENT ANALYSIS ====
+PDF_EXPORT_FONT = "Helvetica"
+PDF_EXPORT_FONT_SIZE = 11
+PDF_EXPORT_LEADING = 14
+_PDF_MAX_CARRY = 4096  # a "word" longer than this is laid out before it ends
+
+
+def _wrap_text_stream(pieces, width, max_width: float):
+    """Yield wrapped display lines from an iterable of text pieces.
+
+    Newlines are hard breaks, runs of spaces become one space (leading
+    indentation is kept), and words wider than a line are split by character.
+    Only the line being filled and a partial word are held between pieces.
+    """
+    space = width(" ")
+    line, line_width = "", 0.0
+    at_start, indent = True, ""
+
+    def place(word):
+        nonlocal line, line_width, at_start, indent
+        prefix = indent if at_start else (" " if line else "")
+        word_width = width(word)
+        if line_width + width(prefix) + word_width <= max_width:
+            line += prefix + word
+            line_width += width(prefix) + word_width
+            at_start, indent = False, ""
+            return
+        if line.strip():
+            yield line
+        line, line_width, at_start, indent = "", 0.0, False, ""
+        if word_width <= max_width:
+            line, line_width = word, word_width
+            return
+        # Break an over-long word (URLs, base64, ...) at character level
+        for ch in word:
+            ch_width = width(ch)
+            if line and line_width + ch_width > max_width:
+                yield line
+                line, line_width = "", 0.0
+            line += ch
+            line_width += ch_width
+
+    carry = ""
+    for piece in itertools.chain(pieces, [None]):
+        if piece is None:
+            data, final = carry, True
+        else:
+            data, final = carry + piece, False
+        carry = ""
+        tokens = re.findall(r"\n|[^\S\n]+|[^\s]+", data)
+        if not final and tokens and tokens[-1] != "\n" and len(tokens[-1]) < _PDF_MAX_CARRY:
+            # The last word (or run of spaces, which may be indentation) may continue in the next piece
+            carry = tokens.pop()
+        for token in tokens:
+            if token == "\n":
+                yield line
+                line, line_width, at_start, indent = "", 0.0, True, ""
+            elif token.isspace():
+                if at_start:
+                    indent = token.replace("\t", "    ")
+                    if width(indent) >= max_width:
+                        indent = ""
+            else:
+                yield from place(token)
+    if line:
+        yield line
+
+
+def write_text_pdf(text, output_path: str, title: str = None, on_page=None) -> int:
+    """Lay out text (a string or an iterable of string pieces) into a PDF page by page.
+
+    Text is wrapped and paginated as it arrives, so a generator over a long
+    transcript is never joined in memory. Pages are numbered in the footer.
+    on_page(page_number) is called after each page is finished. Returns the
+    page count.
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.units import inch
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    if isinstance(text, str):
+        text = [text]
+    c = canvas.Canvas(output_path, pagesize=letter, pageCompression=1)
+    if title:
+        c.setTitle(title)
+    width, height = letter
+    margin = 0.75 * inch
+    max_width = width - 2 * margin
+    lines_per_page = max(1, int((height - 2 * margin) // PDF_EXPORT_LEADING))
+    widths = {}
+
+    def measure(s):
+        # Most calls are for short words that repeat, so memoize them
+        if len(s) > 32:
+            return stringWidth(s, PDF_EXPORT_FONT, PDF_EXPORT_FONT_SIZE)
+        w = widths.get(s)
+        if w is None:
+            if len(widths) > 50000:
+                widths.clear()
+            w = widths[s] = stringWidth(s, PDF_EXPORT_FONT, PDF_EXPORT_FONT_SIZE)
+        return w
+
+    page, used, body = 0, 0, None
+
+    def finish_page():
+        c.drawText(body)
+        c.setFont(PDF_EXPORT_FONT, 8)
+        c.drawCentredString(width / 2, margin / 2, f"Page {page}")
+        c.showPage()
+        if on_page:
+            on_page(page)
+
+    for line in _wrap_text_stream(text, measure, max_width):
+        if body is None or used >= lines_per_page:
+            if body is not None:
+                finish_page()
+            page, used = page + 1, 0
+            body = c.beginText(margin, height - margin)
+            body.setFont(PDF_EXPORT_FONT, PDF_EXPORT_FONT_SIZE)
+            body.setLeading(PDF_EXPORT_LEADING)
+        body.textLine(line)
+        used += 1
+    if body is None:
+        # Empty input still produces a valid one-page PDF
+        page = 1
+        body = c.beginText(margin, height - margin)
+    finish_page()
+    c.save()
+    return page
+
+
+def export_text_to_pdf(text, output_path=None, title=None):
+    """Export text (a string or an iterable of string pieces) to a PDF file and return its path."""
+    try:
+        if not output_path:
+            fd, tmp_path = tempfile.mkstemp(prefix="friday_", suffix=".pdf")
+            os.close(fd)
+            output_path = tmp_path
+        write_text_pdf(text, output_path, title=title)
+        speak(f"Saved PDF to {output_path}")
+        return output_path
+    except Exception as e:
+        speak("Failed to export PDF.")
+        print("[PDF Export Error]", e)
+        return None
+
+
+def benchmark_pdf_export(lines: int = 100_000, line_chars: int = 90, output_path: str = None) -> dict:
+    """Export a synthetic transcript of `lines` lines and report pages per second."""
+    words = ("assistant", "document", "summary", "the", "of", "analysis", "query", "response", "and", "a")
+
+    def transcript():
+        for i in range(lines):
+            row, n = [f"[{i}]"], 0
+            while n < line_chars:
+                word = words[(i + n) % len(words)]
+                row.append(word)
+                n += len(word) + 1
+            yield " ".join(row) + "\n"
+
+    path = output_path
+    if not path:
+        fd, path = tempfile.mkstemp(prefix="alias_bench_", suffix=".pdf")
+        os.close(fd)
+    try:
+        start = time.perf_counter()
+        pages = write_text_pdf(transcript(), path)
+        seconds = time.perf_counter() - start
+        size = os.path.getsize(path)
+    finally:
+        if not output_path:
+            os.remove(path)
+    return {
+        "lines": lines,
+        "pages": pages,
+        "seconds": round(seconds, 2),
+        "pages_per_sec": round(pages / seconds, 1) if seconds else None,
+        "bytes": size,
+    }
+
+
+# ==== PROGRESS AND CANCELLATION ====
+# Document jobs report pages, chunks, bytes and an ETA, and can be cancelled:
+# extraction stops at the next page or block, and LLM calls that have not
+# started yet are skipped.
+PROGRESS_STATUS_INTERVAL = float(os.getenv("ALIAS_PROGRESS_INTERVAL", "0.25"))  # seconds between status updates
+
+
+class AnalysisCancelled(Exception):
+    """Raised inside a document job once its CancelToken is cancelled."""
+
+
+class CancelToken:
+    """Thread-safe cancel flag shared between the UI and a running job."""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise AnalysisCancelled("Analysis cancelled.")
+
+
+class AnalysisProgress:
+    """Progress and cancellation channel for one document job.
+
+    on_progress(percent) fires whenever the whole percentage changes.
+    on_status(status) fires on stage changes and otherwise at most every
+    PROGRESS_STATUS_INTERVAL seconds; status is a dict with name, stage,
+    percent, pages, pages_total, chunks, chunks_total, bytes, bytes_total and
+    eta (seconds, or None while unknown).
+    """
+
+    def __init__(self, on_progress=None, on_status=None, cancel=None, name: str = "", read_span=(5, 80)):
+        self.on_progress = on_progress
+        self.on_status = on_status
+        self.cancel = cancel or CancelToken()
+        self.name = name
+        self.read_span = read_span  # percent range covered while the source is being read
+        self.stage = "starting"
+        self.percent = 0
+        self.fraction_read = 0.0
+        self.pages = 0
+        self.pages_total = None
+        self.chunks = 0
+        self.chunks_total = None
+        self.bytes = 0
+        self.bytes_total = None
+        self.started = time.monotonic()
+        self._last_percent = -1
+        self._last_status = 0.0
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raise AnalysisCancelled if the job was cancelled."""
+        self.cancel.raise_if_cancelled()
+
+    def start_file(self, file_path: str):
+        self.name = self.name or os.path.basename(file_path)
+        try:
+            self.bytes_total = os.path.getsize(file_path)
+        except OSError:
+            pass
+        self.update(stage="extracting")
+
+    def read_position(self, fraction: float, pages: int = None, pages_total: int = None):
+        """Record how much of the source has been read (0..1), plus pages for PDFs."""
+        low, high = self.read_span
+        with self._lock:
+            self.fraction_read = max(self.fraction_read, min(1.0, fraction))
+            if self.bytes_total:
+                self.bytes = int(self.bytes_total * self.fraction_read)
+            if pages is not None:
+                self.pages = pages
+            if pages_total is not None:
+                self.pages_total = pages_total
+            self.percent = max(self.percent, int(low + (high - low) * self.fraction_read))
+        self._emit()
+
+    def update(self, stage: str = None, percent: int = None, chunks: int = None, chunks_total: int = None):
+        with self._lock:
+            changed = stage is not None and stage != self.stage
+            if stage is not None:
+                self.stage = stage
+            if percent is not None:
+                self.percent = max(self.percent, min(100, int(percent)))
+            if chunks is not None:
+                self.chunks = chunks
+            if chunks_total is not None:
+                self.chunks_total = chunks_total
+        self._emit(force=changed)
+
+    def eta(self):
+        """Seconds left, extrapolated from elapsed time and percent done."""
+        if self.percent < 2 or self.percent >= 100:
+            return None
+        elapsed = time.monotonic() - self.started
+        return elapsed * (100 - self.percent) / self.percent
+
+    def status(self) -> dict:
+        with self._lock:
+            status = {
+                "name": self.name,
+                "stage": self.stage,
+                "percent": self.percent,
+                "pages": self.pages,
+                "pages_total": self.pages_total,
+                "chunks": self.chunks,
+                "chunks_total": self.chunks_total,
+                "bytes": self.bytes,
+                "bytes_total": self.bytes_total,
+            }
+        status["eta"] = self.eta()
+        return status
+
+    def _emit(self, force: bool = False):
+        percent = self.percent
+        if self.on_progress and percent != self._last_percent:
+            self._last_percent = percent
+            try:
+                self.on_progress(percent)
+            except Exception as e:
+                print("[Progress Callback Error]", e)
+        now = time.monotonic()
+        if self.on_status and (force or percent >= 100 or now - self._last_status >= PROGRESS_STATUS_INTERVAL):
+            self._last_status = now
+            try:
+                self.on_status(self.status())
+            except Exception as e:
+                print("[Progress Callback Error]", e)
+
+
+# ==== DOCUMENT CACHE ====
+# Extracted text and analyses are stored by SHA-256 of the file bytes, so a
+# re-upload of the same document (under any name) returns immediately.
+import mmap
+
+DOC_CACHE_ENABLED = os.getenv("ALIAS_DOC_CACHE", "on").strip().lower() not in ("0", "off", "false", "no")
+DOC_CACHE_MAX_BYTES = int(os.getenv("ALIAS_DOC_CACHE_BYTES", str(200 * 1024 * 1024)))
+_HASH_BLOCK = 4 * 1024 * 1024
+
+
+def file_sha256(file_path: str) -> str:
+    """Streaming SHA-256 of a file using memory-mapped reads (no full copy in memory)."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, _HASH_BLOCK):
+                    digest.update(view[offset:offset + _HASH_BLOCK])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+class DocumentCache:
+    """SQLite store of per-document results keyed on (content hash, kind), LRU-evicted by total size."""
+
+    def __init__(self, db=None, max_bytes=DOC_CACHE_MAX_BYTES):
+        self.db = db or chat_db
+        self.max_bytes = max_bytes
+        self._table_ready = False
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _ensure_table(self):
+        if not self._table_ready:
+            migrate_chat_database(self.db)
+            self._table_ready = True
+
+    def get(self, sha256: str, kind: str):
+        try:
+            self._ensure_table()
+            row = self.db.query_one(
+                'SELECT content FROM document_cache WHERE sha256 = ? AND kind = ?', (sha256, kind)
+            )
+            if row:
+                self.db.execute(
+                    'UPDATE document_cache SET last_access = ? WHERE sha256 = ? AND kind = ?',
+                    (time.time(), sha256, kind),
+                )
+        except Exception as e:
+            print("[Document Cache Read Error]", e)
+            row = None
+        with self._lock:
+            self.stats["hits" if row else "misses"] += 1
+        return row[0] if row else None
+
+    def put(self, sha256: str, kind: str, content: str):
+        if not content:
+            return
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            self._ensure_table()
+            with self.db.write() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO document_cache (sha256, kind, content, size, created_at, last_access)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (sha256, kind, content, size, now, now))
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM document_cache').fetchone()[0]
+                evicted = 0
+                while total > self.max_bytes:
+                    victim = conn.execute(
+                        'SELECT sha256, kind, size FROM document_cache ORDER BY last_access LIMIT 1'
+                    ).fetchone()
+                    if not victim:
+                        break
+                    conn.execute('DELETE FROM document_cache WHERE sha256 = ? AND kind = ?', victim[:2])
+                    total -= victim[2]
+                    evicted += 1
+            with self._lock:
+                self.stats["stores"] += 1
+                self.stats["evictions"] += evicted
+        except Exception as e:
+            print("[Document Cache Write Error]", e)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+document_cache = DocumentCache()
+
+
+def _analysis_cache_kind() -> str:
+    """Cache kind for analyses; changes whenever settings that shape the output change."""
+    return f"analysis:{GEMINI_MODEL}:{DOCUMENT_TOKEN_BUDGET}:{DOCUMENT_CHUNK_TOKENS}:{int(DOCUMENT_MAP_REDUCE)}"
+
+
+PAGE_BREAK = "\n\f\n"
+TEXT_BLOCK_CHARS = int(os.getenv("ALIAS_TEXT_BLOCK_CHARS", str(256 * 1024)))  # TXT streaming unit
+DOC_CACHE_TEXT_MAX_CHARS = int(os.getenv("ALIAS_DOC_CACHE_TEXT_MAX_CHARS", str(8 * 1024 * 1024)))
+
+# Parallel PDF extraction: page ranges are spread over a process pool (the work is
+# CPU-bound and would otherwise hold the GIL and stutter the Qt UI).
+PDF_EXTRACT_WORKERS = int(os.getenv("ALIAS_PDF_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("ALIAS_PDF_PARALLEL_MIN_PAGES", "40"))  # below this, stay serial
+PDF_PAGE_TIMEOUT = float(os.getenv("ALIAS_PDF_PAGE_TIMEOUT", "20"))  # seconds allowed per page
+
+
+def _pdf_page_ranges(page_count: int, workers: int):
+    """Split pages into small ranges so slow pages don't leave other workers idle."""
+    size = max(4, min(25, math.ceil(page_count / (workers * 3))))
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+def _iter_pdf_pages_serial(reader, start: int = 0):
+    for index in range(start, len(reader.pages)):
+        try:
+            yield reader.pages[index].extract_text() or ""
+        except Exception:
+            yield ""
+
+
+def _stop_pool(pool, terminate: bool):
+    """Shut a multiprocessing pool down and join its workers and handler threads.
+
+    terminate=True is for a pool with a stuck worker: Pool.terminate() stops
+    the workers and its handler threads safely, where killing a
+    ProcessPoolExecutor's processes can leave its manager thread blocked and
+    the interpreter unable to exit.
+    """
+    try:
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+    except Exception as e:
+        print("[PDF Parallel Error]", e)
+
+
+def iter_pdf_pages_parallel(file_path: str, page_count: int, workers: int = None):
+    """Yield every page's text in page order, extracting ranges on a process pool.
+
+    At most two ranges per worker are outstanding, so memory stays bounded
+    however long the PDF is. A range that exceeds PDF_PAGE_TIMEOUT per page
+    yields empty pages and its stuck pool is terminated and replaced. If the
+    consumer stops early, the outstanding ranges are left to finish and the
+    pool is joined, so no worker is killed mid-result. If the pool is unusable
+    from the start, extraction falls back to the serial loop.
+    """
+    import multiprocessing
+    from pdf_extract_worker import extract_page_range
+
+    workers = max(1, workers or PDF_EXTRACT_WORKERS)
+    ranges = iter(_pdf_page_ranges(page_count, workers))
+    try:
+        pool = multiprocessing.Pool(processes=workers)
+    except Exception as e:
+        print("[PDF Parallel Error]", e, "- extracting serially")
+        from pypdf import PdfReader
+        yield from _iter_pdf_pages_serial(PdfReader(file_path))
+        return
+    pending = deque()
+    produced = 0
+    restarts = 0
+    stuck = False  # the current pool has a worker that never returned its range
+
+    def submit(page_range):
+        pending.append((page_range, pool.apply_async(extract_page_range, (file_path, *page_range))))
+
+    def fill():
+        while len(pending) < workers * 2:
+            page_range = next(ranges, None)
+            if page_range is None:
+                return
+            submit(page_range)
+
+    try:
+        fill()
+        while pending:
+            (start, end), result = pending.popleft()
+            restart = False
+            try:
+                page_texts = result.get(timeout=PDF_PAGE_TIMEOUT * (end - start))
+            except multiprocessing.TimeoutError:
+                print(f"[PDF Parallel] pages {start + 1}-{end} timed out; skipping them")
+                page_texts, restart = [], True
+            except Exception as e:
+                if produced == 0:
+                    # Workers can't run here at all (e.g. pypdf missing in the child)
+                    print("[PDF Parallel Error]", e, "- extracting serially")
+                    from pypdf import PdfReader
+                    yield from _iter_pdf_pages_serial(PdfReader(file_path))
+                    return
+                print(f"[PDF Parallel] pages {start + 1}-{end} failed: {e}")
+                page_texts = []
+            if restart and restarts >= 3:
+                stuck = True
+            elif restart:
+                # A worker is stuck on a page: terminate the pool and resubmit what was queued
+                restarts += 1
+                queued = [page_range for page_range, _ in pending]
+                pending.clear()
+                _stop_pool(pool, terminate=True)
+                pool = multiprocessing.Pool(processes=workers)
+                for page_range in queued:
+                    submit(page_range)
+            fill()
+            # Keep page positions stable even when a range failed
+            page_texts = list(page_texts) + [""] * (end - start - len(page_texts))
+            for text in page_texts:
+                produced += 1
+                yield text
+    finally:
+        # Let the few outstanding ranges finish rather than kill workers mid-result;
+        # one that overruns its timeout means a stuck worker, so the pool is terminated
+        for (start, end), result in pending:
+            if stuck:
+                break
+            result.wait(PDF_PAGE_TIMEOUT * (end - start))
+            stuck = not result.ready()
+        _stop_pool(pool, terminate=stuck)
+
+
+def extract_pdf_pages_parallel(file_path: str, page_count: int, workers: int = None):
+    """List form of iter_pdf_pages_parallel; returns None if the pool could not be used."""
+    try:
+        return list(iter_pdf_pages_parallel(file_path, page_count, workers))
+    except Exception as e:
+        print("[PDF Parallel Error]", e)
+        return None
+
+
+def _iter_txt_blocks(file_path: str, block_chars: int, on_position=None):
+    """Yield a text file in blocks of about block_chars, cut at line ends where possible."""
+    size = os.path.getsize(file_path) or 1
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        carry = ""
+        while True:
+            block = f.read(block_chars)
+            if not block:
+                break
+            if on_position:
+                on_position(min(1.0, f.buffer.tell() / size))
+            block = carry + block
+            cut = block.rfind("\n") + 1
+            if cut <= 0:
+                carry = ""
+                yield block
+            else:
+                carry = block[cut:]
+                yield block[:cut]
+        if carry:
+            yield carry
+
+
+def _iter_docx_paragraphs(file_path: str, on_position=None):
+    """Stream paragraphs out of word/document.xml without building the whole tree."""
+    import zipfile
+    from xml.etree.ElementTree import iterparse
+
+    w = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+    with zipfile.ZipFile(file_path) as archive:
+        xml_size = archive.getinfo("word/document.xml").file_size or 1
+        with archive.open("word/document.xml") as xml:
+            body = None
+            parts = []
+            for event, elem in iterparse(xml, events=("start", "end")):
+                if event == "start":
+                    if elem.tag == w + "body":
+                        body = elem
+                    continue
+                if elem.tag == w + "t":
+                    parts.append(elem.text or "")
+                elif elem.tag == w + "tab":
+                    parts.append("\t")
+                elif elem.tag in (w + "br", w + "cr"):
+                    parts.append("\n")
+                elif elem.tag == w + "p":
+                    if on_position:
+                        on_position(min(1.0, xml.tell() / xml_size))
+                    yield "".join(parts) + "\n\n"
+                    parts = []
+                    # Drop finished paragraphs so memory stays flat
+                    if body is not None:
+                        body.clear()
+
+
+def iter_text_from_file(file_path, on_position=None, tracker=None):
+    """Yield a TXT, PDF or DOCX document's text lazily, one unit at a time.
+
+    Units are pages (PDF, each followed by PAGE_BREAK), paragraphs (DOCX) or
+    ~TEXT_BLOCK_CHARS blocks (TXT), so memory stays bounded by one unit however
+    large the file is. Concatenating the units gives the full text. Other file
+    types yield nothing. on_position(fraction) reports how much of the source
+    has been consumed. tracker (an AnalysisProgress) receives pages and bytes
+    read, and is checked for cancellation before every unit.
+    """
+    def position(fraction, pages=None, pages_total=None):
+        if on_position:
+            on_position(fraction)
+        if tracker:
+            tracker.read_position(fraction, pages, pages_total)
+
+    if tracker:
+        tracker.start_file(file_path)
+    lower = file_path.lower()
+    if lower.endswith(".txt"):
+        units = _iter_txt_blocks(file_path, TEXT_BLOCK_CHARS, position)
+    elif lower.endswith(".pdf"):
+        units = _iter_pdf_units(file_path, position)
+    elif lower.endswith(".docx"):
+        units = _iter_docx_paragraphs(file_path, position)
+    else:
+        return
+    for unit in units:
+        if tracker:
+            tracker.check()
+        yield unit
+
+
+def _iter_pdf_units(file_path: str, position):
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    page_count = len(reader.pages)
+    if PDF_EXTRACT_WORKERS > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+        pages = iter_pdf_pages_parallel(file_path, page_count)
+    else:
+        pages = _iter_pdf_pages_serial(reader)
+    for number, page_text in enumerate(pages, start=1):
+        position(number / page_count, number, page_count)
+        # Form feed marks page boundaries so chunking can split on them
+        yield page_text + PAGE_BREAK
+
+
+def _iter_document_text(file_path: str, file_hash: str = None, on_position=None, tracker=None):
+    """iter_text_from_file with the content-hash text cache in front of it.
+
+    Text is only buffered for the cache while it stays under
+    DOC_CACHE_TEXT_MAX_CHARS, so huge documents are never held in full.
+    """
+    if file_hash:
+        cached = document_cache.get(file_hash, "text")
+        if cached is not None:
+            if on_position:
+                on_position(1.0)
+            if tracker:
+                tracker.start_file(file_path)
+                tracker.read_position(1.0)
+            yield cached
+            return
+    buffer, size = [], 0
+    for unit in iter_text_from_file(file_path, on_position, tracker):
+        if buffer is not None:
+            size += len(unit)
+            if size <= DOC_CACHE_TEXT_MAX_CHARS:
+                buffer.append(unit)
+            else:
+                buffer = None
+        yield unit
+    if file_hash and buffer:
+        text = "".join(buffer).strip()
+        if text:
+            document_cache.put(file_hash, "text", text)
+
+
+def read_text_from_file(file_path, file_hash: str = None, on_progress=None, on_status=None, cancel=None):
+    """Read text from TXT, PDF, DOCX. Return extracted text or None.
+
+    Results are cached by content hash; pass file_hash if it is already known.
+    PDF pages are joined with a newline, as before streaming extraction;
+    iter_text_from_file marks them with PAGE_BREAK instead. Use
+    iter_text_from_file to process very large documents without loading
+    them whole. on_progress/on_status/cancel work as in analyze_document.
+    """
+    try:
+        if not file_path.lower().endswith((".txt", ".pdf", ".docx")):
+            return None
+        if DOC_CACHE_ENABLED:
+            file_hash = file_hash or file_sha256(file_path)
+        tracker = AnalysisProgress(on_progress, on_status, cancel, read_span=(0, 100))
+        text = "".join(_iter_document_text(file_path, file_hash if DOC_CACHE_ENABLED else None, tracker=tracker))
+        text = text.replace(PAGE_BREAK, "\n").strip()
+        tracker.update(stage="done", percent=100)
+        return text
+    except AnalysisCancelled:
+        print("[Read File] cancelled:", file_path)
+        return None
+    except Exception as e:
+        speak("Failed to read the document.")
+        print("[Read File Error]", e)
+        return None
+
+
+DOCUMENT_MAP_REDUCE = os.getenv("ALIAS_DOCUMENT_MAP_REDUCE", "on").strip().lower() not in ("0", "off", "false", "no")
+DOCUMENT_CHUNK_TOKENS = int(os.getenv("ALIAS_DOCUMENT_CHUNK_TOKENS", "3000"))
+DOCUMENT_MAP_CONCURRENCY = int(os.getenv("ALIAS_DOCUMENT_MAP_CONCURRENCY", str(GEMINI_MAX_IN_FLIGHT)))
+DOCUMENT_ANALYSIS_INSTRUCTION = (
+    "Summarize and analyze the following document. Extract key points, action items, and any entities."
+)
+
+
+def _split_oversized(unit: str, max_tokens: int):
+    """Split a paragraph that alone exceeds max_tokens on line, then word boundaries."""
+    pieces, current = [], ""
+    for line in unit.splitlines(keepends=True):
+        if estimate_tokens(current + line) <= max_tokens:
+            current += line
+            continue
+        if current:
+            pieces.append(current)
+            current = ""
+        while estimate_tokens(line) > max_tokens:
+            head = truncate_to_tokens(line, max_tokens)
+            if not head:
+                head = line[:max_tokens * CHARS_PER_TOKEN]
+            pieces.append(head)
+            line = line[len(head):].lstrip()
+        current = line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def iter_text_chunks(units, max_tokens: int = DOCUMENT_CHUNK_TOKENS):
+    """Lazily pack text units into chunks of at most ~max_tokens.
+
+    Chunks end at page or paragraph boundaries where possible. Only the text
+    after the last boundary seen so far is held back, so memory stays around
+    one chunk plus one unit.
+    """
+    current = ""
+
+    def pack(segment):
+        nonlocal current
+        ready = []
+        for page in segment.split("\f"):
+            for unit in re.split(r"\n\s*\n", page):
+                unit = unit.strip()
+                if not unit:
+                    continue
+                sep = "\n\n" if current else ""
+                if estimate_tokens(current + sep + unit) <= max_tokens:
+                    current += sep + unit
+                    continue
+                if current:
+                    ready.append(current)
+                    current = ""
+                if estimate_tokens(unit) <= max_tokens:
+                    current = unit
+                else:
+                    parts = _split_oversized(unit, max_tokens)
+                    ready.extend(parts[:-1])
+                    current = parts[-1] if parts else ""
+        return ready
+
+    pending = ""
+    for unit in units:
+        pending += unit
+        cut = max(pending.rfind("\f"), pending.rfind("\n\n"))
+        if cut < 0:
+            if estimate_tokens(pending) < max_tokens:
+                continue
+            # No boundary in sight; cut here rather than buffering without limit
+            cut = len(pending)
+        segment, pending = pending[:cut], pending[cut:]
+        yield from pack(segment)
+    yield from pack(pending)
+    if current:
+        yield current
+
+
+def split_text_chunks(text: str, max_tokens: int = DOCUMENT_CHUNK_TOKENS):
+    """Split text into chunks of at most ~max_tokens, preferring page then paragraph boundaries."""
+    return list(iter_text_chunks([text], max_tokens))
+
+
+def benchmark_document_streaming(megabytes: float = 64, kind: str = "txt", pdf_lines: int = 50_000,
+                                 file_path: str = None) -> dict:
+    """Stream a large document through iter_text_from_file and iter_text_chunks and report peak memory.
+
+    Without file_path, a synthetic TXT of about `megabytes` MB (kind="txt") or
+    a PDF of `pdf_lines` lines (kind="pdf", via write_text_pdf) is generated in
+    a temporary file. peak_traced_bytes is the tracemalloc peak while reading
+    and chunking; peak_rss_bytes is the process high-water mark where the
+    resource module exists (it includes everything loaded before the run).
+    Pages extracted by the process pool are not traced.
+    """
+    import sys
+    import tracemalloc
+    try:
+        import resource
+    except ImportError:  # Windows
+        resource = None
+
+    path = file_path
+    if not path:
+        fd, path = tempfile.mkstemp(prefix="alias_bench_", suffix="." + kind)
+        os.close(fd)
+        paragraph = ("The assistant read the document and wrote a summary of the analysis. " * 12).strip() + "\n\n"
+        if kind == "pdf":
+            write_text_pdf((paragraph[:90] + "\n" for _ in range(pdf_lines)), path)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                for _ in range(int(megabytes * 1024 * 1024 / len(paragraph)) + 1):
+                    f.write(paragraph)
+    try:
+        size = os.path.getsize(path)
+        chunks = chars = 0
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            for chunk in iter_text_chunks(iter_text_from_file(path)):
+                chunks += 1
+                chars += len(chunk)
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        if not file_path:
+            os.remove(path)
+    rss = None
+    if resource is not None:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {
+        "kind": kind,
+        "bytes": size,
+        "chunks": chunks,
+        "chars": chars,
+        "seconds": round(seconds, 2),
+        "mb_per_sec": round(size / 1048576 / seconds, 1) if seconds else None,
+        "peak_traced_bytes": peak,
+        "peak_rss_bytes": rss,
+    }
+
+
+def _reduce_summaries(summaries, budget: int, on_round=None, cancel=None):
+    """Hierarchically merge partial summaries until they fit one prompt."""
+    level = 0
+    while estimate_tokens("\n\n".join(summaries)) > budget and len(summaries) > 1:
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+        level += 1
+        groups, current = [], []
+        for summary in summaries:
+            if current and estimate_tokens("\n\n".join(current + [summary])) > budget:
+                groups.append(current)
+                current = []
+            current.append(summary)
+        if current:
+            groups.append(current)
+        if len(groups) == len(summaries):
+            # Every summary is already near the budget on its own; pair them up to make progress
+            groups = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+        prompts = [
+            build_prompt(
+                "\n\n".join(group),
+                system="Merge these partial summaries of consecutive sections of one document into a single "
+                       "summary. Keep all key points, action items, and entities; remove duplicates.",
+                budget=budget + DOCUMENT_CHUNK_TOKENS,
+            )
+            for group in groups
+        ]
+        results = gemini_batch(prompts, max_concurrency=DOCUMENT_MAP_CONCURRENCY, feature="document", cancel=cancel)
+        summaries = [
+            r["text"] if r["ok"] and r["text"] else "\n\n".join(group)
+            for r, group in zip(results, groups)
+        ]
+        if on_round:
+            on_round(level, len(summaries))
+    return summaries
+
+
+def analyze_document_chunked(text: str, on_progress=None):
+    """Map-reduce analysis: summarize chunks in parallel, then reduce into one analysis."""
+    tracker = AnalysisProgress(on_progress)
+    tracker.read_position(1.0)
+    return _map_reduce_analysis([text], tracker)[0]
+
+
+def _is_gemini_fallback(text: str) -> bool:
+    """True if text is one of gemini_chat's failure messages rather than a real reply."""
+    return not text or text.startswith(("Service is temporarily unavailable.", "Gemini API key is not configured."))
+
+
+def _map_reduce_analysis(units, tracker):
+    """Run the map-reduce analysis over an iterable of text units.
+
+    Chunks are pulled lazily and summarized in windows of a few batches, so
+    only the partial summaries accumulate in memory. tracker (an
+    AnalysisProgress) is fed the chunk counts and checked for cancellation
+    between windows. Returns (summary, complete) where complete means every
+    step succeeded.
+    """
+    tracker.update(stage="summarizing")
+    chunks = iter_text_chunks(units, DOCUMENT_CHUNK_TOKENS)
+    window = max(1, DOCUMENT_MAP_CONCURRENCY) * 2
+    partials = []
+    failed = total = 0
+    while True:
+        tracker.check()
+        batch = list(itertools.islice(chunks, window))
+        if not batch:
+            break
+        map_prompts = [
+            build_prompt(
+                chunk,
+                system=f"This is part {total + i + 1} of a longer document. Summarize this part: "
+                       f"key points, action items, and any entities mentioned.",
+                budget=DOCUMENT_CHUNK_TOKENS + 200,
+            )
+            for i, chunk in enumerate(batch)
+        ]
+        results = gemini_batch(map_prompts, max_concurrency=DOCUMENT_MAP_CONCURRENCY, feature="document",
+                               cancel=tracker.cancel)
+        tracker.check()
+        for r in results:
+            total += 1
+            if r["ok"] and r["text"]:
+                partials.append(f"Part {total}:\n{r['text'].strip()}")
+            else:
+                failed += 1
+                print(f"[Analyze Document] part {total} failed: {r['error']}")
+        # Project the chunk total from how much of the source these chunks came from
+        read = tracker.fraction_read
+        tracker.update(chunks=total, chunks_total=max(total, round(total / read)) if read > 0 else None)
+    tracker.update(chunks_total=total)
+    if not partials:
+        return "Failed to analyze document.", False
+
+    tracker.update(stage="combining", percent=80)
+    reduce_budget = DOCUMENT_TOKEN_BUDGET // 2
+    partials = _reduce_summaries(
+        partials, reduce_budget,
+        on_round=lambda level, n: tracker.update(percent=min(95, 80 + 5 * level)),
+        cancel=tracker.cancel,
+    )
+    tracker.update(percent=95)
+    note = f"\n\n(Note: {failed} of {total} sections could not be analyzed.)" if failed else ""
+    prompt = build_prompt(
+        "\n\n".join(partials),
+        system=DOCUMENT_ANALYSIS_INSTRUCTION + " The document was split into sections; "
+               "below are summaries of each section in order.",
+        budget=DOCUMENT_TOKEN_BUDGET,
+        query_keep="middle",
+    )
+    tracker.check()
+    summary = gemini_chat(prompt, feature="document")
+    complete = not failed and not _is_gemini_fallback(summary)
+    return (summary or "No analysis produced.") + note, complete
+
+
+def analyze_document(file_path, on_progress=None, on_status=None, cancel=None):
+    """Extract text and run Gemini summary/analysis. Return summary string.
+
+    Text is read lazily (see iter_text_from_file). Documents larger than
+    DOCUMENT_TOKEN_BUDGET are analyzed with map-reduce while they are being
+    read. on_progress(percent) and on_status(status) report progress (see
+    AnalysisProgress); cancelling the cancel token stops extraction and any
+    LLM calls not yet sent. Complete analyses are cached by file content hash,
+    and the text is indexed for search_documents().
+    """
+    return _analyze_document(file_path, on_progress, on_status, cancel)[0]
+
+
+def _analyze_document(file_path, on_progress=None, on_status=None, cancel=None):
+    """analyze_document returning (summary, status); status is "ok", "failed" or "cancelled"."""
+    tracker = AnalysisProgress(on_progress, on_status, cancel, name=os.path.basename(file_path))
+    units = None
+    try:
+        index = DOCUMENT_INDEX_ENABLED and document_index.available
+        file_hash = file_sha256(file_path) if DOC_CACHE_ENABLED or index else None
+        text_hash = file_hash if DOC_CACHE_ENABLED else None
+        indexed = index and document_index.is_indexed(file_hash)
+        if text_hash:
+            cached = document_cache.get(file_hash, _analysis_cache_kind())
+            if cached is not None:
+                if index and not indexed:
+                    # Analyzed before indexing was enabled; the text usually comes from cache
+                    for _ in document_index.index_while_reading(
+                        file_hash, file_path, _iter_document_text(file_path, text_hash, tracker=tracker)
+                    ):
+                        pass
+                tracker.update(stage="done", percent=100)
+                return cached, "ok"
+        units = _iter_document_text(file_path, text_hash, tracker=tracker)
+        if index and not indexed:
+            units = document_index.index_while_reading(file_hash, file_path, units)
+        # Read up to one prompt's worth; only documents bigger than that are map-reduced
+        head, head_chars = [], 0
+        limit_chars = DOCUMENT_TOKEN_BUDGET * CHARS_PER_TOKEN
+        exhausted = True
+        for unit in units:
+            head.append(unit)
+            head_chars += len(unit)
+            if head_chars > limit_chars:
+                exhausted = False
+                break
+        if not "".join(head).strip():
+            return "Could not extract text from document.", "failed"
+        if DOCUMENT_MAP_REDUCE and not exhausted:
+            summary, complete = _map_reduce_analysis(itertools.chain(head, units), tracker)
+        else:
+            if index and not indexed and not exhausted:
+                # Only the head is analyzed, but the whole document should be searchable
+                for _ in units:
+                    pass
+            units.close()
+            prompt = build_prompt(
+                "".join(head).strip().replace("\f", ""),
+                system=DOCUMENT_ANALYSIS_INSTRUCTION,
+                budget=DOCUMENT_TOKEN_BUDGET,
+                query_keep="middle" if exhausted else "head",
+            )
+            tracker.update(stage="summarizing", percent=80, chunks=0, chunks_total=1)
+            tracker.check()
+            summary = gemini_chat(prompt, feature="document")
+            tracker.check()
+            tracker.update(chunks=1)
+            complete = exhausted and not _is_gemini_fallback(summary)
+            summary = summary or "No analysis produced."
+        if text_hash and complete:
+            document_cache.put(file_hash, _analysis_cache_kind(), summary)
+        tracker.update(stage="done", percent=100)
+        return summary, "failed" if _is_gemini_fallback(summary) else "ok"
+    except AnalysisCancelled:
+        tracker.update(stage="cancelled")
+        return "Analysis cancelled.", "cancelled"
+    except Exception as e:
+        print("[Analyze Document Error]", e)
+        return "Failed to analyze document.", "failed"
+    finally:
+        if units is not None:
+            # Stops a parallel PDF pool and drops a partial index straight away
+            units.close()
+
+
+# ==== DOCUMENT INDEX ====
+# Extracted document text is chunked into an FTS5 table so follow-up questions
+# can be answered from the best-matching passages (BM25) instead of the whole file.
+DOCUMENT_INDEX_ENABLED = os.getenv("ALIAS_DOCUMENT_INDEX", "on").strip().lower() not in ("0", "off", "false", "no")
+DOCUMENT_INDEX_CHUNK_TOKENS = int(os.getenv("ALIAS_DOCUMENT_INDEX_CHUNK_TOKENS", "300"))
+DOCUMENT_RETRIEVAL_K = int(os.getenv("ALIAS_DOCUMENT_RETRIEVAL_K", "4"))
+# Share of the question's search terms a passage must contain to be added to the prompt
+DOCUMENT_RETRIEVAL_MIN_MATCH = float(os.getenv("ALIAS_DOCUMENT_RETRIEVAL_MIN_MATCH", "0.5"))
+_INDEX_INSERT_BATCH = 64
+_SEARCH_STOPWORDS = frozenset(
+    "a an and are as at be by can could did do does for from had has have how i in is it its "
+    "me my of on or our please say so tell than that the their them then there these they this "
+    "to was we were what when where which who why will with would you your about "
+    "hi hello hey thanks thank ok okay yes no bye good morning evening night".split()
+)
+
+
+class DocumentIndex:
+    """FTS5 index of document chunks; a document is searchable once fully indexed."""
+
+    def __init__(self, db=None):
+        self.db = db or chat_db
+        self.available = True
+        self._table_ready = False
+        self._lock = threading.Lock()
+        self.stats = {"documents": 0, "chunks": 0, "searches": 0, "hits": 0}
+
+    def _ensure_table(self):
+        if self._table_ready:
+            return
+        migrate_chat_database(self.db)
+        if self.db.query_one(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'document_chunks'"
+        ) is None:
+            # The migration skips the FTS5 table when SQLite lacks FTS5
+            self.available = False
+            raise sqlite3.OperationalError("document_chunks unavailable (no FTS5)")
+        self._table_ready = True
+
+    def is_indexed(self, doc_id: str) -> bool:
+        if not self.available:
+            return False
+        try:
+            self._ensure_table()
+            row = self.db.query_one('SELECT complete FROM document_index WHERE doc_id = ?', (doc_id,))
+            return bool(row and row[0])
+        except Exception as e:
+            print("[Document Index Error]", e)
+            return False
+
+    def index_while_reading(self, doc_id: str, file_path: str, units):
+        """Yield units unchanged while indexing them chunk by chunk.
+
+        Rows are committed in small batches so the chat database is never
+        locked for the length of an analysis. If the consumer stops early the
+        partial index is removed.
+        """
+        if not self.available:
+            yield from units
+            return
+        try:
+            self._ensure_table()
+            with self.db.write() as conn:
+                conn.execute('DELETE FROM document_chunks WHERE doc_id = ?', (doc_id,))
+                conn.execute('''
+                    INSERT OR REPLACE INTO document_index (doc_id, path, name, chunks, complete, indexed_at)
+                    VALUES (?, ?, ?, 0, 0, ?)
+                ''', (doc_id, file_path, os.path.basename(file_path), time.time()))
+        except Exception as e:
+            # e.g. SQLite built without FTS5; analysis still works, just without retrieval
+            print("[Document Index Error]", e)
+            self.available = False
+            yield from units
+            return
+
+        pending, rows, count = [], [], 0
+
+        def flush(chunks):
+            nonlocal count
+            for chunk in chunks:
+                rows.append((chunk, doc_id, count))
+                count += 1
+            if len(rows) >= _INDEX_INSERT_BATCH:
+                write_rows()
+
+        def write_rows():
+            if rows:
+                with self.db.write() as conn:
+                    conn.executemany('INSERT INTO document_chunks (content, doc_id, chunk_no) VALUES (?, ?, ?)', rows)
+                rows.clear()
+
+        finished = False
+        try:
+            for unit in units:
+                yield unit
+                pending.append(unit)
+                # Pack once a few chunks' worth is pending; hold the tail back since it may continue
+                if sum(len(p) for p in pending) >= 4 * DOCUMENT_INDEX_CHUNK_TOKENS * CHARS_PER_TOKEN:
+                    chunks = list(iter_text_chunks(pending, DOCUMENT_INDEX_CHUNK_TOKENS))
+                    flush(chunks[:-1])
+                    pending = chunks[-1:]
+            flush(iter_text_chunks(pending, DOCUMENT_INDEX_CHUNK_TOKENS))
+            write_rows()
+            self.db.execute(
+                'UPDATE document_index SET chunks = ?, complete = 1, indexed_at = ? WHERE doc_id = ?',
+                (count, time.time(), doc_id),
+            )
+            finished = True
+            with self._lock:
+                self.stats["documents"] += 1
+                self.stats["chunks"] += count
+        finally:
+            if not finished:
+                try:
+                    with self.db.write() as conn:
+                        conn.execute('DELETE FROM document_chunks WHERE doc_id = ?', (doc_id,))
+                        conn.execute('DELETE FROM document_index WHERE doc_id = ?', (doc_id,))
+                except Exception:
+                    pass
+
+    def search(self, query: str, k: int = DOCUMENT_RETRIEVAL_K, min_match: float = None):
+        """Top-k chunks for query ranked by BM25, as dicts with name, chunk_no, content, score and matched.
+
+        matched is the share of the query's search terms found in the chunk;
+        chunks below min_match (default DOCUMENT_RETRIEVAL_MIN_MATCH) are
+        dropped, so a single shared word doesn't pull in unrelated passages.
+        """
+        if not self.available or not query:
+            return []
+        terms = [t for t in re.findall(r"\w+", query.lower()) if len(t) > 1 and t not in _SEARCH_STOPWORDS]
+        terms = list(dict.fromkeys(terms))
+        if not terms:
+            return []
+        min_match = DOCUMENT_RETRIEVAL_MIN_MATCH if min_match is None else min_match
+        try:
+            self._ensure_table()
+            rows = self.db.query('''
+                SELECT c.rowid, d.name, c.chunk_no, c.content, bm25(document_chunks) AS score
+                FROM document_chunks c
+                JOIN document_index d ON d.doc_id = c.doc_id
+                WHERE document_chunks MATCH ? AND d.complete = 1
+                ORDER BY score
+                LIMIT ?
+            ''', (" OR ".join(f'"{t}"' for t in terms), k * 3))
+            # Count terms per candidate with FTS itself, so stemming matches the index
+            matched = dict.fromkeys((row[0] for row in rows), 0)
+            if len(terms) > 1 and matched:
+                marks = ",".join("?" * len(matched))
+                for term in terms:
+                    for (rowid,) in self.db.query(
+                        f'SELECT rowid FROM document_chunks WHERE document_chunks MATCH ? AND rowid IN ({marks})',
+                        [f'"{term}"'] + list(matched),
+                    ):
+                        matched[rowid] += 1
+        except Exception as e:
+            print("[Document Search Error]", e)
+            rows, matched = [], {}
+        hits = []
+        for rowid, name, chunk_no, content, score in rows:
+            share = matched[rowid] / len(terms) if len(terms) > 1 else 1.0
+            if share >= min_match and len(hits) < k:
+                hits.append({"name": name, "chunk_no": chunk_no, "content": content, "score": score,
+                             "matched": share})
+        with self._lock:
+            self.stats["searches"] += 1
+            self.stats["hits"] += 1 if hits else 0
+        return hits
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+document_index = DocumentIndex()
+
+
+def search_documents(query: str, k: int = None):
+    """Retrieve the passages of indexed documents most relevant to query, formatted for build_prompt(memory=...)."""
+    if not DOCUMENT_INDEX_ENABLED:
+        return []
+    return [
+        f"From {hit['name']} (part {hit['chunk_no'] + 1}):\n{hit['content']}"
+        for hit in document_index.search(query, k or DOCUMENT_RETRIEVAL_K)
+    ]
+
+
+# ==== BATCH DOCUMENT ANALYSIS ====
+# Folders or lists of files are analyzed on a bounded worker pool fed from a
+# priority queue (smallest files first by default, so early results arrive
+# quickly), then combined into one digest.
+DOCUMENT_BATCH_WORKERS = int(os.getenv("ALIAS_DOCUMENT_BATCH_WORKERS", "2"))
+SUPPORTED_DOCUMENT_EXTENSIONS = (".txt", ".pdf", ".docx")
+
+
+def collect_document_paths(paths_or_dir, recursive: bool = True):
+    """Expand a directory (or a list mixing files and directories) into supported document paths."""
+    if isinstance(paths_or_dir, str):
+        paths_or_dir = [paths_or_dir]
+    found = []
+    for path in paths_or_dir:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(SUPPORTED_DOCUMENT_EXTENSIONS):
+                        found.append(os.path.join(root, name))
+                if not recursive:
+                    break
+        elif os.path.isfile(path) and path.lower().endswith(SUPPORTED_DOCUMENT_EXTENSIONS):
+            found.append(path)
+    # Drop duplicates but keep first-seen order
+    return list(dict.fromkeys(found))
+
+
+def analyze_documents_batch(paths_or_dir, max_workers: int = None, priority=None,
+                            on_progress=None, on_file_progress=None, on_file_done=None,
+                            on_file_status=None, cancel=None):
+    """Analyze many documents concurrently and build a combined digest.
+
+    priority(path) -> sortable value decides processing order (default: file
+    size, smallest first). Callbacks: on_progress(percent) for the whole batch,
+    on_file_progress(path, percent), on_file_status(path, status) and
+    on_file_done(path, summary) per file. Cancelling cancel (a CancelToken)
+    stops running files and leaves queued ones unprocessed. Returns
+    {"digest": str, "files": [{"path", "summary", "status", "ok"}, ...]} with
+    one entry per file in the order they were given; status is "ok", "failed"
+    or "cancelled" (files never started after a cancel are "cancelled" too).
+    """
+    paths = collect_document_paths(paths_or_dir)
+    if not paths:
+        return {"digest": "No supported documents (TXT, PDF, DOCX) found.", "files": []}
+
+    def default_priority(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    rank = priority or default_priority
+    work = queue.PriorityQueue()
+    for seq, path in enumerate(paths):
+        work.put((rank(path), seq, path))
+
+    results = [None] * len(paths)
+    file_percent = [0] * len(paths)
+    lock = threading.Lock()
+
+    def report():
+        if on_progress:
+            with lock:
+                percent = sum(file_percent) // len(paths)
+            try:
+                on_progress(int(percent))
+            except Exception as e:
+                print("[Progress Callback Error]", e)
+
+    def worker():
+        while True:
+            if cancel is not None and cancel.cancelled:
+                return
+            try:
+                _, seq, path = work.get_nowait()
+            except queue.Empty:
+                return
+
+            def file_progress(percent, seq=seq, path=path):
+                with lock:
+                    file_percent[seq] = max(file_percent[seq], min(100, int(percent)))
+                if on_file_progress:
+                    try:
+                        on_file_progress(path, int(percent))
+                    except Exception as e:
+                        print("[Progress Callback Error]", e)
+                report()
+
+            file_status = (lambda status, path=path: on_file_status(path, status)) if on_file_status else None
+            summary, status = _analyze_document(path, on_progress=file_progress, on_status=file_status,
+                                                cancel=cancel)
+            results[seq] = {"path": path, "summary": summary, "status": status, "ok": status == "ok"}
+            file_progress(100)
+            if on_file_done:
+                try:
+                    on_file_done(path, summary)
+                except Exception as e:
+                    print("[File Done Callback Error]", e)
+
+    workers = [
+        threading.Thread(target=worker, name=f"doc-batch-{i}", daemon=True)
+        for i in range(max(1, min(max_workers or DOCUMENT_BATCH_WORKERS, len(paths))))
+    ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    for seq, path in enumerate(paths):
+        if results[seq] is None:
+            results[seq] = {"path": path, "summary": "Analysis cancelled.", "status": "cancelled", "ok": False}
+    done = [r for r in results if r["ok"]]
+    summaries = [f"{os.path.basename(r['path'])}:\n{r['summary']}" for r in done]
+    if cancel is not None and cancel.cancelled:
+        digest = f"Analysis cancelled after {len(done)} of {len(paths)} documents."
+    elif not summaries:
+        digest = "None of the documents could be analyzed."
+    elif len(summaries) == 1:
+        digest = done[0]["summary"]
+    else:
+        try:
+            summaries = _reduce_summaries(summaries, DOCUMENT_TOKEN_BUDGET // 2, cancel=cancel)
+            digest = gemini_chat(
+                build_prompt(
+                    "\n\n".join(summaries),
+                    system="Below are analyses of several related documents. Write a combined digest: "
+                           "common themes, key differences between documents, and all action items.",
+                    budget=DOCUMENT_TOKEN_BUDGET,
+                ),
+                feature="document",
+            )
+        except AnalysisCancelled:
+            digest = f"Analysis cancelled after {len(done)} of {len(paths)} documents."
+    return {"digest": digest, "files": results}
 
 
 # ==== CAMERA HELPERS ====
@@ -265,7 +2801,7 @@ def identify_product_from_image(image_path):
             ],
             "generationConfig": {"temperature": 0.2, "maxOutputTokens": 256}
         }
-        resp = requests.post(url, headers=headers, json=data, timeout=20)
+        resp = http_post(url, headers=headers, json=data, timeout=20)
         resp.raise_for_status()
         result = resp.json()
         text = result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
@@ -470,7 +3006,7 @@ def solve_math(command):
         except Exception:
             # Fallback: Use OpenAI to solve if sympy fails
             speak("Let me try to solve it using AI.")
-            answer = gemini_chat(f"Solve this math problem: {command}")
+            answer = gemini_chat(build_prompt(command, system="Solve this math problem:"), feature="math")
             answer = answer.strip() if answer else ""
             speak(f"AI says: {answer}")
     except Exception as e:
@@ -516,14 +3052,14 @@ def generate_code(command):
                 language = lang
                 break
 
-        prompt = (
+        prompt = build_prompt(
             f"Write {language} code to {target}. "
             f"Respond with ONLY a single fenced code block labeled {language}. "
             f"No explanations. No prose. No comments."
         )
 
         speak("Generating code, please wait.")
-        response = gemini_chat(prompt) or ""
+        response = gemini_chat(prompt, feature="code") or ""
         response = response.strip()
 
         import re
@@ -542,8 +3078,10 @@ def generate_code(command):
 
 def summarize_text_bullets(text, bullets=5):
     try:
-        prompt = f"Summarize the following news items into {bullets} concise bullet points:\n\n{text[:12000]}"
-        return gemini_chat(prompt) or text
+        prompt = build_prompt(
+            text, system=f"Summarize the following news items into {bullets} concise bullet points:"
+        )
+        return gemini_chat(prompt, feature="news") or text
     except Exception:
         return text
 
@@ -554,7 +3092,7 @@ def fetch_news_newsapi(category: str = "general", country: str = None, page_size
     try:
         country = country or USER_COUNTRY
         url = f"https://newsapi.org/v2/top-headlines?country={country}&category={category}&pageSize={page_size}&apiKey={NEWSAPI_KEY}"
-        r = requests.get(url, timeout=15)
+        r = http_get(url, timeout=15)
         r.raise_for_status()
         data = r.json()
         articles = data.get("articles", [])
@@ -622,193 +3160,1230 @@ def handle_email_command(command: str) -> str:
         return "Failed to process email command."
 
 # ==== SQLITE DATABASE FOR CHAT HISTORY ====
-import sqlite3
-import json
 from datetime import datetime
 
-# SQLite database for chat history and memory
-DB_PATH = "alias_chat_history.db"
+# Tables live in DB_PATH and are accessed through chat_db (see SQLITE CONNECTION MANAGER)
 
-def init_chat_database():
-    """Initialize SQLite database for chat history and memory."""
+def _query_hash(query: str) -> str:
+    """Hash of a query with case, surrounding punctuation and extra whitespace removed."""
+    normalized = re.sub(r"\s+", " ", (query or "").lower()).strip(" ?!.")
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+# Schema migrations, applied in order; PRAGMA user_version records the last one run.
+def _migration_base_tables(conn):
+    # Chat history table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            user_message TEXT NOT NULL,
+            assistant_response TEXT NOT NULL,
+            command_type TEXT,
+            session_id TEXT
+        )
+    ''')
+    
+    # Query memory table for learning patterns
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS query_memory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            query TEXT NOT NULL,
+            response TEXT NOT NULL,
+            frequency INTEGER DEFAULT 1,
+            last_used DATETIME DEFAULT CURRENT_TIMESTAMP,
+            success_rate REAL DEFAULT 1.0
+        )
+    ''')
+    
+    # User preferences table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migration_history_index(conn):
+    # get_recent_chat_history: WHERE session_id = ? ORDER BY timestamp DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_session_time ON chat_history(session_id, timestamp)')
+
+
+def _migration_query_hash(conn):
+    conn.execute('ALTER TABLE query_memory ADD COLUMN query_hash TEXT')
+    conn.create_function("alias_query_hash", 1, _query_hash, deterministic=True)
+    conn.execute('UPDATE query_memory SET query_hash = alias_query_hash(query)')
+    # Rows that normalize to the same query are merged into the newest one
+    duplicates = conn.execute('''
+        SELECT query_hash, MAX(id), SUM(frequency), SUM(success_rate * frequency)
+        FROM query_memory GROUP BY query_hash HAVING COUNT(*) > 1
+    ''').fetchall()
+    for query_hash, keep_id, frequency, weighted in duplicates:
+        conn.execute(
+            'UPDATE query_memory SET frequency = ?, success_rate = ? WHERE id = ?',
+            (frequency, weighted / frequency if frequency else 1.0, keep_id),
+        )
+        conn.execute('DELETE FROM query_memory WHERE query_hash = ? AND id != ?', (query_hash, keep_id))
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_query_memory_hash ON query_memory(query_hash)')
+
+
+def _migration_cache_tables(conn):
+    # Previously created lazily by LLMResponseCache and DocumentCache
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            feature TEXT,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            size INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS document_cache (
+            sha256 TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            content TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            PRIMARY KEY (sha256, kind)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_document_cache_last_access ON document_cache(last_access)')
+
+
+def _migration_query_index(conn):
+    # Word index over query_memory.query for get_similar_queries, kept in sync by triggers.
+    # The tokenizer matches _query_terms() so IDF from the vocab table lines up with Python-side terms.
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Chat history table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                user_message TEXT NOT NULL,
-                assistant_response TEXT NOT NULL,
-                command_type TEXT,
-                session_id TEXT
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS query_memory_fts USING fts5(
+                query, content = 'query_memory', content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 0'
             )
         ''')
-        
-        # Query memory table for learning patterns
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS query_memory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                query TEXT NOT NULL,
-                response TEXT NOT NULL,
-                frequency INTEGER DEFAULT 1,
-                last_used DATETIME DEFAULT CURRENT_TIMESTAMP,
-                success_rate REAL DEFAULT 1.0
-            )
+    except sqlite3.OperationalError as e:
+        # SQLite without FTS5: get_similar_queries falls back to a LIKE scan
+        print("[DB] Query index unavailable:", e)
+        return
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS query_memory_vocab USING fts5vocab(query_memory_fts, 'row')")
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS query_memory_fts_insert AFTER INSERT ON query_memory BEGIN
+            INSERT INTO query_memory_fts (rowid, query) VALUES (new.id, new.query);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS query_memory_fts_delete AFTER DELETE ON query_memory BEGIN
+            INSERT INTO query_memory_fts (query_memory_fts, rowid, query) VALUES ('delete', old.id, old.query);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS query_memory_fts_update AFTER UPDATE OF query ON query_memory BEGIN
+            INSERT INTO query_memory_fts (query_memory_fts, rowid, query) VALUES ('delete', old.id, old.query);
+            INSERT INTO query_memory_fts (rowid, query) VALUES (new.id, new.query);
+        END
+    ''')
+    conn.execute("INSERT INTO query_memory_fts (query_memory_fts) VALUES ('rebuild')")
+
+
+def _migration_archive_tables(conn):
+    # Rows removed by the retention policy, zlib-compressed in segments (see compact_chat_database)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_archive_segments_source ON archive_segments(source, first_id)')
+
+
+# Upper bounds (ms) of the latency histogram buckets; -1 collects everything slower
+LATENCY_BUCKETS_MS = (50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 60000)
+
+
+def _migration_stats_counters(conn):
+    # get_chat_statistics reads these instead of scanning chat_history; triggers keep them exact
+    conn.execute('ALTER TABLE chat_history ADD COLUMN latency_ms REAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_stats (
+            command_type TEXT PRIMARY KEY,
+            messages INTEGER NOT NULL DEFAULT 0,
+            latency_count INTEGER NOT NULL DEFAULT 0,
+            latency_total_ms REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_activity_hourly (
+            hour TEXT PRIMARY KEY,
+            messages INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_latency_histogram (
+            command_type TEXT NOT NULL,
+            bucket_ms INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (command_type, bucket_ms)
+        )
+    ''')
+    bucket = "CASE " + " ".join(f"WHEN {{v}} <= {b} THEN {b}" for b in LATENCY_BUCKETS_MS) + " ELSE -1 END"
+    for event, row, sign in (("INSERT", "NEW", "+"), ("DELETE", "OLD", "-")):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS chat_history_stats_{event.lower()} AFTER {event} ON chat_history BEGIN
+                INSERT INTO chat_stats (command_type, messages, latency_count, latency_total_ms)
+                VALUES (COALESCE({row}.command_type, ''), {sign}1,
+                        {sign}({row}.latency_ms IS NOT NULL), {sign}COALESCE({row}.latency_ms, 0))
+                ON CONFLICT(command_type) DO UPDATE SET
+                    messages = messages + excluded.messages,
+                    latency_count = latency_count + excluded.latency_count,
+                    latency_total_ms = latency_total_ms + excluded.latency_total_ms;
+                INSERT INTO chat_activity_hourly (hour, messages)
+                VALUES (strftime('%Y-%m-%d %H:00', {row}.timestamp), {sign}1)
+                ON CONFLICT(hour) DO UPDATE SET messages = messages + excluded.messages;
+                INSERT INTO chat_latency_histogram (command_type, bucket_ms, count)
+                SELECT COALESCE({row}.command_type, ''), {bucket.format(v=f"{row}.latency_ms")}, {sign}1
+                WHERE {row}.latency_ms IS NOT NULL
+                ON CONFLICT(command_type, bucket_ms) DO UPDATE SET count = count + excluded.count;
+            END
         ''')
-        
-        # User preferences table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_preferences (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    # Seed the counters from existing rows (none of which have a latency yet)
+    conn.execute('''
+        INSERT INTO chat_stats (command_type, messages)
+        SELECT COALESCE(command_type, ''), COUNT(*) FROM chat_history GROUP BY 1
+    ''')
+    conn.execute('''
+        INSERT INTO chat_activity_hourly (hour, messages)
+        SELECT strftime('%Y-%m-%d %H:00', timestamp), COUNT(*) FROM chat_history GROUP BY 1
+    ''')
+
+
+def _migration_document_index(conn):
+    # Tables for DocumentIndex (search_documents); previously created lazily by the index
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS document_index (
+            doc_id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            name TEXT NOT NULL,
+            chunks INTEGER NOT NULL DEFAULT 0,
+            complete INTEGER NOT NULL DEFAULT 0,
+            indexed_at REAL NOT NULL
+        )
+    ''')
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS document_chunks USING fts5(
+                content, doc_id UNINDEXED, chunk_no UNINDEXED, tokenize = 'porter unicode61'
             )
         ''')
-        
-        conn.commit()
-        conn.close()
+    except sqlite3.OperationalError as e:
+        # SQLite without FTS5: documents are still analyzed, just not indexed for retrieval
+        print("[DB] Document index unavailable:", e)
+
+
+SCHEMA_MIGRATIONS = [
+    _migration_base_tables,
+    _migration_history_index,
+    _migration_query_hash,
+    _migration_cache_tables,
+    _migration_query_index,
+    _migration_archive_tables,
+    _migration_stats_counters,
+    _migration_document_index,
+]
+_migrated_paths = set()
+_migrate_lock = threading.Lock()
+
+
+def migrate_chat_database(db=None) -> int:
+    """Bring the database up to the latest schema version; returns that version.
+
+    Pending migrations run in one transaction, so a failure leaves the schema
+    at the previous version.
+    """
+    db = db or chat_db
+    with _migrate_lock:
+        if db.path in _migrated_paths:
+            return len(SCHEMA_MIGRATIONS)
+        with db.write() as conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, migration in enumerate(SCHEMA_MIGRATIONS, start=1):
+                if number > version:
+                    migration(conn)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                    print(f"[DB] Migrated schema to version {number} ({migration.__name__[11:]})")
+        _migrated_paths.add(db.path)
+        return len(SCHEMA_MIGRATIONS)
+
+
+def init_chat_database():
+    """Initialize SQLite database for chat history and memory."""
+    try:
+        migrate_chat_database()
+        conversation_buffer.warm()
+        start_retention_schedule()
         print("Chat database initialized successfully.")
         return True
     except Exception as e:
         print(f"Database initialization error: {e}")
         return False
 
-def save_chat_message(user_msg: str, assistant_msg: str, command_type: str = "general", session_id: str = "default"):
-    """Save chat message to database."""
+def _write_chat(op, durable: bool = None):
+    """Apply op(conn) through the write-behind queue, or directly when it is disabled."""
+    if DB_WRITE_BEHIND:
+        return chat_writes.submit(op, durable)
+    with chat_db.write() as conn:
+        op(conn)
+    return True
+
+def _pending_chat_writes():
+    """Make queued writes visible before reading them back."""
+    if DB_WRITE_BEHIND:
+        chat_writes.flush()
+
+CONVERSATION_BUFFER_TURNS = int(os.getenv("ALIAS_CONVERSATION_BUFFER_TURNS", "20"))
+
+
+class ConversationBuffer:
+    """Recent turns per session in memory, so building context never waits on SQLite.
+
+    Each session is a deque of (user_message, assistant_response,
+    command_type, timestamp) holding the last maxlen turns. It is loaded from
+    chat_history the first time the session is touched and appended to by
+    save_chat_message() before the queued write lands.
+    """
+
+    def __init__(self, db=None, maxlen: int = CONVERSATION_BUFFER_TURNS):
+        self.db = db or chat_db
+        self.maxlen = maxlen
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _session(self, session_id: str):
+        turns = self._sessions.get(session_id)
+        if turns is None:
+            if self.db is chat_db:
+                _pending_chat_writes()
+            rows = self.db.query('''
+                SELECT user_message, assistant_response, command_type, timestamp
+                FROM chat_history
+                WHERE session_id = ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (session_id, self.maxlen))
+            turns = self._sessions[session_id] = deque(reversed(rows), maxlen=self.maxlen)
+        return turns
+
+    def warm(self, session_id: str = "default"):
+        """Load a session from the database now rather than on first use."""
+        with self._lock:
+            self._session(session_id)
+
+    def append(self, user_msg: str, assistant_msg: str, command_type: str = "general", session_id: str = "default"):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())  # same format as CURRENT_TIMESTAMP
+        with self._lock:
+            self._session(session_id).append((user_msg, assistant_msg, command_type, timestamp))
+
+    def recent(self, limit: int = 10, session_id: str = "default"):
+        """Up to limit turns, newest first (the row shape of get_recent_chat_history)."""
+        with self._lock:
+            turns = self._session(session_id)
+            return list(reversed(turns))[:limit]
+
+    def clear(self, session_id: str = None):
+        """Forget one session (or all); they reload from the database on next use."""
+        with self._lock:
+            if session_id is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(session_id, None)
+
+
+conversation_buffer = ConversationBuffer()
+
+
+def save_chat_message(user_msg: str, assistant_msg: str, command_type: str = "general", session_id: str = "default",
+                      durable: bool = None, latency_ms: float = None):
+    """Save chat message to database (queued; durable=True waits for the commit).
+
+    latency_ms, if given, is how long the reply took; it feeds the per-type
+    latency percentiles in get_chat_statistics().
+    """
+    def op(conn):
+        conn.execute('''
+            INSERT INTO chat_history (user_message, assistant_response, command_type, session_id, latency_ms)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_msg, assistant_msg, command_type, session_id, latency_ms))
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO chat_history (user_message, assistant_response, command_type, session_id)
-            VALUES (?, ?, ?, ?)
-        ''', (user_msg, assistant_msg, command_type, session_id))
-        
-        conn.commit()
-        conn.close()
-        return True
+        # Summary first: a new session seeds itself from the buffer, which must not hold this turn yet
+        conversation_summary.add_turn(user_msg, assistant_msg, session_id)
+        conversation_buffer.append(user_msg, assistant_msg, command_type, session_id)
+        return _write_chat(op, durable)
     except Exception as e:
         print(f"Error saving chat: {e}")
         return False
 
 def get_recent_chat_history(limit: int = 10, session_id: str = "default"):
-    """Get recent chat history for context."""
+    """Get recent chat history for context, newest first (from memory when it fits the buffer)."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        if limit <= conversation_buffer.maxlen:
+            return conversation_buffer.recent(limit, session_id)
+        _pending_chat_writes()
+        return chat_db.query('''
             SELECT user_message, assistant_response, command_type, timestamp
             FROM chat_history 
             WHERE session_id = ?
             ORDER BY timestamp DESC 
             LIMIT ?
         ''', (session_id, limit))
-        
-        results = cursor.fetchall()
-        conn.close()
-        return results
     except Exception as e:
         print(f"Error getting chat history: {e}")
         return []
 
-def update_query_memory(query: str, response: str, success: bool = True):
-    """Update query memory for learning patterns."""
+def _upsert_query_memory(conn, query: str, response: str, success: bool = True):
+    # One statement: insert, or bump frequency and fold the outcome into success_rate.
+    # A failed attempt keeps the last good response instead of overwriting it.
+    conn.execute('''
+        INSERT INTO query_memory (query, query_hash, response, frequency, success_rate, last_used)
+        VALUES (?, ?, ?, 1, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(query_hash) DO UPDATE SET
+            frequency = frequency + 1,
+            success_rate = (success_rate * frequency + excluded.success_rate) / (frequency + 1),
+            last_used = CURRENT_TIMESTAMP,
+            response = CASE WHEN excluded.success_rate > 0 THEN excluded.response ELSE response END
+    ''', (query, _query_hash(query), response if success else "", 1.0 if success else 0.0))
+
+def update_query_memory(query: str, response: str, success: bool = True, durable: bool = None):
+    """Update query memory for learning patterns (queued; durable=True waits for the commit)."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Check if query exists
-        cursor.execute('SELECT id, frequency, success_rate FROM query_memory WHERE query = ?', (query,))
-        existing = cursor.fetchone()
-        
-        if existing:
-            # Update existing query
-            query_id, freq, success_rate = existing
-            new_freq = freq + 1
-            new_success_rate = ((success_rate * freq) + (1.0 if success else 0.0)) / new_freq
-            
-            cursor.execute('''
-                UPDATE query_memory 
-                SET frequency = ?, success_rate = ?, last_used = CURRENT_TIMESTAMP, response = ?
-                WHERE id = ?
-            ''', (new_freq, new_success_rate, response, query_id))
-        else:
-            # Insert new query
-            cursor.execute('''
-                INSERT INTO query_memory (query, response, success_rate)
-                VALUES (?, ?, ?)
-            ''', (query, response, 1.0 if success else 0.0))
-        
-        conn.commit()
-        conn.close()
-        return True
+        return _write_chat(lambda conn: _upsert_query_memory(conn, query, response, success), durable)
     except Exception as e:
         print(f"Error updating query memory: {e}")
         return False
 
+QUERY_SEARCH_CANDIDATES = int(os.getenv("ALIAS_QUERY_SEARCH_CANDIDATES", "64"))
+_COMMON_TERM_SHARE = 0.2  # terms in more than this share of queries don't generate candidates
+_DF_CACHE_TTL = 300.0  # seconds a term's document frequency is reused
+_DF_CACHE_TERMS = 200_000
+_df_cache = OrderedDict()  # term -> (document frequency, fetched_at)
+_df_lock = threading.Lock()
+_query_rows = {"rows": 0, "checked": 0.0}
+
+
+def _query_terms(text: str):
+    """Lower-cased word tokens, split the same way as FTS5's unicode61 tokenizer."""
+    return re.findall(r"[^\W_]+", (text or "").lower())
+
+
+def _query_index_ready() -> bool:
+    try:
+        return chat_db.query_one(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'query_memory_vocab'"
+        ) is not None
+    except Exception:
+        return False
+
+
+def _query_memory_size() -> int:
+    # Row count only changes how IDF is scaled, so a slightly stale value is fine
+    now = time.monotonic()
+    if now - _query_rows["checked"] > 30:
+        _query_rows["rows"] = chat_db.query_one('SELECT COUNT(*) FROM query_memory')[0]
+        _query_rows["checked"] = now
+    return _query_rows["rows"]
+
+
+def _document_frequencies(terms):
+    """Number of stored queries containing each term, from fts5vocab with an in-process LRU in front."""
+    now = time.monotonic()
+    found, missing = {}, []
+    with _df_lock:
+        for term in terms:
+            entry = _df_cache.get(term)
+            if entry is not None and now - entry[1] < _DF_CACHE_TTL:
+                _df_cache.move_to_end(term)
+                found[term] = entry[0]
+            else:
+                missing.append(term)
+    fetched = {}
+    for start in range(0, len(missing), 500):
+        part = missing[start:start + 500]
+        fetched.update(chat_db.query(
+            f'SELECT term, doc FROM query_memory_vocab WHERE term IN ({",".join("?" * len(part))})', part
+        ))
+    with _df_lock:
+        for term in missing:
+            found[term] = fetched.get(term, 0)
+            # Unknown terms aren't cached, so a query stored a moment ago is searchable straight away
+            if found[term]:
+                _df_cache[term] = (found[term], now)
+                _df_cache.move_to_end(term)
+        while len(_df_cache) > _DF_CACHE_TERMS:
+            _df_cache.popitem(last=False)
+    return found
+
+
+def search_query_memory(query: str, limit: int = 3, min_similarity: float = 0.0, flush: bool = True):
+    """Rank stored queries by TF-IDF cosine similarity to query.
+
+    Candidates come from the query_memory_fts word index (rare terms first),
+    then are re-ranked with NumPy using IDF from the fts5vocab table. Returns
+    dicts with query, response, frequency, success_rate, last_used and
+    similarity (0..1), best first. flush=False skips waiting for queued
+    writes, for callers on the response path that can miss the last second.
+    """
+    import numpy as np
+
+    terms = _query_terms(query)
+    if not terms:
+        return []
+    if flush:
+        _pending_chat_writes()
+    indexed = _query_index_ready()
+    columns = 'q.query, q.response, q.frequency, q.success_rate, q.last_used'
+    if indexed:
+        total = max(1, _query_memory_size())
+        df = _document_frequencies(list(dict.fromkeys(terms)))
+        known = [t for t in df if df[t] > 0]
+        if not known:
+            return []
+        # Common words match too much to be useful candidates; keep them only if nothing else is left
+        rare = [t for t in known if df[t] <= total * _COMMON_TERM_SHARE] or sorted(known, key=df.get)[:2]
+        match = " OR ".join(f'"{t}"' for t in rare)
+        rows = chat_db.query(f'''
+            SELECT {columns} FROM query_memory_fts f JOIN query_memory q ON q.id = f.rowid
+            WHERE query_memory_fts MATCH ? ORDER BY bm25(query_memory_fts) LIMIT ?
+        ''', (match, QUERY_SEARCH_CANDIDATES))
+    else:
+        longest = sorted(set(terms), key=len, reverse=True)[:3]
+        rows = chat_db.query(
+            f'SELECT {columns} FROM query_memory q WHERE ' + " OR ".join("q.query LIKE ?" for _ in longest)
+            + ' LIMIT ?',
+            [f"%{t}%" for t in longest] + [QUERY_SEARCH_CANDIDATES],
+        )
+        total, df = max(1, len(rows)), {}
+    if not rows:
+        return []
+
+    candidate_terms = [_query_terms(row[0]) for row in rows]
+    vocab = list(dict.fromkeys(terms + [t for ts in candidate_terms for t in ts]))
+    position = {t: i for i, t in enumerate(vocab)}
+    if indexed:
+        df.update(_document_frequencies([t for t in vocab if t not in df]))
+    idf = np.array([math.log((total + 1) / (df.get(t, 0) + 1)) + 1.0 for t in vocab])
+
+    def vector(tokens):
+        v = np.zeros(len(vocab))
+        for t in tokens:
+            v[position[t]] += 1.0
+        return v
+
+    matrix = np.vstack([vector(ts) for ts in candidate_terms]) * idf
+    target = vector(terms) * idf
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(target)
+    scores = np.divide(matrix @ target, norms, out=np.zeros(len(rows)), where=norms > 0)
+
+    # Ties (e.g. identical wording) go to the most used, most successful entry
+    order = sorted(range(len(rows)), key=lambda i: (-round(float(scores[i]), 6), -(rows[i][2] or 0), -(rows[i][3] or 0)))
+    results = []
+    for i in order:
+        if scores[i] < min_similarity or len(results) >= limit:
+            break
+        query_text, response, frequency, success_rate, last_used = rows[i]
+        results.append({
+            "query": query_text, "response": response, "frequency": frequency,
+            "success_rate": success_rate, "last_used": last_used, "similarity": float(scores[i]),
+        })
+    return results
+
 def get_similar_queries(query: str, limit: int = 3):
-    """Find similar queries from memory."""
+    """Find similar queries from memory: (query, response, frequency, success_rate) tuples, best first."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Simple similarity search (can be enhanced with fuzzy matching)
-        cursor.execute('''
-            SELECT query, response, frequency, success_rate
-            FROM query_memory 
-            WHERE query LIKE ? OR query LIKE ? OR query LIKE ?
-            ORDER BY frequency DESC, success_rate DESC
-            LIMIT ?
-        ''', (f"%{query}%", f"%{query.split()[0]}%", f"%{query.split()[-1]}%", limit))
-        
-        results = cursor.fetchall()
-        conn.close()
-        return results
+        return [
+            (m["query"], m["response"], m["frequency"], m["success_rate"])
+            for m in search_query_memory(query, limit)
+        ]
     except Exception as e:
         print(f"Error getting similar queries: {e}")
         return []
 
+def _histogram_percentile(buckets, fraction: float):
+    """Upper bound (ms) of the bucket holding the given fraction of samples; None past the last bound."""
+    total = sum(count for _, count in buckets)
+    seen = 0
+    for bound, count in buckets:
+        seen += count
+        if seen >= total * fraction:
+            return bound
+    return None
+
+
 def get_chat_statistics():
-    """Get chat statistics."""
+    """Get chat statistics from the trigger-maintained counters (no chat_history scans).
+
+    recent_activity counts the last 24 hourly buckets. latency maps each
+    command type to its sample count, mean and p50/p90/p99 in milliseconds;
+    percentiles are histogram bucket bounds (None = over the largest bound).
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Total messages
-        cursor.execute('SELECT COUNT(*) FROM chat_history')
-        total_messages = cursor.fetchone()[0]
+        _pending_chat_writes()
+        type_rows = chat_db.query(
+            'SELECT command_type, messages, latency_count, latency_total_ms FROM chat_stats WHERE messages > 0'
+        )
+        total_messages = sum(row[1] for row in type_rows)
         
-        # Most common command types
-        cursor.execute('''
-            SELECT command_type, COUNT(*) as count 
-            FROM chat_history 
-            GROUP BY command_type 
-            ORDER BY count DESC 
-            LIMIT 5
-        ''')
-        command_stats = cursor.fetchall()
+        # Most common command types ('' stands for a NULL command_type)
+        command_stats = [(command_type or None, count)
+                         for command_type, count, _, _ in sorted(type_rows, key=lambda row: -row[1])[:5]]
         
         # Recent activity
-        cursor.execute('''
-            SELECT COUNT(*) FROM chat_history 
-            WHERE timestamp > datetime('now', '-1 day')
-        ''')
-        recent_activity = cursor.fetchone()[0]
+        recent_activity = chat_db.query_one('''
+            SELECT COALESCE(SUM(messages), 0) FROM chat_activity_hourly
+            WHERE hour > strftime('%Y-%m-%d %H:00', 'now', '-1 day')
+        ''')[0]
+        
+        # Latency percentiles per command type; -1 is the overflow bucket, so sort it last
+        histograms = {}
+        for command_type, bound, count in chat_db.query(
+            'SELECT command_type, bucket_ms, count FROM chat_latency_histogram WHERE count > 0'
+        ):
+            histograms.setdefault(command_type, []).append((None if bound < 0 else bound, count))
+        latency = {}
+        for command_type, _, samples, total_ms in type_rows:
+            buckets = sorted(histograms.get(command_type, []), key=lambda item: float("inf") if item[0] is None else item[0])
+            if not samples or not buckets:
+                continue
+            latency[command_type or None] = {
+                'count': samples,
+                'avg_ms': round(total_ms / samples, 1),
+                'p50_ms': _histogram_percentile(buckets, 0.5),
+                'p90_ms': _histogram_percentile(buckets, 0.9),
+                'p99_ms': _histogram_percentile(buckets, 0.99),
+            }
         
-        conn.close()
         return {
             'total_messages': total_messages,
             'command_stats': command_stats,
-            'recent_activity': recent_activity
+            'recent_activity': recent_activity,
+            'latency': latency,
         }
     except Exception as e:
         print(f"Error getting statistics: {e}")
         return {}
 
+def benchmark_chat_database(rows: int = 1_000_000, checkpoints=(10_000, 100_000, 1_000_000), samples: int = 500):
+    """Measure query-memory UPSERT and recent-history latency as the tables grow.
+
+    Runs against a temporary database. For each checkpoint row count, returns
+    p50/p99 microseconds for UPSERTs (half existing queries, half new) and for
+    get_recent_chat_history's query, plus the old unindexed lookup by query text
+    in milliseconds for comparison.
+    """
+
+    def percentile(values, pct):
+        values = sorted(values)
+        return round(values[min(len(values) - 1, int(len(values) * pct))], 1)
+
+    fd, path = tempfile.mkstemp(prefix="alias_bench_", suffix=".db")
+    os.close(fd)
+    db = SQLiteManager(path)
+    results = {}
+    try:
+        migrate_chat_database(db)
+        loaded = 0
+        for target in sorted(c for c in checkpoints if c <= rows):
+            with db.write() as conn:
+                while loaded < target:
+                    step = range(loaded, min(target, loaded + 50_000))
+                    conn.executemany(
+                        'INSERT INTO query_memory (query, query_hash, response) VALUES (?, ?, ?)',
+                        ((f"benchmark query {i}", _query_hash(f"benchmark query {i}"), "response") for i in step),
+                    )
+                    conn.executemany(
+                        'INSERT INTO chat_history (user_message, assistant_response, command_type, session_id) '
+                        'VALUES (?, ?, ?, ?)',
+                        ((f"message {i}", "reply", "general", f"session {i % 1000}") for i in step),
+                    )
+                    loaded = step.stop
+            upserts, reads = [], []
+            with db.write() as conn:
+                for n in range(samples):
+                    query = f"benchmark query {random.randrange(loaded)}" if n % 2 else f"new query {target} {n}"
+                    start = time.perf_counter()
+                    _upsert_query_memory(conn, query, "response")
+                    upserts.append((time.perf_counter() - start) * 1e6)
+            for n in range(samples):
+                start = time.perf_counter()
+                db.query(
+                    'SELECT user_message, assistant_response, command_type, timestamp FROM chat_history '
+                    'WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?',
+                    (f"session {random.randrange(1000)}", 10),
+                )
+                reads.append((time.perf_counter() - start) * 1e6)
+            start = time.perf_counter()
+            for n in range(5):
+                db.query('SELECT id FROM query_memory WHERE query = ?', (f"benchmark query {random.randrange(loaded)}",))
+            results[target] = {
+                "upsert_us_p50": percentile(upserts, 0.5),
+                "upsert_us_p99": percentile(upserts, 0.99),
+                "history_us_p50": percentile(reads, 0.5),
+                "history_us_p99": percentile(reads, 0.99),
+                "unindexed_lookup_ms": round((time.perf_counter() - start) * 1000 / 5, 2),
+            }
+    finally:
+        db.close()
+        _migrated_paths.discard(path)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+    return results
+
+class PreferencesStore:
+    """user_preferences held in memory: loaded once, written through, with change subscribers.
+
+    subscribe(callback, key=None) registers callback(key, value) for one key
+    (or every key) and returns a function that unsubscribes it. Callbacks run
+    on the thread that made the change.
+    """
+
+    def __init__(self, db=None):
+        self.db = db or chat_db
+        self._values = None
+        self._lock = threading.Lock()
+        self._subscribers = []  # (key or None, callback)
+        self.stats = {"loads": 0, "reads": 0, "writes": 0}
+
+    def _load(self):
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    migrate_chat_database(self.db)
+                    self._values = dict(self.db.query('SELECT key, value FROM user_preferences'))
+                    self.stats["loads"] += 1
+        return self._values
+
+    def get(self, key: str, default=None):
+        try:
+            values = self._load()
+        except Exception as e:
+            print(f"Error reading preference: {e}")
+            return default
+        self.stats["reads"] += 1
+        return values.get(key, default)
+
+    def set(self, key: str, value: str) -> bool:
+        try:
+            values = self._load()
+            with self._lock:
+                self.db.execute('''
+                    INSERT OR REPLACE INTO user_preferences (key, value, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                ''', (key, value))
+                changed = values.get(key) != value
+                values[key] = value
+                self.stats["writes"] += 1
+                subscribers = [callback for wanted, callback in self._subscribers if wanted in (None, key)]
+        except Exception as e:
+            print(f"Error saving preference: {e}")
+            return False
+        if changed:
+            for callback in subscribers:
+                try:
+                    callback(key, value)
+                except Exception as e:
+                    print("[Preferences Subscriber Error]", e)
+        return True
+
+    def all(self) -> dict:
+        """Copy of every stored preference."""
+        return dict(self._load())
+
+    def subscribe(self, callback, key: str = None):
+        entry = (key, callback)
+        with self._lock:
+            self._subscribers.append(entry)
+
+        def unsubscribe():
+            with self._lock:
+                if entry in self._subscribers:
+                    self._subscribers.remove(entry)
+        return unsubscribe
+
+    def reload(self):
+        """Drop the in-memory copy so the next read loads the table again."""
+        with self._lock:
+            self._values = None
+
+
+preferences = PreferencesStore()
+
+
+def get_user_preference(key: str, default=None):
+    """Read one value from user_preferences (served from memory)."""
+    return preferences.get(key, default)
+
+def set_user_preference(key: str, value: str):
+    """Store one value in user_preferences and notify subscribers."""
+    return preferences.set(key, value)
+
+def subscribe_preference(callback, key: str = None):
+    """Call callback(key, value) when a preference changes; returns an unsubscribe function."""
+    return preferences.subscribe(callback, key)
+
+# ==== SEMANTIC ANSWER CACHE ====
+# A general question that closely matches one answered well several times
+# before is served from query_memory instead of calling Gemini. Time-sensitive
+# questions (news, email, weather, "today"...) always go to the model, and an
+# answer is only reused while its last_used timestamp is recent enough.
+# Prompts that continue the previous turn ("and in Java?", "tell me more
+# about it") are never answered from here, nor are short prompts that lean on
+# a pronoun ("why is that so") while a conversation is under way.
+ANSWER_CACHE_ENABLED = os.getenv("ALIAS_ANSWER_CACHE", "on").strip().lower() not in ("0", "off", "false", "no")
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ALIAS_ANSWER_CACHE_SIMILARITY", "0.85"))
+ANSWER_CACHE_MIN_FREQUENCY = int(os.getenv("ALIAS_ANSWER_CACHE_MIN_FREQUENCY", "2"))
+ANSWER_CACHE_MIN_SUCCESS = float(os.getenv("ALIAS_ANSWER_CACHE_MIN_SUCCESS", "0.8"))
+ANSWER_CACHE_MAX_AGE_HOURS = float(os.getenv("ALIAS_ANSWER_CACHE_MAX_AGE_HOURS", "168"))
+ANSWER_CACHE_CONTEXT_MINUTES = float(os.getenv("ALIAS_ANSWER_CACHE_CONTEXT_MINUTES", "10"))  # 0 = ignore recent turns
+_ANSWER_CACHE_MIN_TERMS = 3  # shorter prompts are usually follow-ups that depend on the conversation
+_ANAPHORA_MAX_TERMS = 5  # up to this long, a pronoun probably points at the previous turn
+_TIME_SENSITIVE = re.compile(
+    r"\b(news|headlines?|email|e-mail|inbox|mail|weather|forecast|today|tonight|tomorrow|yesterday|now|"
+    r"current(ly)?|latest|recent|this (week|month|year)|time|date|price|stock|score)\b",
+    re.IGNORECASE,
+)
+# Openings that only make sense as a continuation of the previous turn
+_FOLLOW_UP = re.compile(
+    r"^\s*(and|also|or|but|so|then|what about|how about|what else|why not|same|"
+    r"tell me more|more (on|about)|explain (that|it|this)|say (that|it) again|do (that|it) again)\b",
+    re.IGNORECASE,
+)
+_ANAPHORA = re.compile(r"\b(it|its|that|this|these|those|them|they|he|she|him|her)\b", re.IGNORECASE)
+# Error replies from the command handlers, e.g. "AI query error: ..." or "Failed to open browser: ..."
+_FAILED_ANSWER = re.compile(r"^([A-Z][\w ]{0,30} error|Failed to [^:]{0,40}):")
+_answer_cache_stats = {"lookups": 0, "hits": 0, "skipped": 0}
+
+
+def is_failed_answer(text: str) -> bool:
+    """True if text is an error or Gemini fallback message rather than an answer worth remembering."""
+    return _is_gemini_fallback(text) or bool(_FAILED_ANSWER.match(text))
+
+
+def _timestamp_age(timestamp, now: float) -> float:
+    """Seconds since a UTC "YYYY-MM-DD HH:MM:SS" timestamp (inf if it can't be parsed)."""
+    import calendar
+
+    try:
+        return now - calendar.timegm(time.strptime(str(timestamp)[:19], "%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        return float("inf")
+
+
+def _in_conversation(session_id: str, now: float) -> bool:
+    if ANSWER_CACHE_CONTEXT_MINUTES <= 0:
+        return False
+    recent = conversation_buffer.recent(1, session_id)
+    return bool(recent) and _timestamp_age(recent[0][3], now) < ANSWER_CACHE_CONTEXT_MINUTES * 60
+
+
+def _depends_on_context(query: str, session_id: str, now: float) -> bool:
+    """True if query reads as a follow-up to the previous turn rather than a standalone question."""
+    if _FOLLOW_UP.match(query):
+        return True
+    short = len(_query_terms(query)) <= _ANAPHORA_MAX_TERMS
+    return short and bool(_ANAPHORA.search(query)) and _in_conversation(session_id, now)
+
+
+def lookup_cached_answer(query: str, session_id: str = "default"):
+    """Stored response for a close, frequently successful past query, or None."""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    now = time.time()
+    if (_TIME_SENSITIVE.search(query) or len(_query_terms(query)) < _ANSWER_CACHE_MIN_TERMS
+            or _depends_on_context(query, session_id, now)):
+        _answer_cache_stats["skipped"] += 1
+        return None
+    _answer_cache_stats["lookups"] += 1
+    try:
+        # No flush: a cached answer needs several past askings, so rows still queued don't matter
+        matches = search_query_memory(query, limit=3, min_similarity=ANSWER_CACHE_SIMILARITY, flush=False)
+    except Exception as e:
+        print("[Answer Cache Error]", e)
+        return None
+    for match in matches:
+        if match["frequency"] < ANSWER_CACHE_MIN_FREQUENCY or match["success_rate"] < ANSWER_CACHE_MIN_SUCCESS:
+            continue
+        # Stored rows include news/email replies saved under other wording, follow-ups whose
+        # answer depended on their conversation, and error text from older versions
+        if (_TIME_SENSITIVE.search(match["query"]) or _FOLLOW_UP.match(match["query"])
+                or is_failed_answer(match["response"] or "")):
+            continue
+        if _timestamp_age(match["last_used"], now) > ANSWER_CACHE_MAX_AGE_HOURS * 3600:
+            continue
+        _answer_cache_stats["hits"] += 1
+        print(f"[Answer Cache] hit {match['similarity']:.2f}: {query[:60]!r} -> {match['query'][:60]!r}")
+        return match["response"]
+    return None
+
+
+def get_answer_cache_stats():
+    """Lookup/hit counts for the semantic answer cache."""
+    stats = dict(_answer_cache_stats)
+    stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+    return stats
+
+# ==== CHAT DATABASE RETENTION ====
+# chat_history and query_memory would otherwise grow forever. Rows past the
+# age or row-count limits are moved into archive_segments as zlib-compressed
+# JSON (one segment per ARCHIVE_SEGMENT_ROWS rows) and deleted from the live
+# tables; freed pages are then returned with PRAGMA incremental_vacuum. It can
+# be run offline with `python Alias.py --compact`; running it automatically
+# every RETENTION_INTERVAL_HOURS is opt-in (ALIAS_RETENTION=on), since the
+# first run moves an existing user's older history out of chat_history.
+import zlib
+
+RETENTION_ENABLED = os.getenv("ALIAS_RETENTION", "off").strip().lower() in ("1", "on", "true", "yes")
+RETENTION_HISTORY_DAYS = float(os.getenv("ALIAS_RETENTION_HISTORY_DAYS", "90"))  # 0 = no age limit
+RETENTION_HISTORY_ROWS = int(os.getenv("ALIAS_RETENTION_HISTORY_ROWS", "50000"))  # 0 = no size limit
+RETENTION_MEMORY_DAYS = float(os.getenv("ALIAS_RETENTION_MEMORY_DAYS", "180"))
+RETENTION_MEMORY_ROWS = int(os.getenv("ALIAS_RETENTION_MEMORY_ROWS", "100000"))
+RETENTION_INTERVAL_HOURS = float(os.getenv("ALIAS_RETENTION_INTERVAL_HOURS", "24"))
+ARCHIVE_SEGMENT_ROWS = int(os.getenv("ALIAS_ARCHIVE_SEGMENT_ROWS", "1000"))
+VACUUM_PAGES = 2000  # pages released per incremental_vacuum step
+
+_ARCHIVE_COLUMNS = {
+    "chat_history": ("id", "timestamp", "user_message", "assistant_response", "command_type", "session_id", "latency_ms"),
+    "query_memory": ("id", "query", "response", "frequency", "last_used", "success_rate"),
+}
+_retention_timer = None
+_retention_announced = False
+
+
+def _expired_ids(conn, source: str, max_age_days: float, max_rows: int):
+    """Ids past the age or row-count limit, oldest first."""
+    if source == "chat_history":
+        age_column, keep_order = "timestamp", "id DESC"
+    else:
+        # Keep the most useful memories: frequent first, then recently used
+        age_column, keep_order = "last_used", "frequency DESC, last_used DESC, id DESC"
+    ids = set()
+    if max_age_days > 0:
+        ids.update(row[0] for row in conn.execute(
+            f"SELECT id FROM {source} WHERE {age_column} < datetime('now', ?)", (f"-{max_age_days} days",)
+        ))
+    if max_rows > 0:
+        ids.update(row[0] for row in conn.execute(
+            f"SELECT id FROM {source} ORDER BY {keep_order} LIMIT -1 OFFSET ?", (max_rows,)
+        ))
+    return sorted(ids)
+
+
+def archive_rows(source: str, ids, db=None) -> dict:
+    """Move the given rows of chat_history or query_memory into compressed archive segments."""
+    db = db or chat_db
+    columns = _ARCHIVE_COLUMNS[source]
+    stats = {"rows": 0, "segments": 0, "raw_bytes": 0, "stored_bytes": 0}
+    ids = list(ids)
+    for start in range(0, len(ids), ARCHIVE_SEGMENT_ROWS):
+        part = ids[start:start + ARCHIVE_SEGMENT_ROWS]
+        marks = ",".join("?" * len(part))
+        # One transaction per segment keeps the writer lock short
+        with db.write() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(columns)} FROM {source} WHERE id IN ({marks}) ORDER BY id", part
+            ).fetchall()
+            if not rows:
+                continue
+            raw = json.dumps([dict(zip(columns, row)) for row in rows], ensure_ascii=False).encode("utf-8")
+            data = zlib.compress(raw, 9)
+            conn.execute('''
+                INSERT INTO archive_segments (source, first_id, last_id, row_count, raw_bytes, data)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (source, rows[0][0], rows[-1][0], len(rows), len(raw), data))
+            conn.execute(f"DELETE FROM {source} WHERE id IN ({marks})", part)
+        stats["rows"] += len(rows)
+        stats["segments"] += 1
+        stats["raw_bytes"] += len(raw)
+        stats["stored_bytes"] += len(data)
+    return stats
+
+
+def iter_archived_rows(source: str = "chat_history", db=None):
+    """Yield archived rows (dicts) of one source, oldest segment first."""
+    db = db or chat_db
+    last = 0
+    while True:
+        segment = db.query_one(
+            "SELECT id, data FROM archive_segments WHERE source = ? AND id > ? ORDER BY id LIMIT 1", (source, last)
+        )
+        if segment is None:
+            return
+        last = segment[0]
+        yield from json.loads(zlib.decompress(segment[1]).decode("utf-8"))
+
+
+def _database_bytes(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def vacuum_chat_database(db=None, convert: bool = False, max_pages: int = None) -> dict:
+    """Return free pages to the filesystem.
+
+    With auto_vacuum=INCREMENTAL this releases up to max_pages free pages in
+    short steps. An older file created without it needs one full VACUUM to
+    switch modes, which only runs when convert=True (it rewrites the file).
+    """
+    db = db or chat_db
+    with db.write() as conn:
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    result = {"mode": mode, "free_pages": free, "released_pages": 0, "converted": False}
+    if mode != 2:
+        if not convert:
+            return result
+        with db.write() as conn:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        result.update(mode=2, released_pages=free, converted=True)
+        return result
+    remaining = free if max_pages is None else min(free, max_pages)
+    while remaining > 0:
+        step = min(VACUUM_PAGES, remaining)
+        with db.write() as conn:
+            conn.execute(f"PRAGMA incremental_vacuum({step})").fetchall()
+        remaining -= step
+        result["released_pages"] += step
+    return result
+
+
+def compact_chat_database(db=None, history_days: float = None, history_rows: int = None,
+                          memory_days: float = None, memory_rows: int = None,
+                          convert: bool = False) -> dict:
+    """Apply the retention policy, archive expired rows and vacuum; returns a summary dict."""
+    db = db or chat_db
+    history_days = RETENTION_HISTORY_DAYS if history_days is None else history_days
+    history_rows = RETENTION_HISTORY_ROWS if history_rows is None else history_rows
+    memory_days = RETENTION_MEMORY_DAYS if memory_days is None else memory_days
+    memory_rows = RETENTION_MEMORY_ROWS if memory_rows is None else memory_rows
+    started = time.perf_counter()
+    migrate_chat_database(db)
+    if db is chat_db:
+        _pending_chat_writes()
+    size_before = _database_bytes(db.path)
+    summary = {}
+    for source, days, rows in (("chat_history", history_days, history_rows),
+                               ("query_memory", memory_days, memory_rows)):
+        summary[source] = archive_rows(source, _expired_ids(db.reader(), source, days, rows), db)
+    with db.write() as conn:
+        # Hourly activity buckets emptied by archiving
+        conn.execute("DELETE FROM chat_activity_hourly WHERE messages <= 0")
+    summary["vacuum"] = vacuum_chat_database(db, convert=convert)
+    with db.write() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    summary["bytes_before"] = size_before
+    summary["bytes_after"] = _database_bytes(db.path)
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def _run_scheduled_retention():
+    global _retention_timer
+    try:
+        summary = compact_chat_database()
+        history, memory = summary["chat_history"]["rows"], summary["query_memory"]["rows"]
+        if history or memory:
+            print(f"[Retention] moved {history} chat turns (older than {RETENTION_HISTORY_DAYS:g} days or beyond "
+                  f"{RETENTION_HISTORY_ROWS} rows) and {memory} query memories to archive_segments; "
+                  "read them back with iter_archived_rows()")
+        if summary["vacuum"]["released_pages"]:
+            print(f"[Retention] released {summary['vacuum']['released_pages']} pages")
+        if summary["vacuum"]["mode"] != 2:
+            print("[Retention] run `python Alias.py --compact` once to enable incremental vacuum")
+    except Exception as e:
+        print("[Retention Error]", e)
+    _retention_timer = None
+    start_retention_schedule()
+
+
+def start_retention_schedule():
+    """Run compact_chat_database() every RETENTION_INTERVAL_HOURS on a daemon timer (if ALIAS_RETENTION=on)."""
+    global _retention_timer, _retention_announced
+    if not RETENTION_ENABLED or RETENTION_INTERVAL_HOURS <= 0 or _retention_timer is not None:
+        return
+    if not _retention_announced:
+        _retention_announced = True
+        print(f"[Retention] on: chat turns older than {RETENTION_HISTORY_DAYS:g} days are archived every "
+              f"{RETENTION_INTERVAL_HOURS:g} hours (set ALIAS_RETENTION=off to keep everything in chat_history)")
+    _retention_timer = threading.Timer(RETENTION_INTERVAL_HOURS * 3600, _run_scheduled_retention)
+    _retention_timer.daemon = True
+    _retention_timer.start()
+
+# ==== ROLLING CONVERSATION SUMMARY ====
+# Older turns are folded into a running summary on a background thread, so a
+# general query carries a bounded summary plus the last few turns verbatim
+# instead of every previous answer (code listings and news digests included).
+# Each fold is one Gemini call, so turns are folded in batches rather than one
+# at a time.
+SUMMARY_VERBATIM_TURNS = int(os.getenv("ALIAS_SUMMARY_VERBATIM_TURNS", "2"))
+SUMMARY_MAX_TOKENS = int(os.getenv("ALIAS_SUMMARY_MAX_TOKENS", "300"))
+SUMMARY_FOLD_TURNS = int(os.getenv("ALIAS_SUMMARY_FOLD_TURNS", "4"))  # turns beyond the verbatim ones per fold
+SUMMARY_FOLD_TOKENS = int(os.getenv("ALIAS_SUMMARY_FOLD_TOKENS", "2000"))  # ...or fewer once they reach this size
+_SUMMARY_TURN_TOKENS = 400  # each side of a turn is trimmed to this before folding
+
+
+class RollingSummary:
+    """Per-session running summary of the conversation.
+
+    add_turn() queues a saved turn. Once fold_turns turns beyond the last
+    verbatim_turns are waiting (or they add up to fold_tokens), they are
+    folded into the summary by Gemini on a single background worker (or by a
+    short extractive digest when Gemini is unavailable), so a conversation
+    costs one summary call per fold_turns turns. context() returns the summary
+    and the turns not folded yet, so nothing is lost while a fold is in
+    progress.
+    """
+
+    def __init__(self, buffer=None, verbatim_turns: int = SUMMARY_VERBATIM_TURNS,
+                 max_tokens: int = SUMMARY_MAX_TOKENS, fold_turns: int = SUMMARY_FOLD_TURNS,
+                 fold_tokens: int = SUMMARY_FOLD_TOKENS):
+        self.buffer = buffer or conversation_buffer
+        self.verbatim_turns = max(0, verbatim_turns)
+        self.max_tokens = max_tokens
+        self.fold_turns = max(1, fold_turns)
+        self.fold_tokens = fold_tokens
+        self._sessions = {}  # session_id -> {"summary", "pending", "folding"}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="alias-summary")
+        self.stats = {"requests": 0, "prompt_tokens": 0, "max_prompt_tokens": 0, "last_prompt_tokens": 0,
+                      "raw_history_tokens": 0, "folds": 0, "folded_turns": 0, "fold_errors": 0}
+
+    def _state(self, session_id: str):
+        state = self._sessions.get(session_id)
+        if state is None:
+            # Turns saved by earlier runs start out unsummarized and are folded in the background
+            turns = [(u or "", a or "") for u, a, _, _ in reversed(self.buffer.recent(self.buffer.maxlen, session_id))]
+            state = self._sessions[session_id] = {"summary": "", "pending": turns, "folding": False}
+            self._schedule(session_id, state)
+        return state
+
+    def _fold_due(self, state) -> bool:
+        older = state["pending"][:max(0, len(state["pending"]) - self.verbatim_turns)]
+        if len(older) >= self.fold_turns:
+            return True
+        return bool(older) and sum(estimate_tokens(u) + estimate_tokens(a) for u, a in older) >= self.fold_tokens
+
+    def _schedule(self, session_id: str, state):
+        # Caller holds self._lock
+        if not state["folding"] and self._fold_due(state):
+            state["folding"] = True
+            self._executor.submit(self._fold, session_id, state)
+
+    def add_turn(self, user_msg: str, assistant_msg: str, session_id: str = "default"):
+        with self._lock:
+            state = self._state(session_id)
+            state["pending"].append((user_msg or "", assistant_msg or ""))
+            self._schedule(session_id, state)
+
+    def context(self, session_id: str = "default"):
+        """(summary, turns): the running summary and the unfolded turns, oldest first."""
+        with self._lock:
+            state = self._state(session_id)
+            return state["summary"], list(state["pending"])
+
+    def _fold(self, session_id: str, state):
+        with self._lock:
+            count = len(state["pending"]) - self.verbatim_turns
+            turns, previous = state["pending"][:count], state["summary"]
+        try:
+            summary = self._summarize(previous, turns)
+        except Exception as e:
+            print("[Summary Error]", e)
+            self.stats["fold_errors"] += 1
+            summary = self._digest(previous, turns)
+        with self._lock:
+            del state["pending"][:count]
+            state["summary"] = summary
+            state["folding"] = False
+            self.stats["folds"] += 1
+            self.stats["folded_turns"] += count
+            self._schedule(session_id, state)
+
+    def _summarize(self, previous: str, turns) -> str:
+        if not GEMINI_API_KEY or GEMINI_API_KEY.strip() == "":
+            return self._digest(previous, turns)
+        transcript = "\n".join(
+            f"User: {truncate_to_tokens(u, _SUMMARY_TURN_TOKENS, keep='middle')}\n"
+            f"Assistant: {truncate_to_tokens(a, _SUMMARY_TURN_TOKENS, keep='middle')}"
+            for u, a in turns
+        )
+        prompt = (
+            "Update the running summary of a conversation between a user and the assistant ALIAS. "
+            "Keep names, preferences, facts, decisions and open questions; leave out code, lists and wording. "
+            f"Reply with the updated summary only, in at most {self.max_tokens * 3 // 4} words.\n\n"
+            f"Current summary:\n{previous or '(none)'}\n\nNew turns:\n{transcript}"
+        )
+        text = gemini_client.generate_sync(prompt, feature="summary", raise_errors=True, deadline=30)
+        return truncate_to_tokens((text or "").strip(), self.max_tokens) or self._digest(previous, turns)
+
+    def _digest(self, previous: str, turns) -> str:
+        """Fallback summary: one short line per turn, newest kept when over budget."""
+        lines = [previous] if previous else []
+        for u, a in turns:
+            lines.append(f"User asked: {truncate_to_tokens(' '.join(u.split()), 30)}; "
+                         f"ALIAS answered: {truncate_to_tokens(' '.join(a.split()), 30).rstrip('.')}.")
+        return truncate_to_tokens(" ".join(lines), self.max_tokens, keep="tail")
+
+    def record(self, prompt: str, session_id: str = "default"):
+        """Count a prompt's tokens, next to what the raw recent history alone would have cost."""
+        tokens = estimate_tokens(prompt)
+        raw = sum(estimate_tokens(u) + estimate_tokens(a)
+                  for u, a, _, _ in self.buffer.recent(self.buffer.maxlen, session_id))
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["prompt_tokens"] += tokens
+            self.stats["last_prompt_tokens"] = tokens
+            self.stats["max_prompt_tokens"] = max(self.stats["max_prompt_tokens"], tokens)
+            self.stats["raw_history_tokens"] += raw
+        return tokens
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        requests = stats["requests"] or 1
+        stats["avg_prompt_tokens"] = round(stats["prompt_tokens"] / requests, 1)
+        stats["avg_raw_history_tokens"] = round(stats["raw_history_tokens"] / requests, 1)
+        return stats
+
+
+conversation_summary = RollingSummary()
+
+
+def build_conversation_prompt(query: str, system: str = "", memory=None, session_id: str = "default",
+                              budget: int = None) -> str:
+    """build_prompt() with the session's running summary and its last verbatim turns as history."""
+    summary, turns = conversation_summary.context(session_id)
+    prompt = build_prompt(query, system=system, history=turns, memory=memory, budget=budget, summary=summary)
+    conversation_summary.record(prompt, session_id)
+    return prompt
+
+
+def get_conversation_summary_stats():
+    """Prompt token counts per request and summary fold statistics."""
+    return conversation_summary.get_stats()
+
 # ==== MYSQL SUPPORT ====
 MYSQL_CONFIG = {
     "host": "localhost",
@@ -842,8 +4417,8 @@ def create_database_from_command(command):
         db_name = f"friday_{subject.replace(' ', '_')}"
         speak(f"Creating a database for {subject}.")
         # Use OpenAI to generate a table schema
-        prompt = f"Generate a MySQL CREATE TABLE statement for a table called {subject} with appropriate columns. Only output the SQL statement."
-        sql = gemini_chat(prompt)
+        prompt = build_prompt(f"Generate a MySQL CREATE TABLE statement for a table called {subject} with appropriate columns. Only output the SQL statement.")
+        sql = gemini_chat(prompt, feature="sql")
         print("[DEBUG] Generated SQL:", sql)
         if not sql:
             speak("Failed to get table schema from AI.")
@@ -933,8 +4508,8 @@ def nl_to_sql(command):
     speak("Translating your request into SQL...")
     try:
         table_info = f"Assume the database has tables relevant to the current context."
-        prompt = f"{table_info} Convert the following request to SQL: {command}"
-        sql = gemini_chat(prompt)
+        prompt = build_prompt(command, system=f"{table_info} Convert the following request to SQL:")
+        sql = gemini_chat(prompt, feature="sql")
         sql = sql.strip() if sql else ""
         print("SQL Generated:", sql)
         handle_mysql_query("run query " + sql)
@@ -958,7 +4533,7 @@ def handle_query(command):
         else:
             speak("Let me find the answer for you.")
             try:
-                answer = gemini_chat(command)
+                answer = gemini_chat(build_prompt(command))
                 answer = answer.strip() if answer else ""
                 speak(answer)
                 print("Gemini Answer:", answer)
@@ -1043,4 +4618,21 @@ def main():
             traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="A.L.I.A.S. voice assistant")
+    parser.add_argument("--compact", action="store_true",
+                        help="archive old chat history, vacuum the chat database and exit")
+    parser.add_argument("--history-days", type=float, help="archive chat turns older than this")
+    parser.add_argument("--history-rows", type=int, help="keep at most this many chat turns")
+    parser.add_argument("--memory-days", type=float, help="archive query memory unused for this long")
+    parser.add_argument("--memory-rows", type=int, help="keep at most this many query memory rows")
+    args = parser.parse_args()
+    if args.compact:
+        result = compact_chat_database(
+            history_days=args.history_days, history_rows=args.history_rows,
+            memory_days=args.memory_days, memory_rows=args.memory_rows, convert=True,
+        )
+        print(json.dumps(result, indent=2))
+    else:
+        main()
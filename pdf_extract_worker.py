@@ -0,0 +1,20 @@
+"""
+Process-pool worker for PDF text extraction.
+
+Kept separate from Alias.py on purpose: worker processes import this module,
+and importing Alias would start TTS, the camera stack and other heavy imports
+in every child.
+"""
+
+
+def extract_page_range(file_path: str, start: int, end: int) -> list:
+    """Extract text for pages [start, end) of a PDF. Unreadable pages yield ""."""
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    texts = []
+    for index in range(start, min(end, len(reader.pages))):
+        try:
+            texts.append(reader.pages[index].extract_text() or "")
+        except Exception:
+            texts.append("")
+    return texts
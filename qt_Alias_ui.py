@@ -18,6 +18,7 @@ import sys
 import html
 import os
 import threading
+import itertools
 
 try:
     import speech_recognition as sr
@@ -87,6 +88,7 @@ class ChatBubble(QFrame):
         super().__init__()
         self.setFrameShape(QFrame.Shape.NoFrame)
         self.setObjectName("user" if is_user else "assistant")
+        self._label: QLabel | None = None
         layout = QVBoxLayout(self)
 
         if not is_user and text.strip().startswith("```"):
@@ -116,10 +118,12 @@ class ChatBubble(QFrame):
                 label = QLabel(text)
                 label.setWordWrap(True)
                 layout.addWidget(label)
+                self._label = label
         else:
             label = QLabel(text)
             label.setWordWrap(True)
             layout.addWidget(label)
+            self._label = label
 
         self.setStyleSheet(
             """
@@ -129,6 +133,13 @@ class ChatBubble(QFrame):
             """
         )
 
+    def set_text(self, text: str) -> bool:
+        """Replace the text of a plain bubble in place. Returns False for code bubbles."""
+        if self._label is None:
+            return False
+        self._label.setText(text)
+        return True
+
 
 # ---------------- Orb Widget ----------------
 class OrbWidget(QWidget):
@@ -170,8 +181,11 @@ class OrbWidget(QWidget):
 class UiSignals(QObject):
     add_user = pyqtSignal(str)
     add_assistant = pyqtSignal(str)
+    assistant_partial = pyqtSignal(int, str)
+    assistant_final = pyqtSignal(int, str)
     set_active = pyqtSignal(bool)
     progress = pyqtSignal(int)
+    status = pyqtSignal(object)
     scroll_bottom = pyqtSignal()
 
 
@@ -182,6 +196,9 @@ class MainWindow(QWidget):
         self.backend = FridayBackend()
         self.signals = UiSignals()
         self._selected_file: str | None = None
+        # Streaming replies: request id -> (bubble, row container) being grown in place
+        self._stream_bubbles: dict[int, tuple[ChatBubble, QWidget]] = {}
+        self._stream_ids = itertools.count(1)
 
         self._init_palette()
         self._init_ui()
@@ -233,6 +250,8 @@ class MainWindow(QWidget):
         self.input.returnPressed.connect(self._send_text)
         self.upload = QPushButton("Upload File")
         self.upload.clicked.connect(self._choose_file)
+        self.upload_folder = QPushButton("Upload Folder")
+        self.upload_folder.clicked.connect(self._choose_folder)
         self.send = QPushButton("Send")
         self.send.clicked.connect(self._send_text)
         self.tts_toggle = QPushButton("🔊 On")
@@ -247,6 +266,7 @@ class MainWindow(QWidget):
         bottom.addWidget(self.orb, 0)
         bottom.addWidget(self.input, 1)
         bottom.addWidget(self.upload, 0)
+        bottom.addWidget(self.upload_folder, 0)
         bottom.addWidget(self.tts_toggle, 0)
         bottom.addWidget(self.pause_btn, 0)
         bottom.addWidget(self.send, 0)
@@ -259,31 +279,30 @@ class MainWindow(QWidget):
         self.progress = QProgressBar()
         self.progress.setValue(0)
         self.progress.setVisible(False)
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.setVisible(False)
+        self.cancel_btn.clicked.connect(self._cancel_analysis)
+        self._cancel_token = None
         info_row.addWidget(self.file_label, 1)
         info_row.addWidget(self.progress, 0)
+        info_row.addWidget(self.cancel_btn, 0)
         root.addLayout(info_row)
 
         # Welcome text - check if user name is stored
         welcome_msg = "Hello, I am ALIAS. I remember our conversations and learn from them. How can I assist you?"
-        try:
-            import sqlite3
-            conn = sqlite3.connect("alias_chat_history.db")
-            cursor = conn.cursor()
-            cursor.execute('SELECT value FROM user_preferences WHERE key = ?', ("user_name",))
-            result = cursor.fetchone()
-            if result:
-                user_name = result[0]
-                welcome_msg = f"Hello {user_name}, I am ALIAS. I remember our conversations and learn from them. How can I assist you?"
-            conn.close()
-        except Exception:
-            pass
+        user_name = self.backend.get_user_preference("user_name")
+        if user_name:
+            welcome_msg = f"Hello {user_name}, I am ALIAS. I remember our conversations and learn from them. How can I assist you?"
         self._append_assistant(welcome_msg)
 
     def _wire_signals(self):
         self.signals.add_user.connect(lambda t: self._append_bubble(t, True))
         self.signals.add_assistant.connect(lambda t: self._append_bubble(t, False))
+        self.signals.assistant_partial.connect(self._on_assistant_partial)
+        self.signals.assistant_final.connect(self._on_assistant_final)
         self.signals.set_active.connect(self.orb.setActive)
         self.signals.progress.connect(self._set_progress)
+        self.signals.status.connect(self._on_status)
         self.signals.scroll_bottom.connect(self._scroll_to_bottom)
 
     # ------------ Chat helpers ------------
@@ -305,34 +324,123 @@ class MainWindow(QWidget):
         cont.setLayout(wrapper)
         self.chat_layout.insertWidget(self.chat_layout.count() - 1, cont)
         self.signals.scroll_bottom.emit()
+        return bubble, cont
 
     def _append_assistant(self, text: str):
         self._append_bubble(text, False)
 
+    def _on_assistant_partial(self, request_id: int, text: str):
+        entry = self._stream_bubbles.get(request_id)
+        if entry is None:
+            self._stream_bubbles[request_id] = self._append_bubble(text, False)
+            return
+        entry[0].set_text(text)
+        self.signals.scroll_bottom.emit()
+
+    def _on_assistant_final(self, request_id: int, text: str):
+        entry = self._stream_bubbles.pop(request_id, None)
+        if entry is None:
+            self._append_bubble(text, False)
+            return
+        bubble, cont = entry
+        if text.strip().startswith("```") or not bubble.set_text(text):
+            # Code replies need the dedicated code layout; rebuild the bubble
+            idx = self.chat_layout.indexOf(cont)
+            cont.setParent(None)
+            cont.deleteLater()
+            _, new_cont = self._append_bubble(text, False)
+            if idx >= 0:
+                self.chat_layout.removeWidget(new_cont)
+                self.chat_layout.insertWidget(idx, new_cont)
+        self.signals.scroll_bottom.emit()
+
+    def _ask_backend(self, text: str):
+        """Send text to the backend, streaming the reply into one growing bubble."""
+        request_id = next(self._stream_ids)
+        self.backend.analyze_text_async(
+            text,
+            on_result=lambda r: self.signals.assistant_final.emit(request_id, r),
+            on_error=lambda e: self.signals.assistant_final.emit(request_id, f"Error: {e}"),
+            on_activity=self.signals.set_active.emit,
+            on_partial=lambda p: self.signals.assistant_partial.emit(request_id, p),
+        )
+
     def _scroll_to_bottom(self):
         self.scroll.verticalScrollBar().setValue(self.scroll.verticalScrollBar().maximum())
 
     def _set_progress(self, val: int):
         self.progress.setVisible(val < 100)
         self.progress.setValue(val)
+        if val >= 100:
+            self.cancel_btn.setVisible(False)
+            self._cancel_token = None
+
+    def _on_status(self, status: dict):
+        parts = [status.get("name") or "Document", status.get("stage", "")]
+        if status.get("pages_total"):
+            parts.append(f"page {status['pages']}/{status['pages_total']}")
+        if status.get("chunks_total"):
+            parts.append(f"{status['chunks']}/{status['chunks_total']} chunks")
+        if status.get("bytes_total"):
+            parts.append(f"{status['bytes'] / 1048576:.1f}/{status['bytes_total'] / 1048576:.1f} MB")
+        if status.get("eta") is not None:
+            parts.append(f"~{int(status['eta']) + 1}s left")
+        self.file_label.setText(" · ".join(parts))
+
+    def _track_job(self, token):
+        self._cancel_token = token
+        self.cancel_btn.setText("Cancel")
+        self.cancel_btn.setEnabled(True)
+        self.cancel_btn.setVisible(token is not None)
+
+    def _cancel_analysis(self):
+        if self._cancel_token is not None:
+            self._cancel_token.cancel()
+            self.cancel_btn.setText("Cancelling…")
+            self.cancel_btn.setEnabled(False)
 
     # ------------ Actions ------------
     def _choose_file(self):
-        path, _ = QFileDialog.getOpenFileName(self, "Select file to analyze", "", "Documents (*.txt *.pdf *.docx);;All Files (*)")
-        if path:
+        paths, _ = QFileDialog.getOpenFileNames(self, "Select files to analyze", "", "Documents (*.txt *.pdf *.docx);;All Files (*)")
+        if len(paths) > 1:
+            self._start_batch(paths, f"{len(paths)} files")
+            return
+        if paths:
+            path = paths[0]
             self._selected_file = path
             name = os.path.basename(path)
             self.file_label.setText(f"Selected: {name}")
             # Kick off analysis immediately
             self._append_bubble(f"Uploaded {name}", True)
-            self.signals.progress.emit(5)
-            self.backend.analyze_file_async(
+            self.signals.progress.emit(1)
+            self._track_job(self.backend.analyze_file_async(
                 path,
                 on_progress=self.signals.progress.emit,
                 on_result=lambda r: self.signals.add_assistant.emit(r),
                 on_error=lambda e: self.signals.add_assistant.emit(f"Error: {e}"),
                 on_activity=self.signals.set_active.emit,
-            )
+                on_status=self.signals.status.emit,
+            ))
+
+    def _choose_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Select folder to analyze")
+        if folder:
+            self._start_batch(folder, os.path.basename(folder.rstrip("/\\")) or folder)
+
+    def _start_batch(self, paths, label: str):
+        self._selected_file = paths
+        self.file_label.setText(f"Selected: {label}")
+        self._append_bubble(f"Uploaded {label}", True)
+        self.signals.progress.emit(1)
+        self._track_job(self.backend.analyze_batch_async(
+            paths,
+            on_progress=self.signals.progress.emit,
+            on_file_result=lambda p, r: self.signals.add_assistant.emit(f"{os.path.basename(p)}:\n{r}"),
+            on_result=lambda r: self.signals.add_assistant.emit(r),
+            on_error=lambda e: self.signals.add_assistant.emit(f"Error: {e}"),
+            on_activity=self.signals.set_active.emit,
+            on_status=self.signals.status.emit,
+        ))
 
     def _send_text(self):
         text = self.input.text().strip()
@@ -340,12 +448,7 @@ class MainWindow(QWidget):
             return
         self.input.clear()
         self.signals.add_user.emit(text)
-        self.backend.analyze_text_async(
-            text,
-            on_result=lambda r: self.signals.add_assistant.emit(r),
-            on_error=lambda e: self.signals.add_assistant.emit(f"Error: {e}"),
-            on_activity=self.signals.set_active.emit,
-        )
+        self._ask_backend(text)
 
     def _toggle_tts(self):
         on = self.tts_toggle.isChecked()
@@ -393,12 +496,7 @@ class MainWindow(QWidget):
                         text = recognizer.recognize_google(audio)
                         if text:
                             self.signals.add_user.emit(text)
-                            self.backend.analyze_text_async(
-                                text,
-                                on_result=lambda r: self.signals.add_assistant.emit(r),
-                                on_error=lambda e: self.signals.add_assistant.emit(f"Error: {e}"),
-                                on_activity=self.signals.set_active.emit,
-                            )
+                            self._ask_backend(text)
                     except sr.UnknownValueError:
                         # ignore unrecognized noise
                         pass
@@ -1,4 +1,5 @@
 import threading
+import time
 from typing import Callable, Optional
 import webbrowser
 from urllib.parse import quote
@@ -20,13 +21,25 @@ class FridayBackend:
         self._import_friday_functions()
         # Initialize chat database
         self.init_chat_database()
+        # Preferences are served from memory; keep the user's name current without re-reading it
+        self.user_name = self.get_user_preference("user_name", "User")
+        self.subscribe_preference(self._on_user_name_changed, "user_name")
+
+    def _on_user_name_changed(self, key: str, value: str) -> None:
+        self.user_name = value or "User"
 
     def _import_friday_functions(self):
-        """Import all necessary functions from friday.py"""
+        """Import all necessary functions from Alias.py"""
         try:
-            from friday import (
+            from Alias import (
                 gemini_chat,
+                gemini_chat_stream,
+                build_prompt,
+                build_conversation_prompt,
                 analyze_document,
+                analyze_documents_batch,
+                search_documents,
+                CancelToken,
                 execute_command,
                 solve_math,
                 generate_code,
@@ -40,10 +53,21 @@ class FridayBackend:
                 get_recent_chat_history,
                 update_query_memory,
                 get_similar_queries,
+                lookup_cached_answer,
+                is_failed_answer,
                 init_chat_database,
+                get_user_preference,
+                set_user_preference,
+                subscribe_preference,
             )
             self.gemini_chat = gemini_chat
+            self.gemini_chat_stream = gemini_chat_stream
+            self.build_prompt = build_prompt
+            self.build_conversation_prompt = build_conversation_prompt
             self.analyze_document = analyze_document
+            self.analyze_documents_batch = analyze_documents_batch
+            self.search_documents = search_documents
+            self.CancelToken = CancelToken
             self.execute_command = execute_command
             self.solve_math = solve_math
             self.generate_code = generate_code
@@ -57,12 +81,23 @@ class FridayBackend:
             self.get_recent_chat_history = get_recent_chat_history
             self.update_query_memory = update_query_memory
             self.get_similar_queries = get_similar_queries
+            self.lookup_cached_answer = lookup_cached_answer
+            self.is_failed_answer = is_failed_answer
             self.init_chat_database = init_chat_database
+            self.get_user_preference = get_user_preference
+            self.set_user_preference = set_user_preference
+            self.subscribe_preference = subscribe_preference
         except Exception as e:
             print(f"Warning: Could not import some Friday functions: {e}")
             # Fallback functions
             self.gemini_chat = lambda x: f"(backend unavailable) {x}"
-            self.analyze_document = lambda x: f"(backend unavailable) Could not analyze: {x}"
+            self.gemini_chat_stream = lambda x, *args, **kwargs: f"(backend unavailable) {x}"
+            self.build_prompt = lambda query, **kwargs: query
+            self.build_conversation_prompt = lambda query, **kwargs: query
+            self.analyze_document = lambda x, *args, **kwargs: f"(backend unavailable) Could not analyze: {x}"
+            self.analyze_documents_batch = lambda x, **kwargs: {"digest": f"(backend unavailable) Could not analyze: {x}", "files": []}
+            self.search_documents = lambda x, k=None: []
+            self.CancelToken = lambda: None
             self.execute_command = lambda x: None
             self.solve_math = lambda x: None
             self.generate_code = lambda x: None
@@ -72,11 +107,16 @@ class FridayBackend:
             self.get_news_summary = lambda x: ""
             self.speak = lambda x: None
             self.stop_speaking = lambda: None
-            self.save_chat_message = lambda a, b, c="general", d="default": None
+            self.save_chat_message = lambda a, b, *args, **kwargs: None
             self.get_recent_chat_history = lambda a=10, b="default": []
-            self.update_query_memory = lambda a, b, c=True: None
+            self.update_query_memory = lambda a, b, *args, **kwargs: None
             self.get_similar_queries = lambda a, b=3: []
+            self.lookup_cached_answer = lambda x, *args, **kwargs: None
+            self.is_failed_answer = lambda text: False
             self.init_chat_database = lambda: None
+            self.get_user_preference = lambda key, default=None: default
+            self.set_user_preference = lambda key, value: False
+            self.subscribe_preference = lambda callback, key=None: (lambda: None)
 
     def _handle_web_commands(self, lower: str) -> str:
         """Handle web browser commands"""
@@ -189,6 +229,16 @@ class FridayBackend:
                 return f"News error: {e}"
         return ""
 
+    def _handle_cached_answer(self, lower: str, prompt: str) -> str:
+        """Serve a stored answer for a close match of a frequently successful past query."""
+        # Name introductions update preferences in _handle_general_query, so never short-circuit them
+        if lower.startswith(("my name is ", "i am ", "call me ")):
+            return ""
+        try:
+            return self.lookup_cached_answer(prompt) or ""
+        except Exception:
+            return ""
+
     def _clean_output(self, text: str) -> str:
         """Clean output text by removing asterisks and formatting for better speech."""
         if not text:
@@ -207,8 +257,15 @@ class FridayBackend:
         
         return text
 
-    def _handle_general_query(self, prompt: str) -> str:
-        """Handle general AI queries"""
+    def _handle_general_query(self, prompt: str, on_partial: Optional[Callable[[str], None]] = None,
+                              history=None) -> str:
+        """Handle general AI queries. If on_partial is given, the reply is streamed to it.
+
+        Context is the session's rolling summary plus its last verbatim turns,
+        unless history, a list of (user, assistant) turns, is passed explicitly.
+        The best-matching passages of previously analyzed documents are added
+        to the prompt.
+        """
         try:
             # Check for specific name-related queries only
             lower = prompt.lower().strip()
@@ -230,23 +287,23 @@ class FridayBackend:
                     user_name = "User"
                 
                 # Store user's name in preferences
-                try:
-                    import sqlite3
-                    conn = sqlite3.connect("alias_chat_history.db")
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO user_preferences (key, value, updated_at)
-                        VALUES (?, ?, CURRENT_TIMESTAMP)
-                    ''', ("user_name", user_name))
-                    conn.commit()
-                    conn.close()
-                except Exception:
-                    pass
+                self.set_user_preference("user_name", user_name)
                 
                 return f"Nice to meet you, {user_name}! I'm ALIAS, and I'll remember your name for our future conversations."
             
-            # All other queries go to Gemini
-            raw_response = self.gemini_chat(prompt)
+            # All other queries go to Gemini, with retrieved document passages as context
+            passages = self.search_documents(prompt)
+            system = "Use the document excerpts below when they are relevant to the question." if passages else ""
+            if history is not None:
+                full_prompt = self.build_prompt(prompt, system=system, history=history, memory=passages)
+            else:
+                full_prompt = self.build_conversation_prompt(prompt, system=system, memory=passages)
+            if on_partial:
+                raw_response = self.gemini_chat_stream(
+                    full_prompt, on_chunk=lambda partial: on_partial(self._clean_output(partial))
+                )
+            else:
+                raw_response = self.gemini_chat(full_prompt)
             return self._clean_output(raw_response)
         except Exception as e:
             return f"AI query error: {e}"
@@ -257,9 +314,15 @@ class FridayBackend:
         on_result: Callable[[str], None],
         on_error: Optional[Callable[[str], None]] = None,
         on_activity: Optional[Callable[[bool], None]] = None,
+        on_partial: Optional[Callable[[str], None]] = None,
     ) -> None:
-        """Process text command asynchronously"""
+        """Process text command asynchronously.
+
+        on_partial, if given, receives the growing assistant text while a
+        general query is streamed; on_result still receives the final text.
+        """
         def worker():
+            started = time.perf_counter()
             try:
                 if on_activity:
                     on_activity(True)
@@ -267,30 +330,11 @@ class FridayBackend:
                 lower = prompt.lower()
                 result = ""
                 
-                # Get recent chat history for context
-                recent_history = self.get_recent_chat_history(5)
-                context = ""
-                if recent_history:
-                    context = "Recent conversation context:\n"
-                    for user_msg, assistant_msg, cmd_type, timestamp in reversed(recent_history[-3:]):
-                        context += f"User: {user_msg}\nAssistant: {assistant_msg}\n"
-                    context += "\nCurrent query: "
-                
                 # Get user's name from preferences for personalized responses
-                user_name = "User"
-                try:
-                    import sqlite3
-                    conn = sqlite3.connect("alias_chat_history.db")
-                    cursor = conn.cursor()
-                    cursor.execute('SELECT value FROM user_preferences WHERE key = ?', ("user_name",))
-                    result = cursor.fetchone()
-                    if result:
-                        user_name = result[0]
-                    conn.close()
-                except Exception:
-                    pass
+                user_name = self.user_name
                 
-                # Try each command handler in order
+                # Try each command handler in order; a cached answer only replaces the Gemini call
+                cached = ""
                 result = (self._handle_voice_commands(lower, prompt) or
                          self._handle_web_commands(lower) or
                          self._handle_system_commands(lower, prompt) or
@@ -299,7 +343,8 @@ class FridayBackend:
                          self._handle_database_commands(lower, prompt) or
                          self._handle_email_commands(lower, prompt) or
                          self._handle_news_commands(lower, prompt) or
-                         self._handle_general_query(context + prompt if context else prompt))
+                         (cached := self._handle_cached_answer(lower, prompt)) or
+                         self._handle_general_query(prompt, on_partial))
                 
                 # Clean the result for better display and speech
                 if result:
@@ -324,13 +369,18 @@ class FridayBackend:
                 elif lower.startswith("open youtube") or lower.startswith("open chrome"):
                     command_type = "web"
                 
+                latency_ms = (time.perf_counter() - started) * 1000
                 on_result(result or "")
                 
                 # Save to database
                 if result:
                     try:
-                        self.save_chat_message(prompt, result, command_type)
-                        self.update_query_memory(prompt, result, True)
+                        self.save_chat_message(prompt, result, command_type, latency_ms=latency_ms)
+                        # Cached replies leave query_memory alone so last_used keeps tracking the model's answer;
+                        # failures are counted against the query but their error text is never stored
+                        if not cached:
+                            success = not self.is_failed_answer(result)
+                            self.update_query_memory(prompt, result if success else "", success)
                     except Exception:
                         pass
                 
@@ -357,20 +407,21 @@ class FridayBackend:
         on_result: Optional[Callable[[str], None]] = None,
         on_error: Optional[Callable[[str], None]] = None,
         on_activity: Optional[Callable[[bool], None]] = None,
-    ) -> None:
-        """Analyze file asynchronously"""
+        on_status: Optional[Callable[[dict], None]] = None,
+    ):
+        """Analyze file asynchronously.
+
+        on_status receives detailed progress (pages, chunks, bytes, ETA).
+        Returns a cancel token; call its cancel() to stop the analysis.
+        """
+        cancel = self.CancelToken()
+
         def worker():
             try:
                 if on_activity:
                     on_activity(True)
                 
-                if on_progress:
-                    on_progress(10)
-                
-                summary = self.analyze_document(file_path)
-                
-                if on_progress:
-                    on_progress(90)
+                summary = self.analyze_document(file_path, on_progress=on_progress, on_status=on_status, cancel=cancel)
                 
                 if on_result:
                     on_result(summary or "")
@@ -391,4 +442,60 @@ class FridayBackend:
                 if on_activity:
                     on_activity(False)
 
-        threading.Thread(target=worker, daemon=True).start()
\ No newline at end of file
+        threading.Thread(target=worker, daemon=True).start()
+        return cancel
+
+    def analyze_batch_async(
+        self,
+        paths,
+        on_progress: Optional[Callable[[int], None]] = None,
+        on_file_result: Optional[Callable[[str, str], None]] = None,
+        on_result: Optional[Callable[[str], None]] = None,
+        on_error: Optional[Callable[[str], None]] = None,
+        on_activity: Optional[Callable[[bool], None]] = None,
+        on_status: Optional[Callable[[dict], None]] = None,
+    ):
+        """Analyze a folder or several files asynchronously and report a combined digest.
+
+        on_status receives the detailed progress of whichever file reported last.
+        Returns a cancel token; call its cancel() to stop the batch.
+        """
+        cancel = self.CancelToken()
+
+        def worker():
+            try:
+                if on_activity:
+                    on_activity(True)
+
+                if on_progress:
+                    on_progress(0)
+
+                # Files are processed smallest-first on a bounded pool; each one is reported as it finishes
+                batch = self.analyze_documents_batch(
+                    paths,
+                    on_progress=on_progress,
+                    on_file_done=on_file_result,
+                    on_file_status=(lambda path, status: on_status(status)) if on_status else None,
+                    cancel=cancel,
+                )
+
+                if on_result:
+                    on_result(f"Combined digest:\n{batch.get('digest', '')}")
+
+                if batch.get("digest") and TTS_ENABLED:
+                    try:
+                        self.speak(batch["digest"])
+                    except Exception:
+                        pass
+
+            except Exception as e:
+                if on_error:
+                    on_error(str(e))
+            finally:
+                if on_progress:
+                    on_progress(100)
+                if on_activity:
+                    on_activity(False)
+
+        threading.Thread(target=worker, daemon=True).start()
+        return cancel
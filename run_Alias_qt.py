@@ -4,6 +4,7 @@ Friday AI (PyQt6)
 Run this to launch the sleek black-and-white Friday chat UI.
 """
 import sys
+import multiprocessing
 
 def main() -> int:
     try:
@@ -18,6 +19,8 @@ def main() -> int:
         return 1
 
 if __name__ == "__main__":
+    # Needed for PDF extraction worker processes in a frozen (PyInstaller) build
+    multiprocessing.freeze_support()
     sys.exit(main())
 
 
@@ -0,0 +1,43 @@
+"""
+Shared fixtures. Alias is imported against a throwaway database, with no
+Gemini key (so nothing reaches the network) and automatic retention off.
+"""
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["ALIAS_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="alias_tests_"), "chat.db")
+os.environ["GEMINI_API_KEY"] = ""  # load_dotenv() does not override variables that are already set
+os.environ["ALIAS_RETENTION"] = "off"
+
+import Alias  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    """Keep text-to-speech out of the tests."""
+    monkeypatch.setattr(Alias, "speak", lambda *args, **kwargs: None)
+
+
+@pytest.fixture
+def chat_db(tmp_path, monkeypatch):
+    """A fresh, migrated chat database swapped in for Alias.chat_db and everything built on it."""
+    db = Alias.SQLiteManager(str(tmp_path / "chat.db"))
+    writes = Alias.WriteBehindQueue(db, interval=0.01)
+    buffer = Alias.ConversationBuffer(db)
+    monkeypatch.setattr(Alias, "chat_db", db)
+    monkeypatch.setattr(Alias, "chat_writes", writes)
+    monkeypatch.setattr(Alias, "conversation_buffer", buffer)
+    monkeypatch.setattr(Alias, "conversation_summary", Alias.RollingSummary(buffer))
+    monkeypatch.setattr(Alias, "_df_cache", OrderedDict())
+    monkeypatch.setattr(Alias, "_query_rows", {"rows": 0, "checked": 0.0})
+    monkeypatch.setattr(Alias, "_answer_cache_stats", {"lookups": 0, "hits": 0, "skipped": 0})
+    Alias.migrate_chat_database(db)
+    yield db
+    writes.close()
+    db.close()
@@ -0,0 +1,99 @@
+"""lookup_cached_answer: which prompts and stored answers may skip the LLM."""
+import pytest
+
+import Alias
+
+QUESTION = "how do I reverse a list in python"
+ANSWER = "Use my_list.reverse() or my_list[::-1]."
+
+
+def _remember(query, response=ANSWER, times=2, success=True):
+    for _ in range(times):
+        Alias.update_query_memory(query, response, success=success)
+    Alias.chat_writes.flush(timeout=10)
+
+
+@pytest.fixture
+def answered(chat_db):
+    _remember(QUESTION)
+    for filler in ("open notepad", "set a timer for ten minutes", "take a screenshot",
+                   "play some jazz music", "what is the capital of france"):
+        _remember(filler, f"answer to {filler}", times=1)
+    return chat_db
+
+
+def test_repeated_question_is_served_from_memory(answered):
+    assert Alias.lookup_cached_answer("How do I reverse a list in Python?") == ANSWER
+    assert Alias.get_answer_cache_stats()["hits"] == 1
+
+
+def test_question_asked_only_once_is_not_served(chat_db):
+    _remember(QUESTION, times=1)
+
+    assert Alias.lookup_cached_answer(QUESTION) is None
+
+
+def test_unreliable_answers_are_not_served(chat_db):
+    _remember(QUESTION, times=2)
+    _remember(QUESTION, "AI query error: timeout", times=2, success=False)
+
+    assert Alias.lookup_cached_answer(QUESTION) is None  # success rate 0.5
+
+
+def test_error_replies_are_not_served(chat_db):
+    _remember(QUESTION, "AI query error: 503 Service Unavailable")
+
+    assert Alias.lookup_cached_answer(QUESTION) is None
+
+
+def test_stale_answers_are_not_served(answered):
+    answered.execute("UPDATE query_memory SET last_used = datetime('now', '-30 days')")
+
+    assert Alias.lookup_cached_answer(QUESTION) is None
+
+
+def test_unrelated_question_misses(answered):
+    assert Alias.lookup_cached_answer("how do I sort a dictionary by value") is None
+    assert Alias.get_answer_cache_stats()["lookups"] == 1
+
+
+@pytest.mark.parametrize("prompt", [
+    "what is the latest news about python",  # time-sensitive
+    "check my email",
+    "reverse it",  # too short
+    "and how do I reverse a list in java",  # continues the previous turn
+    "tell me more about reversing a list in python",
+])
+def test_prompts_that_always_go_to_the_model(answered, prompt):
+    assert Alias.lookup_cached_answer(prompt) is None
+    assert Alias.get_answer_cache_stats()["skipped"] == 1
+
+
+def test_short_pronoun_prompt_is_skipped_only_during_a_conversation(chat_db):
+    _remember("why is that so slow", "Because of the GIL.")
+
+    assert Alias.lookup_cached_answer("why is that so slow") == "Because of the GIL."
+
+    Alias.save_chat_message("how do I loop over a file", "Use a for loop over the file object.")
+
+    assert Alias.lookup_cached_answer("why is that so slow") is None
+    assert Alias.lookup_cached_answer("why is that so slow", session_id="other") == "Because of the GIL."
+
+
+def test_standalone_question_is_served_during_a_conversation(answered):
+    Alias.save_chat_message("open notepad", "Opening notepad")
+
+    assert Alias.lookup_cached_answer("how do I reverse a list in python") == ANSWER
+
+
+def test_is_failed_answer():
+    assert Alias.is_failed_answer("")
+    assert Alias.is_failed_answer("Service is temporarily unavailable. Please try again.")
+    assert Alias.is_failed_answer("Failed to open browser: not found")
+    assert not Alias.is_failed_answer("Error handling in Python uses try/except.")
+
+
+def test_disabled(answered, monkeypatch):
+    monkeypatch.setattr(Alias, "ANSWER_CACHE_ENABLED", False)
+
+    assert Alias.lookup_cached_answer(QUESTION) is None
@@ -0,0 +1,113 @@
+"""get_chat_statistics from the trigger-maintained counters, through inserts, deletes and archiving."""
+import pytest
+
+import Alias
+
+
+def _save(db, turns):
+    for user_msg, command_type, latency_ms in turns:
+        Alias.save_chat_message(user_msg, f"reply to {user_msg}", command_type, latency_ms=latency_ms)
+    assert Alias.chat_writes.flush(timeout=10)
+
+
+def _counted_from_history(db):
+    # What get_chat_statistics used to compute by scanning chat_history
+    return {
+        "total": db.query_one("SELECT COUNT(*) FROM chat_history")[0],
+        "types": dict(db.query("SELECT command_type, COUNT(*) FROM chat_history GROUP BY command_type")),
+        "recent": db.query_one(
+            "SELECT COUNT(*) FROM chat_history WHERE timestamp > datetime('now', '-1 day')")[0],
+    }
+
+
+def _assert_matches_history(db):
+    stats = Alias.get_chat_statistics()
+    expected = _counted_from_history(db)
+    assert stats["total_messages"] == expected["total"]
+    assert dict(stats["command_stats"]) == expected["types"]
+    assert stats["recent_activity"] == expected["recent"]
+    return stats
+
+
+def test_counters_follow_inserts(chat_db):
+    _save(chat_db, [("open notepad", "system", 120), ("what is wal", "general", 900),
+                    ("what is fts5", "general", 1800), ("hello", None, None)])
+
+    stats = _assert_matches_history(chat_db)
+
+    assert stats["command_stats"][0] == ("general", 2)
+    assert stats["latency"]["general"] == {
+        "count": 2, "avg_ms": 1350.0, "p50_ms": 1000, "p90_ms": 2000, "p99_ms": 2000,
+    }
+    assert stats["latency"]["system"]["count"] == 1
+    assert None not in stats["latency"]  # no timings recorded for it
+
+
+def test_slow_replies_land_in_the_overflow_bucket(chat_db):
+    _save(chat_db, [("summarize this book", "document", 90_000)])
+
+    latency = Alias.get_chat_statistics()["latency"]["document"]
+
+    assert latency["avg_ms"] == 90_000.0
+    assert latency["p50_ms"] is None
+
+
+def test_counters_follow_deletes(chat_db):
+    _save(chat_db, [("open notepad", "system", 120), ("what is wal", "general", 900),
+                    ("what is fts5", "general", 1800)])
+
+    chat_db.execute("DELETE FROM chat_history WHERE command_type = 'general'")
+
+    stats = _assert_matches_history(chat_db)
+    assert stats["command_stats"] == [("system", 1)]
+    assert "general" not in stats["latency"]
+    assert chat_db.query_one("SELECT SUM(count) FROM chat_latency_histogram WHERE command_type = 'general'")[0] == 0
+
+
+def test_old_rows_do_not_count_as_recent(chat_db):
+    chat_db.execute(
+        "INSERT INTO chat_history (timestamp, user_message, assistant_response, command_type, session_id) "
+        "VALUES (datetime('now', '-3 days'), 'old', 'reply', 'general', 'default')"
+    )
+    _save(chat_db, [("new", "general", None)])
+
+    stats = _assert_matches_history(chat_db)
+    assert stats["total_messages"] == 2
+    assert stats["recent_activity"] == 1
+
+
+def test_counters_follow_archiving(chat_db):
+    for days in (40, 30, 20):
+        chat_db.execute(
+            "INSERT INTO chat_history (timestamp, user_message, assistant_response, command_type, session_id, "
+            "latency_ms) VALUES (datetime('now', ?), 'old', 'reply', 'general', 'default', 700)",
+            (f"-{days} days",),
+        )
+    _save(chat_db, [("open notepad", "system", 120), ("what is wal", "general", 900)])
+    assert Alias.get_chat_statistics()["total_messages"] == 5
+
+    summary = Alias.compact_chat_database(chat_db, history_days=10, history_rows=0, memory_days=0, memory_rows=0)
+
+    assert summary["chat_history"]["rows"] == 3
+    stats = _assert_matches_history(chat_db)
+    assert stats["total_messages"] == 2
+    assert stats["latency"]["general"]["count"] == 1
+    assert chat_db.query_one("SELECT COUNT(*) FROM chat_activity_hourly WHERE messages <= 0")[0] == 0
+    assert [row["user_message"] for row in Alias.iter_archived_rows("chat_history", chat_db)] == ["old"] * 3
+
+
+def test_row_limit_archives_the_oldest(chat_db):
+    _save(chat_db, [(f"question {i}", "general", 100) for i in range(6)])
+
+    Alias.compact_chat_database(chat_db, history_days=0, history_rows=4, memory_days=0, memory_rows=0)
+
+    assert Alias.get_chat_statistics()["total_messages"] == 4
+    remaining = [row[0] for row in chat_db.query("SELECT user_message FROM chat_history ORDER BY id")]
+    assert remaining == [f"question {i}" for i in range(2, 6)]
+
+
+@pytest.mark.parametrize("fraction, expected", [(0.5, 100), (0.9, 500), (1.0, None)])
+def test_histogram_percentile(fraction, expected):
+    buckets = [(100, 5), (500, 4), (None, 1)]
+
+    assert Alias._histogram_percentile(buckets, fraction) == expected
@@ -0,0 +1,95 @@
+"""CircuitBreaker state transitions and the Retry-After / backoff helpers."""
+import time
+
+import requests
+
+import Alias
+
+
+def _opened(threshold=3, reset=0.05):
+    breaker = Alias.CircuitBreaker(failure_threshold=threshold, reset_timeout=reset)
+    for _ in range(threshold):
+        breaker.record_failure()
+    return breaker
+
+
+def test_opens_after_threshold_consecutive_failures():
+    breaker = Alias.CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert 0 < breaker.retry_in() <= 60
+
+
+def test_success_resets_the_failure_count():
+    breaker = Alias.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_a_single_probe_through():
+    breaker = _opened()
+    time.sleep(0.06)
+
+    assert breaker.state == "half_open"
+    assert breaker.retry_in() == 0.0
+    assert breaker.allow()
+    assert not breaker.allow()  # the probe is still in flight
+
+
+def test_successful_probe_closes_the_circuit():
+    breaker = _opened()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens_the_circuit():
+    breaker = _opened(reset=0.2)
+    time.sleep(0.21)
+    assert breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_in() > 0.1
+
+
+def test_parse_retry_after():
+    assert Alias._parse_retry_after("12") == 12.0
+    assert Alias._parse_retry_after("") is None
+    assert Alias._parse_retry_after("soon") is None
+    assert Alias._parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0  # dates in the past clamp to zero
+
+
+def test_backoff_stays_within_base_and_cap():
+    delay = Alias.GEMINI_BACKOFF_BASE
+    for _ in range(50):
+        delay = Alias._decorrelated_jitter(delay, base=0.5, cap=8)
+        assert 0.5 <= delay <= 8
+
+
+def test_transient_errors():
+    def http_error(status):
+        response = requests.models.Response()
+        response.status_code = status
+        return requests.exceptions.HTTPError(response=response)
+
+    assert Alias._is_transient_error(requests.exceptions.Timeout())
+    assert Alias._is_transient_error(Alias.GeminiRateLimitError("429", retry_after=3))
+    assert Alias._is_transient_error(http_error(503))
+    assert not Alias._is_transient_error(http_error(400))
+    assert not Alias._is_transient_error(ValueError("bad prompt"))
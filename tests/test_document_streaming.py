@@ -0,0 +1,113 @@
+"""Streaming extraction (iter_text_from_file) against the old whole-file reads."""
+import multiprocessing
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import Alias
+from conftest import ROOT
+
+
+def _old_pdf_text(path):
+    # read_text_from_file before streaming: every page, joined with newlines
+    from pypdf import PdfReader
+    return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages).strip()
+
+
+@pytest.fixture
+def sample_pdf(tmp_path):
+    pytest.importorskip("reportlab")
+    pytest.importorskip("pypdf")
+    path = str(tmp_path / "sample.pdf")
+    Alias.write_text_pdf((f"line {i} of the sample document\n" for i in range(3000)), path)
+    return path
+
+
+def test_txt_stream_matches_whole_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(Alias, "TEXT_BLOCK_CHARS", 1000)
+    path = tmp_path / "sample.txt"
+    text = "".join(f"línea {i}: {'x' * (i % 50)}\n" for i in range(5000)) + "y" * 4000
+    path.write_text(text, encoding="utf-8")
+
+    units = list(Alias.iter_text_from_file(str(path)))
+
+    assert len(units) > 1
+    assert "".join(units) == text
+    assert Alias.read_text_from_file(str(path)) == text.strip()
+
+
+def test_docx_stream_matches_docx2txt(tmp_path):
+    docx2txt = pytest.importorskip("docx2txt")
+    import zipfile
+
+    w = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+    paragraphs = "".join(f'<w:p><w:r><w:t>Paragraph {i} of the report.</w:t></w:r></w:p>' for i in range(200))
+    path = str(tmp_path / "sample.docx")
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("[Content_Types].xml", '<?xml version="1.0"?><Types/>')
+        archive.writestr("word/document.xml", f'<?xml version="1.0"?><w:document xmlns:w="{w}"><w:body>'
+                                              f'{paragraphs}</w:body></w:document>')
+
+    streamed = "".join(Alias.iter_text_from_file(path))
+
+    assert streamed.split() == docx2txt.process(path).split()
+
+
+def test_pdf_stream_matches_old_path_serial_and_parallel(sample_pdf, monkeypatch):
+    expected = _old_pdf_text(sample_pdf)
+    monkeypatch.setattr(Alias, "DOC_CACHE_ENABLED", False)
+
+    monkeypatch.setattr(Alias, "PDF_EXTRACT_WORKERS", 1)
+    assert Alias.read_text_from_file(sample_pdf) == expected
+
+    monkeypatch.setattr(Alias, "PDF_EXTRACT_WORKERS", 2)
+    monkeypatch.setattr(Alias, "PDF_PARALLEL_MIN_PAGES", 1)
+    assert Alias.read_text_from_file(sample_pdf) == expected
+    units = list(Alias.iter_text_from_file(sample_pdf))
+    assert all(unit.endswith(Alias.PAGE_BREAK) for unit in units)
+
+
+def test_peak_memory_stays_bounded_for_large_input():
+    small = Alias.benchmark_document_streaming(megabytes=8)
+    large = Alias.benchmark_document_streaming(megabytes=32)
+    print("peak traced bytes:", small["peak_traced_bytes"], large["peak_traced_bytes"],
+          "peak RSS bytes:", large["peak_rss_bytes"])
+
+    assert large["bytes"] > 30 * 1024 * 1024
+    assert large["chars"] >= large["bytes"] * 0.99
+    # Memory follows the block and chunk size, not the file size
+    assert large["peak_traced_bytes"] < 16 * 1024 * 1024
+    assert large["peak_traced_bytes"] < small["peak_traced_bytes"] * 2
+    assert "peak_rss_bytes" in large
+
+
+def test_early_close_stops_parallel_pdf_workers(sample_pdf, monkeypatch):
+    monkeypatch.setattr(Alias, "PDF_EXTRACT_WORKERS", 2)
+    monkeypatch.setattr(Alias, "PDF_PARALLEL_MIN_PAGES", 1)
+
+    units = Alias.iter_text_from_file(sample_pdf)
+    next(units)
+    units.close()
+
+    assert multiprocessing.active_children() == []
+
+
+def test_interpreter_exits_after_early_close(sample_pdf, tmp_path):
+    # The interpreter used to hang at exit after an early close; run it in a child with a timeout
+    script = textwrap.dedent(f"""
+        import Alias
+        pages = list(Alias.iter_text_from_file({sample_pdf!r}))
+        units = Alias.iter_text_from_file({sample_pdf!r})
+        next(units)
+        units.close()
+        print(len(pages))
+    """)
+    env = dict(os.environ, ALIAS_PDF_WORKERS="3", ALIAS_PDF_PARALLEL_MIN_PAGES="1",
+               ALIAS_DB_PATH=str(tmp_path / "child.db"), PYTHONPATH=os.pathsep.join([ROOT] + sys.path))
+    result = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, timeout=120)
+
+    assert result.returncode == 0, result.stderr
+    assert int(result.stdout.strip().splitlines()[-1]) > 1
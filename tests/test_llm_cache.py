@@ -0,0 +1,84 @@
+"""LLMResponseCache: memory LRU in front of the SQLite table, TTLs and eviction."""
+import time
+
+import Alias
+
+
+def test_key_ignores_whitespace_but_not_config():
+    key = Alias.LLMResponseCache.make_key("What is  WAL\nmode?")
+
+    assert key == Alias.LLMResponseCache.make_key("  What is WAL mode? ")
+    assert key != Alias.LLMResponseCache.make_key("What is WAL mode?", {"temperature": 0.9})
+    assert key != Alias.LLMResponseCache.make_key("What is WAL mode?", model="gemini-pro")
+
+
+def test_memory_hit_then_disk_hit_in_a_new_instance(chat_db):
+    cache = Alias.LLMResponseCache(chat_db)
+    key = cache.make_key("hello")
+    assert cache.get(key) is None
+
+    cache.put(key, "Hi there")
+    assert cache.get(key) == "Hi there"
+
+    reopened = Alias.LLMResponseCache(chat_db)
+    assert reopened.get(key) == "Hi there"
+    assert reopened.get(key) == "Hi there"
+    assert cache.stats["misses"] == 1 and cache.stats["memory_hits"] == 1
+    assert reopened.stats["disk_hits"] == 1 and reopened.stats["memory_hits"] == 1
+
+
+def test_expired_entries_are_dropped_from_both_tiers(chat_db, monkeypatch):
+    monkeypatch.setitem(Alias.LLM_CACHE_TTLS, "news", 0.05)
+    cache = Alias.LLMResponseCache(chat_db)
+    key = cache.make_key("latest headlines")
+    cache.put(key, "Old news", feature="news")
+    time.sleep(0.06)
+
+    assert cache.get(key) is None
+    assert chat_db.query_one("SELECT COUNT(*) FROM llm_cache")[0] == 0
+
+
+def test_failed_replies_and_disabled_features_are_not_stored(chat_db, monkeypatch):
+    monkeypatch.setitem(Alias.LLM_CACHE_TTLS, "news", 0)
+    cache = Alias.LLMResponseCache(chat_db)
+
+    cache.put(cache.make_key("a"), "")
+    cache.put(cache.make_key("b"), "Headlines", feature="news")
+
+    assert cache.stats["stores"] == 0
+    assert chat_db.query_one("SELECT COUNT(*) FROM llm_cache")[0] == 0
+
+
+def test_memory_tier_evicts_least_recently_used(chat_db):
+    cache = Alias.LLMResponseCache(chat_db, memory_entries=2)
+    keys = [cache.make_key(f"prompt {i}") for i in range(3)]
+    cache.put(keys[0], "zero")
+    cache.put(keys[1], "one")
+    cache.get(keys[0])  # keys[1] is now the least recently used
+    cache.put(keys[2], "two")
+
+    assert list(cache._memory) == [keys[0], keys[2]]
+    assert cache.stats["evictions"] == 1
+    assert cache.get(keys[1]) == "one"  # still on disk
+
+
+def test_disk_tier_is_bounded_by_entries(chat_db):
+    cache = Alias.LLMResponseCache(chat_db, memory_entries=1, disk_entries=10)
+    for i in range(50):  # eviction runs every 50 stores
+        cache.put(cache.make_key(f"prompt {i}"), f"reply {i}")
+        time.sleep(0.001)  # distinct last_access times
+
+    rows = chat_db.query("SELECT response FROM llm_cache")
+    assert len(rows) == 10
+    assert {row[0] for row in rows} == {f"reply {i}" for i in range(40, 50)}
+
+
+def test_clear_empties_both_tiers(chat_db):
+    cache = Alias.LLMResponseCache(chat_db)
+    key = cache.make_key("hello")
+    cache.put(key, "Hi")
+
+    cache.clear()
+
+    assert cache.get(key) is None
+    assert cache.get_stats()["memory_entries"] == 0
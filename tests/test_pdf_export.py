@@ -0,0 +1,88 @@
+"""Streaming PDF export: line wrapping across pieces and pagination from a generator."""
+import math
+
+import pytest
+
+import Alias
+
+
+def _wrap(pieces, max_width=20):
+    return list(Alias._wrap_text_stream(pieces, len, max_width))
+
+
+def test_wrapping_does_not_depend_on_how_text_is_split():
+    text = "The quick brown fox jumps over the lazy dog.\n\n    indented line here\nend " * 3
+    pieces = [text[i:i + 7] for i in range(0, len(text), 7)]
+
+    assert _wrap(pieces) == _wrap([text])
+    assert _wrap([ch for ch in text]) == _wrap([text])
+
+
+def test_wrapping_rules():
+    lines = _wrap(["one  two\tthree\n  four\n\n" + "x" * 45])
+
+    assert lines[0] == "one two three"
+    assert lines[1] == "  four"  # leading indentation is kept
+    assert lines[2] == ""
+    assert lines[3:] == ["x" * 20, "x" * 20, "x" * 5]  # over-long words break by character
+    assert all(len(line) <= 20 for line in lines)
+
+
+@pytest.fixture
+def reader():
+    pytest.importorskip("reportlab")
+    return pytest.importorskip("pypdf").PdfReader
+
+
+def _lines_per_page():
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.units import inch
+    return int((letter[1] - 1.5 * inch) // Alias.PDF_EXPORT_LEADING)
+
+
+def test_pages_follow_the_line_count(tmp_path, reader):
+    path = str(tmp_path / "out.pdf")
+    per_page = _lines_per_page()
+
+    pages = Alias.write_text_pdf((f"line {i}\n" for i in range(per_page * 3 + 1)), path, title="Transcript")
+
+    assert pages == 4
+    pdf = reader(path)
+    assert len(pdf.pages) == 4
+    assert pdf.metadata.title == "Transcript"
+    first, last = pdf.pages[0].extract_text(), pdf.pages[-1].extract_text()
+    assert "line 0" in first and f"line {per_page - 1}" in first and "Page 1" in first
+    assert f"line {per_page * 3}" in last and "Page 4" in last
+
+
+def test_pages_are_written_while_the_generator_runs(tmp_path, reader):
+    produced = []
+    progress = []
+
+    def transcript():
+        for i in range(2000):
+            produced.append(i)
+            yield f"[{i}] the assistant read the document and wrote a summary\n"
+
+    pages = Alias.write_text_pdf(transcript(), str(tmp_path / "out.pdf"),
+                                 on_page=lambda page: progress.append((page, len(produced))))
+
+    assert [page for page, _ in progress] == list(range(1, pages + 1))
+    assert pages == math.ceil(2000 / _lines_per_page())
+    # Page 1 was finished long before the last piece was pulled
+    assert progress[0][1] < 100
+
+
+def test_empty_text_gives_one_page(tmp_path, reader):
+    path = str(tmp_path / "empty.pdf")
+
+    assert Alias.write_text_pdf("", path) == 1
+    assert len(reader(path).pages) == 1
+
+
+def test_export_returns_the_path_or_none(tmp_path, reader):
+    path = str(tmp_path / "notes.pdf")
+
+    assert Alias.export_text_to_pdf(iter(["hello ", "world"]), path) == path
+    assert "hello world" in reader(path).pages[0].extract_text()
+    assert Alias.export_text_to_pdf("hello", str(tmp_path / "missing" / "notes.pdf")) is None
@@ -0,0 +1,82 @@
+"""search_query_memory / get_similar_queries over the query_memory word index."""
+import pytest
+
+import Alias
+
+QUERIES = [
+    "what is the weather in london",
+    "what is the weather in paris tomorrow",
+    "open notepad",
+    "play some jazz music",
+    "how do I reverse a list in python",
+    "what is the capital of france",
+    "set a timer for ten minutes",
+    "send an email to my manager",
+    "take a screenshot",
+    "show me the latest news",
+    "translate good morning into spanish",
+    "read my calendar for today",
+]
+
+
+@pytest.fixture
+def memory(chat_db):
+    for query in QUERIES:
+        Alias.update_query_memory(query, f"answer to {query}")
+    return chat_db
+
+
+def test_exact_query_ranks_first(memory):
+    results = Alias.search_query_memory("What is the weather in London?")
+
+    assert results[0]["query"] == "what is the weather in london"
+    assert results[0]["similarity"] == pytest.approx(1.0)
+    assert results[1]["query"] == "what is the weather in paris tomorrow"
+    assert results[0]["similarity"] > results[1]["similarity"]
+
+
+def test_rare_terms_outweigh_common_ones(memory):
+    results = Alias.search_query_memory("what is python", limit=1)
+
+    assert results[0]["query"] == "how do I reverse a list in python"
+
+
+def test_min_similarity_and_limit(memory):
+    assert len(Alias.search_query_memory("what is the weather", limit=2)) == 2
+    assert Alias.search_query_memory("weather in tokyo", min_similarity=0.9) == []
+    assert Alias.search_query_memory("quantum chromodynamics") == []
+    assert Alias.search_query_memory("?!") == []
+
+
+def test_new_query_is_found_after_an_earlier_miss(memory):
+    assert Alias.search_query_memory("define photosynthesis") == []
+
+    Alias.update_query_memory("define photosynthesis", "Plants turning light into sugar")
+
+    results = Alias.search_query_memory("define photosynthesis")
+    assert results and results[0]["response"] == "Plants turning light into sugar"
+
+
+def test_ties_go_to_the_more_used_entry(memory):
+    Alias.update_query_memory("Open Notepad!", "Opening notepad")
+    Alias.update_query_memory("play some jazz", "Playing jazz")
+    Alias.update_query_memory("play some jazz", "Playing jazz")
+
+    results = Alias.search_query_memory("play jazz", limit=2)
+
+    assert results[0]["query"] == "play some jazz"
+    assert results[0]["frequency"] == 2
+
+
+def test_like_fallback_without_the_word_index(memory, monkeypatch):
+    monkeypatch.setattr(Alias, "_query_index_ready", lambda: False)
+
+    results = Alias.search_query_memory("open notepad please")
+
+    assert results[0]["query"] == "open notepad"
+
+
+def test_get_similar_queries_returns_tuples(memory):
+    query, response, frequency, success_rate = Alias.get_similar_queries("open notepad", limit=1)[0]
+
+    assert (query, response, frequency, success_rate) == ("open notepad", "answer to open notepad", 1, 1.0)
@@ -0,0 +1,146 @@
+"""Schema migrations from the original (unversioned) tables and the query_memory UPSERT."""
+import sqlite3
+
+import pytest
+
+import Alias
+
+# The tables as the first release created them, before PRAGMA user_version was used
+BASELINE_SCHEMA = """
+CREATE TABLE chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    user_message TEXT NOT NULL,
+    assistant_response TEXT NOT NULL,
+    command_type TEXT,
+    session_id TEXT
+);
+CREATE TABLE query_memory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    query TEXT NOT NULL,
+    response TEXT NOT NULL,
+    frequency INTEGER DEFAULT 1,
+    last_used DATETIME DEFAULT CURRENT_TIMESTAMP,
+    success_rate REAL DEFAULT 1.0
+);
+CREATE TABLE user_preferences (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO chat_history (timestamp, user_message, assistant_response, command_type, session_id) "
+        "VALUES (?, ?, ?, ?, 'default')",
+        [("2024-01-01 09:15:00", "open notepad", "Opening notepad", "system"),
+         ("2024-01-01 09:40:00", "what is sqlite", "A database", "general"),
+         ("2024-01-01 10:05:00", "hi", "Hello", None)],
+    )
+    conn.executemany(
+        "INSERT INTO query_memory (query, response, frequency, success_rate) VALUES (?, ?, ?, ?)",
+        [("What is SQLite?", "old answer", 3, 1.0),
+         ("what is   sqlite", "newer answer", 1, 0.0),
+         ("open notepad", "Opening notepad", 2, 1.0)],
+    )
+    conn.execute("INSERT INTO user_preferences (key, value) VALUES ('voice', 'female')")
+    conn.commit()
+    conn.close()
+    db = Alias.SQLiteManager(path)
+    yield db
+    db.close()
+
+
+def _names(db, kind):
+    return {row[0] for row in db.query("SELECT name FROM sqlite_master WHERE type = ?", (kind,))}
+
+
+def test_baseline_database_migrates_to_latest(baseline_db):
+    assert Alias.migrate_chat_database(baseline_db) == len(Alias.SCHEMA_MIGRATIONS) == 8
+
+    assert baseline_db.query_one("PRAGMA user_version")[0] == 8
+    assert {"llm_cache", "document_cache", "archive_segments", "chat_stats",
+            "chat_activity_hourly", "chat_latency_histogram", "document_index"} <= _names(baseline_db, "table")
+    assert {"idx_chat_history_session_time", "idx_query_memory_hash"} <= _names(baseline_db, "index")
+    assert baseline_db.query_one("SELECT value FROM user_preferences WHERE key = 'voice'")[0] == "female"
+    assert baseline_db.query_one("SELECT COUNT(*) FROM chat_history WHERE latency_ms IS NULL")[0] == 3
+
+
+def test_duplicate_queries_are_merged(baseline_db):
+    Alias.migrate_chat_database(baseline_db)
+
+    rows = baseline_db.query("SELECT id, query, response, frequency, success_rate FROM query_memory ORDER BY id")
+
+    assert [row[0] for row in rows] == [2, 3]
+    merged = rows[0]
+    assert merged[2] == "newer answer"  # the newest row survives
+    assert merged[3] == 4
+    assert merged[4] == pytest.approx(0.75)  # weighted by frequency
+
+
+def test_counters_are_seeded_from_existing_rows(baseline_db):
+    Alias.migrate_chat_database(baseline_db)
+
+    stats = dict(baseline_db.query("SELECT command_type, messages FROM chat_stats"))
+    hours = dict(baseline_db.query("SELECT hour, messages FROM chat_activity_hourly"))
+
+    assert stats == {"system": 1, "general": 1, "": 1}
+    assert hours == {"2024-01-01 09:00": 2, "2024-01-01 10:00": 1}
+
+
+def test_migrating_again_is_a_no_op(baseline_db):
+    Alias.migrate_chat_database(baseline_db)
+    Alias._migrated_paths.discard(baseline_db.path)
+
+    assert Alias.migrate_chat_database(baseline_db) == 8
+    assert baseline_db.query_one("SELECT COUNT(*) FROM query_memory")[0] == 2
+
+
+def test_failed_migration_leaves_the_previous_version(baseline_db, monkeypatch):
+    def broken(conn):
+        conn.execute("CREATE TABLE half_done (id INTEGER)")
+        raise sqlite3.OperationalError("disk on fire")
+
+    monkeypatch.setattr(Alias, "SCHEMA_MIGRATIONS", Alias.SCHEMA_MIGRATIONS[:2] + [broken])
+
+    with pytest.raises(sqlite3.OperationalError):
+        Alias.migrate_chat_database(baseline_db)
+
+    assert baseline_db.query_one("PRAGMA user_version")[0] == 0
+    assert "half_done" not in _names(baseline_db, "table")
+    assert "idx_chat_history_session_time" not in _names(baseline_db, "index")
+
+
+def test_query_hash_normalizes_case_whitespace_and_punctuation():
+    assert Alias._query_hash("What is SQLite?") == Alias._query_hash("  what is   sqlite ")
+    assert Alias._query_hash("What is SQLite?") != Alias._query_hash("What is MySQL?")
+
+
+def _memory(db):
+    return db.query_one("SELECT query, response, frequency, success_rate FROM query_memory")
+
+
+def test_upsert_counts_repeats_and_averages_success(chat_db):
+    assert Alias.update_query_memory("Open Notepad", "Opening notepad", durable=True)
+    assert Alias.update_query_memory("open notepad!", "Opening notepad now", durable=True)
+    assert _memory(chat_db) == ("Open Notepad", "Opening notepad now", 2, 1.0)
+
+    assert Alias.update_query_memory("open notepad", "Error: no window", success=False, durable=True)
+
+    query, response, frequency, success_rate = _memory(chat_db)
+    assert chat_db.query_one("SELECT COUNT(*) FROM query_memory")[0] == 1
+    assert response == "Opening notepad now"  # a failure keeps the last good response
+    assert frequency == 3
+    assert success_rate == pytest.approx(2 / 3)
+
+
+def test_upsert_stores_an_empty_response_for_a_first_failure(chat_db):
+    Alias.update_query_memory("send the email", "Error", success=False, durable=True)
+
+    assert _memory(chat_db) == ("send the email", "", 1, 0.0)
@@ -0,0 +1,91 @@
+"""WriteBehindQueue: batching, per-operation savepoints, durable submits and flush."""
+import Alias
+
+
+def _insert(value):
+    return lambda conn: conn.execute("INSERT INTO items (value) VALUES (?)", (value,))
+
+
+def _insert_then_fail(value):
+    def op(conn):
+        conn.execute("INSERT INTO items (value) VALUES (?)", (value,))
+        raise ValueError("boom")
+    return op
+
+
+def _values(db):
+    return [row[0] for row in db.query("SELECT value FROM items ORDER BY id")]
+
+
+def _queue(tmp_path, **kwargs):
+    db = Alias.SQLiteManager(str(tmp_path / "writes.db"))
+    db.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT NOT NULL)")
+    return db, Alias.WriteBehindQueue(db, **kwargs)
+
+
+def test_failing_write_is_rolled_back_without_losing_its_batch(tmp_path):
+    db, writes = _queue(tmp_path, interval=5)
+    try:
+        writes.submit(_insert("a"))
+        writes.submit(_insert_then_fail("half-written"))
+        writes.submit(_insert(None))  # NOT NULL violation
+        writes.submit(_insert("b"))
+        assert writes.flush(timeout=10)
+
+        assert _values(db) == ["a", "b"]
+        stats = writes.get_stats()
+        assert stats["written"] == 2 and stats["failed"] == 2
+        assert stats["batches"] == 1 and stats["pending"] == 0
+    finally:
+        writes.close()
+        db.close()
+
+
+def test_writes_are_batched(tmp_path):
+    db, writes = _queue(tmp_path, batch_size=10, interval=5)
+    try:
+        for i in range(25):
+            writes.submit(_insert(str(i)))
+        assert writes.flush(timeout=10)
+
+        assert _values(db) == [str(i) for i in range(25)]
+        assert writes.get_stats()["batches"] <= 4
+        assert writes.get_stats()["largest_batch"] == 10
+    finally:
+        writes.close()
+        db.close()
+
+
+def test_durable_submit_waits_and_reports_the_outcome(tmp_path):
+    db, writes = _queue(tmp_path, interval=5)
+    try:
+        assert writes.submit(_insert("kept"), durable=True) is True
+        assert _values(db) == ["kept"]  # committed before submit returned
+
+        assert writes.submit(_insert_then_fail("lost"), durable=True) is False
+        assert _values(db) == ["kept"]
+    finally:
+        writes.close()
+        db.close()
+
+
+def test_close_flushes_and_later_writes_go_straight_through(tmp_path):
+    db, writes = _queue(tmp_path, interval=5)
+    try:
+        writes.submit(_insert("queued"))
+        writes.close()
+        assert _values(db) == ["queued"]
+
+        assert writes.submit(_insert("after close")) is True
+        assert _values(db) == ["queued", "after close"]
+    finally:
+        db.close()
+
+
+def test_chat_messages_are_visible_after_flush(chat_db):
+    Alias.save_chat_message("hello", "Hi!", "general")
+    Alias.update_query_memory("hello", "Hi!")
+    assert Alias.chat_writes.flush(timeout=10)
+
+    assert chat_db.query_one("SELECT user_message, assistant_response FROM chat_history") == ("hello", "Hi!")
+    assert chat_db.query_one("SELECT frequency FROM query_memory")[0] == 1